@@ -1,20 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import hashlib
+import weakref
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Callable
+from bisect import bisect_left
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Iterator
+
+import numpy as np
+
+from blockflow.boundary import (
+    boundary_kinds,
+    find_boundary_points,
+    get_sentence_splitter,
+    segment_sentences,
+)
+from blockflow.cache import encode_texts
+from blockflow.dtypes import Allocation, Boundary, TruncationStrategy
+from blockflow.errors import FrozenBlockError
+from blockflow.span import TokenSpan
+from blockflow.tokenizer import tokenizer_artifacts, tokenizer_fingerprint
+from blockflow.truncation import (
+    FlatTree,
+    NodeData,
+    Tree,
+    TruncationPlan,
+    allocate_budget,
+    fold_tree,
+    truncate,
+)
+
+# rich is only needed to render blocks and is imported on first use
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    from rich.panel import Panel
+    from tokenizers import Encoding
+
+    from blockflow.corpus import Corpus
+
+# Executor the async methods run tokenization and truncation in, None for the
+# event loop's default thread pool, and how many subtrees run in it at once
+_EXECUTOR: Executor | None = None
+_MAX_CONCURRENCY = 8
+
+
+def set_executor(executor: Executor | None, max_concurrency: int | None = None):
+    """
+    Change the executor used by `atext`, `atokens` and `asize` when none is
+    passed explicitly, and optionally the number of subtrees they truncate at
+    the same time. Use a thread pool: the blocks are not copied to the workers.
+    """
+    global _EXECUTOR, _MAX_CONCURRENCY
+    _EXECUTOR = executor
+    if max_concurrency is not None:
+        _MAX_CONCURRENCY = max_concurrency
+
+
+async def _offload(executor: Executor | None, func: Callable):
+    if executor is None:
+        executor = _EXECUTOR
+    return await asyncio.get_running_loop().run_in_executor(executor, func)
+
 
-from rich.console import Group
-from rich.panel import Panel
-from rich.style import Style
-from rich.text import Text
-from tokenizers import Encoding
+class AbstractBlock(ABC):
+    # Blocks are slotted: trees can have tens of thousands of them
+    __slots__ = (
+        "_cache",
+        "_parent",
+        "_other_parents",
+        "_frozen",
+        "_tokenizer",
+        "name",
+        "max_tokens",
+        "truncation_strategy",
+        "ellipsis",
+        "boundary",
+        "weight",
+        "reading_order_idx",
+        "priority_order_idx",
+        "__weakref__",
+    )
+
+    # Attributes that feed into cached encodings and truncation results. Assigning
+    # a new value to any of them marks the block and its ancestors dirty.
+    _cached_attributes = frozenset(
+        {
+            "_tokenizer",
+            "name",
+            "max_tokens",
+            "truncation_strategy",
+            "ellipsis",
+            "boundary",
+            "allocation",
+            "weight",
+            "lazy",
+        }
+    )
+
+    def __setattr__(self, key, value):
+        changed = key in self._cached_attributes and (
+            getattr(self, key, None) is not value
+        )
+        if changed:
+            self._check_editable()
+        super().__setattr__(key, value)
+        if changed:
+            self._mark_dirty()
 
-from blockflow.boundary import find_boundary_points
-from blockflow.dtypes import Boundary, TruncationStrategy
-from blockflow.tokenizer import create_tokenizer
-from blockflow.truncation import truncate
+    def _freeze(self):
+        """
+        Make this block and every block below it reject edits. Frozen blocks
+        can be shared by several trees, whose child lists leave their parent
+        as it was when they were frozen.
+        """
+        for block in _descendants(self):
+            object.__setattr__(block, "_frozen", True)
+
+    def _check_editable(self):
+        if getattr(self, "_frozen", False):
+            raise FrozenBlockError(
+                f"{type(self).__name__} {self.name!r} is frozen because other "
+                "trees share it, e.g. as a static part of a BlockTemplate"
+            )
 
+    def _parents(self) -> list[AbstractBlock]:
+        """Every block that adopted this one as a child and is still alive."""
+        parents = [] if self._parent is None else [self._parent]
+        others = getattr(self, "_other_parents", None)
+        if others:
+            parents.extend(others)
+        return parents
+
+    def _add_parent(self, parent: AbstractBlock):
+        """
+        Make `parent` the parent of this block. A block can be the child of
+        several parents, which are all marked dirty when it changes; the ones
+        before the last are only held weakly.
+        """
+        # _parent is missing while a copy or unpickle is still filling the block
+        previous = getattr(self, "_parent", None)
+        if previous is not None and previous is not parent:
+            others = weakref.WeakSet(getattr(self, "_other_parents", None) or ())
+            others.add(previous)
+            others.discard(parent)
+            self._other_parents = others
+        self._parent = parent
+
+    def _mark_dirty(self):
+        """Drop the cached results of this block and every ancestor."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            while node is not None:
+                cache = getattr(node, "_cache", None)
+                if cache:
+                    cache.clear()
+                others = getattr(node, "_other_parents", None)
+                if others:
+                    stack.extend(others)
+                # _parent is missing while a copy is still filling the block
+                node = getattr(node, "_parent", None)
+
+    def __getstate__(self) -> dict:
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for key in getattr(cls, "__slots__", ()):
+                if key not in ("__dict__", "__weakref__") and hasattr(self, key):
+                    state[key] = getattr(self, key)
+        if state.get("_other_parents") is not None:
+            # Weak sets do not pickle
+            state["_other_parents"] = tuple(state["_other_parents"])
+        return state
+
+    def __setstate__(self, state: dict):
+        # Copies and unpickled blocks get their caches back as they were, rather
+        # than marking themselves and their parent dirty attribute by attribute
+        for key, value in state.items():
+            if key == "_other_parents" and value is not None:
+                value = weakref.WeakSet(value)
+            object.__setattr__(self, key, value)
 
-class AbstractBlock(ABC):
     @abstractmethod
     def full_tokens(self) -> Encoding:
         pass
@@ -35,26 +203,263 @@ class AbstractBlock(ABC):
     def text(self) -> str:
         pass
 
+    def iter_tokens(self) -> Iterator[TokenSpan]:
+        """
+        The tokens of `tokens`, one leaf at a time in reading order. Each leaf
+        is yielded as soon as its budget is settled, before the leaves after it
+        are tokenized when their parents hand out tokens in reading order.
+        """
+        for leaf in _stream_leaves(self):
+            if len(leaf.tokens):
+                yield leaf.tokens
+
+    def iter_text(self) -> Iterator[str]:
+        """The text of `text`, decoded one leaf at a time, see `iter_tokens`."""
+        for tokens in self.iter_tokens():
+            yield tokens.text(self._tokenizer)
+
+    def _streams_children(self) -> bool:
+        """Whether the budget of each child is settled by the children before it."""
+        return False
+
+    def _subblocks(self) -> tuple[AbstractBlock, ...] | list[AbstractBlock]:
+        """The blocks directly below this one, each listed once."""
+        return ()
+
+    def _replace_tokenizer(self, tokenizer) -> bool:
+        """
+        Swap the tokenizer of this block alone, dropping its own cached results
+        but not those of its ancestors. Returns whether the tokenizer changed.
+        """
+        if tokenizer is self._tokenizer:
+            return False
+        self._check_editable()
+        self._cache.clear()
+        object.__setattr__(self, "_tokenizer", tokenizer)
+        return True
+
     def full_size(self):
-        return len(self.full_tokens().tokens)
+        return len(self._full_span())
 
     def size(self):
-        return len(self.tokens().tokens)
+        return self._truncated_size()
+
+    def _ensure_tokenizer_set(self):
+        if self._tokenizer is None:
+            raise ValueError("Tokenizer must be explicitly provided")
+
+    def plan(self, max_tokens: int | None = None) -> TruncationPlan:
+        """
+        The truncation of this block as a `TruncationPlan`: which tokens of
+        which leaves are kept, in flat arrays, without merging the tokens or
+        building an `Encoding`. `max_tokens` replaces the budget of this block,
+        not those of the blocks below it. `materialize` builds the text from
+        the plan, `materialize_tokens` the tokens.
+        """
+        self._ensure_tokenizer_set()
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        plans = self._cache.setdefault("plans", {})
+        if max_tokens not in plans:
+            block = self
+            if max_tokens != self.max_tokens:
+                # A copy of this block alone, sharing the children and their
+                # cached truncations
+                block = copy.copy(self)
+                block._cache = {}
+                block._parent = None
+                block._other_parents = None
+                block._frozen = False
+                block.max_tokens = max_tokens
+                if isinstance(block, Block):
+                    block._cache["tokenizer_set"] = True
+            plans[max_tokens] = _make_plan(block)
+        return plans[max_tokens]
+
+    def materialize(self, plan: TruncationPlan) -> str:
+        """The text kept by `plan`, made by `plan` for this tree or an equal one."""
+        return self._plan_span(plan).text(self._tokenizer)
+
+    def materialize_tokens(self, plan: TruncationPlan) -> Encoding:
+        """The tokens kept by `plan`, see `materialize`."""
+        return self._plan_span(plan).to_encoding()
+
+    def _plan_span(self, plan: TruncationPlan) -> TokenSpan:
+        self._ensure_tokenizer_set()
+        if plan.fingerprint != _tree_fingerprint(self, plan.max_tokens):
+            raise ValueError("The plan was made for a different tree")
+        leaves = list(_leaf_occurrences(self))
+        # Only the leaves with tokens kept need tokens
+        kept = [leaves[idx] for idx in np.unique(plan.segments[:, 0]) if idx >= 0]
+        pending = [leaf for leaf in kept if leaf._tokens is None]
+        spans = encode_texts(self._tokenizer, [leaf.full_text() for leaf in pending])
+        for leaf, span in zip(pending, spans):
+            leaf._tokens = span
+
+        ellipsis = tokenizer_artifacts(self._tokenizer).ellipsis
+        spans = [
+            (ellipsis if idx < 0 else leaves[idx]._full_span())
+            .slice(start, end)
+            .shifted(shift)
+            for idx, start, end, shift in plan.segments.tolist()
+        ]
+        return TokenSpan([piece for span in spans for piece in span.pieces])
+
+    def fingerprint(self) -> bytes:
+        """
+        Digest of what the truncation of this block depends on: the shape of
+        the tree below it, the texts and settings of its blocks, the tokenizer
+        and the sentence splitter. Equal trees have the same fingerprint in
+        every process, so plans can be cached by it.
+        """
+        self._ensure_tokenizer_set()
+        return _tree_fingerprint(self, self.max_tokens)
+
+    def _digest_settings(self, max_tokens: int | None) -> tuple:
+        """The settings of this block that its truncation depends on."""
+        return (
+            type(self).__name__,
+            max_tokens,
+            self.truncation_strategy,
+            self.ellipsis,
+            self.boundary,
+            self.weight,
+        )
+
+    async def _atruncate_subtrees(
+        self, executor: Executor | None, max_concurrency: int | None
+    ):
+        """Truncate what can be truncated independently before this block does."""
+
+    async def atext(
+        self, executor: Executor | None = None, max_concurrency: int | None = None
+    ) -> str:
+        """
+        `text` for asyncio code: tokenization and truncation run in `executor`
+        instead of the event loop, see `set_executor` for the defaults. The
+        block must not be edited until the call returns.
+        """
+        await self._atruncate_subtrees(executor, max_concurrency)
+        return await _offload(executor, self.text)
+
+    async def atokens(
+        self, executor: Executor | None = None, max_concurrency: int | None = None
+    ) -> Encoding:
+        """`tokens` for asyncio code, see `atext`."""
+        await self._atruncate_subtrees(executor, max_concurrency)
+        return await _offload(executor, self.tokens)
+
+    async def asize(
+        self, executor: Executor | None = None, max_concurrency: int | None = None
+    ) -> int:
+        """`size` for asyncio code, see `atext`."""
+        await self._atruncate_subtrees(executor, max_concurrency)
+        return await _offload(executor, self.size)
 
     @abstractmethod
     def set_tokenizer(self, tokenizer):
         pass
 
 
-@dataclass
-class NodeData:
-    tokens: Encoding
-    remainder_left: Encoding
-    remainder_right: Encoding
-    name: str
+class _ChildList(list):
+    """
+    List of child blocks that keeps each child's parent link up to date and
+    marks the owning block dirty whenever it is edited in place.
+    """
+
+    def __init__(self, owner: "Block", children=()):
+        super().__init__(children)
+        self._owner = owner
+        for child in self:
+            self._adopt(child)
+
+    def _adopt(self, child):
+        if isinstance(child, AbstractBlock) and not getattr(child, "_frozen", False):
+            child._add_parent(self._owner)
+
+    def _check_editable(self):
+        owner = getattr(self, "_owner", None)
+        if owner is not None:
+            owner._check_editable()
+
+    def _changed(self, added=()):
+        # _owner is missing while a copy or unpickle is still filling the list
+        owner = getattr(self, "_owner", None)
+        if owner is None:
+            return
+        for child in added:
+            self._adopt(child)
+        owner._mark_dirty()
+
+    def append(self, child):
+        self._check_editable()
+        super().append(child)
+        self._changed([child])
+
+    def extend(self, children):
+        self._check_editable()
+        children = list(children)
+        super().extend(children)
+        self._changed(children)
+
+    def insert(self, index, child):
+        self._check_editable()
+        super().insert(index, child)
+        self._changed([child])
+
+    def pop(self, index=-1):
+        self._check_editable()
+        child = super().pop(index)
+        self._changed()
+        return child
+
+    def remove(self, child):
+        self._check_editable()
+        super().remove(child)
+        self._changed()
+
+    def clear(self):
+        self._check_editable()
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        self._check_editable()
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        self._check_editable()
+        super().reverse()
+        self._changed()
+
+    def __setitem__(self, key, value):
+        self._check_editable()
+        super().__setitem__(key, value)
+        self._changed(value if isinstance(key, slice) else [value])
+
+    def __delitem__(self, key):
+        self._check_editable()
+        super().__delitem__(key)
+        self._changed()
+
+    def __iadd__(self, children):
+        self._check_editable()
+        children = list(children)
+        super().__iadd__(children)
+        self._changed(children)
+        return self
+
+    def __imul__(self, n):
+        self._check_editable()
+        super().__imul__(n)
+        self._changed()
+        return self
 
 
 class Block(AbstractBlock):
+    __slots__ = ("_children", "separator", "allocation", "lazy")
+
     def __init__(
         self,
         children: list[AbstractBlock] | None = None,
@@ -65,10 +470,15 @@ class Block(AbstractBlock):
         separator: str = "",
         ellipsis: bool = False,
         tokenizer: Callable | None = None,
-        boundary: Boundary = "token",
+        boundary: Boundary | tuple[Boundary, ...] = "token",
+        allocation: Allocation = "priority",
+        weight: float = 1.0,
         reading_order_idx: int | None = None,
         priority_order_idx: int | None = None,
+        lazy: bool = False,
     ):
+        self._cache = {}
+        self._parent = None
         # Initialize the Block with various parameters including children, text, name, etc.
         self._initialize_basic_properties(
             children,
@@ -80,8 +490,11 @@ class Block(AbstractBlock):
             ellipsis,
             tokenizer,
             boundary,
+            allocation,
+            weight,
             reading_order_idx,
             priority_order_idx,
+            lazy,
         )
         # If a separator is specified and there are children, insert a separator TextBlock between each child
         self._insert_separators()
@@ -103,8 +516,11 @@ class Block(AbstractBlock):
         ellipsis,
         tokenizer,
         boundary,
+        allocation,
+        weight,
         reading_order_idx,
         priority_order_idx,
+        lazy,
     ):
         """
         Initializes the basic properties of the Block.
@@ -116,13 +532,14 @@ class Block(AbstractBlock):
         self.ellipsis = ellipsis
         self._tokenizer = tokenizer
         self.boundary = boundary
+        self.allocation = allocation
+        self.weight = weight
         self.reading_order_idx = reading_order_idx
         self.priority_order_idx = priority_order_idx
+        self.lazy = lazy
 
         # Initialize children to an empty list if None is passed
-        self.children: list[TextBlock | Block] = (
-            children if children is not None else []
-        )
+        self.children = children if children is not None else []
 
         # Validation for max_tokens
         if self.max_tokens is not None and self.max_tokens < 0:
@@ -130,6 +547,50 @@ class Block(AbstractBlock):
                 f"max_tokens should be a positive integer, not {self.max_tokens}"
             )
 
+    @property
+    def children(self) -> list["TextBlock | Block"]:
+        return self._children
+
+    @children.setter
+    def children(self, children: list["TextBlock | Block"]):
+        self._check_editable()
+        self._children = _ChildList(self, children)
+        self._mark_dirty()
+
+    def _subblocks(self) -> list[AbstractBlock]:
+        return self._children
+
+    def _streams_children(self) -> bool:
+        # "never" children claim their tokens first, then the others do in
+        # reading order unless the block is truncated from the left
+        return self.max_tokens is None or (
+            self.allocation == "priority" and self.truncation_strategy != "left"
+        )
+
+    def _digest_settings(self, max_tokens: int | None) -> tuple:
+        return (
+            *super()._digest_settings(max_tokens),
+            self.allocation,
+            self.lazy,
+        )
+
+    def _align(self, tree: Tree) -> list[tuple[AbstractBlock, Tree | NodeData | None]]:
+        """
+        Pair every child, in reading order, with its part of `tree`, a result
+        of `truncate` cut or not, or None for the children it leaves out.
+        """
+        return list(zip(self.children, tree))
+
+    def _tokenizes_lazily(self) -> bool:
+        # With "priority" allocation every child that comes after the budget is
+        # spent is dropped whatever its size, so it need not be tokenized
+        return (
+            self.lazy
+            and self.max_tokens is not None
+            and self.allocation == "priority"
+            and self.truncation_strategy in ("left", "right")
+        )
+
     def _insert_separators(self):
         if self.separator and self.children:
             # Add separator object between each child
@@ -152,47 +613,48 @@ class Block(AbstractBlock):
                 prepend.append(TextBlock(text=self.separator, name="separator"))
             self.children = prepend + self.children
 
-    def _validate_children_max_tokens(self, max_tokens: int, truncation_strategy: str):
+    def _validate_children_max_tokens(self, never_tokens_count: int):
         # Only proceed if the parent has a max_tokens limit set
         if self.max_tokens is None:
             return
 
-        total_tokens_count: int = sum(
-            (len(child.tokens().tokens))
-            for child in self.children
-            if child.truncation_strategy == "never"
-        )
-
         # Check if any child's max_tokens exceed the parent's max_tokens
         for child in self.children:
             if child.truncation_strategy == "never" and child.max_tokens is not None:
-
                 if child.max_tokens > self.max_tokens:
                     raise ValueError(
                         f"Child '{child.name}' has {child.max_tokens} tokens "
                         f"exceeding the parent's max_tokens ({self.max_tokens})."
                     )
-            else:
-                pass
         # Check if the total tokens of all children exceed the parent's max_tokens
-        if total_tokens_count > self.max_tokens:
+        if never_tokens_count > self.max_tokens:
             raise ValueError(
                 "Total max_tokens of children with 'never' truncation strategy "
-                f"({total_tokens_count}) exceeds the parent's max_tokens ({self.max_tokens})."
+                f"({never_tokens_count}) exceeds the parent's max_tokens ({self.max_tokens})."
             )
 
     def boundary_points(self):
         return find_boundary_points(
-            encoding=self.full_tokens(),
+            encoding=self._full_span(),
             tokenizer=self._tokenizer,
             boundary=self.boundary,
             truncate=self.truncation_strategy,
         )
 
     def set_tokenizer(self, tokenizer):
-        self._tokenizer = tokenizer
-        for child in self.children:
-            child.set_tokenizer(tokenizer=tokenizer)
+        # Every block below gets the tokenizer in one walk, so each one only drops
+        # its own results and the ancestors are marked dirty once at the end
+        blocks = list(_descendants(self))
+        for block in blocks:
+            if block._tokenizer is not tokenizer:
+                block._check_editable()
+        changed = False
+        for block in blocks:
+            changed |= block._replace_tokenizer(tokenizer)
+            if isinstance(block, Block):
+                block._cache["tokenizer_set"] = True
+        if changed:
+            self._mark_dirty()
 
     def _ensure_tokenizer_set(self):
         if isinstance(self._tokenizer, str):
@@ -201,19 +663,90 @@ class Block(AbstractBlock):
             )
         if self._tokenizer is None:
             raise ValueError("Tokenizer must be explicitly provided")
-        self.set_tokenizer(self._tokenizer)
+        if not self._cache.get("tokenizer_set"):
+            self.set_tokenizer(self._tokenizer)
+            self._cache["tokenizer_set"] = True
 
-    def full_tokens(self) -> Encoding:
+    def prepare(self, n_process: int = 1) -> "Block":
+        """
+        Tokenize every leaf in the tree that has not been tokenized yet, with one
+        `encode_batch` call per tokenizer instead of one `encode` call per leaf.
+
+        Leaves that are cut on a "sentence" boundary, by themselves or by an
+        ancestor, are segmented into sentences in one batch as well, with the
+        default sentence splitter (`n_process` is passed on to it, see spaCy).
+        """
+        self._ensure_tokenizer_set()
+        if not self._cache.get("prepared"):
+            _prepare_tree([(self, False)], n_process=n_process)
+        return self
+
+    async def _atruncate_subtrees(
+        self, executor: Executor | None, max_concurrency: int | None
+    ):
+        """
+        Tokenize the tree in one batch, then truncate the children concurrently.
+        Their subtrees share no blocks, so they can be truncated in any thread.
+        """
+        if "truncated" in self._cache:
+            return
+        if self._tokenizes_lazily():
+            # Which children are truncated depends on the sizes of the ones before
+            await _offload(executor, self.truncate)
+            return
+        await _offload(executor, self._prepare_for_truncation)
+        limit = asyncio.Semaphore(max_concurrency or _MAX_CONCURRENCY)
+
+        async def truncate_child(child: AbstractBlock):
+            async with limit:
+                await _offload(executor, child.truncate)
+
+        await asyncio.gather(
+            *(
+                truncate_child(child)
+                for child in self.children
+                if "truncated" not in child._cache
+            )
+        )
+
+    def _full_span(self) -> TokenSpan:
         self._ensure_tokenizer_set()
 
-        joined_tokens: list[Encoding] = []
-        for _, child in enumerate(self.children):
-            joined_tokens.append(child.full_tokens())
-        return Encoding.merge(joined_tokens)
+        if "full_span" not in self._cache:
+            self.prepare()
+            # The leaves are merged once, rather than once per level of the tree,
+            # and only blocks below with the result cached are not walked
+            spans: list[TokenSpan] = []
+            stack: list[AbstractBlock] = list(reversed(self.children))
+            while stack:
+                block = stack.pop()
+                if isinstance(block, Block) and "full_span" not in block._cache:
+                    stack.extend(reversed(block.children))
+                else:
+                    spans.append(block._full_span())
+            self._cache["full_span"] = TokenSpan.merge(spans)
+        return self._cache["full_span"]
+
+    def full_tokens(self) -> Encoding:
+        if "full_tokens" not in self._cache:
+            self._cache["full_tokens"] = self._full_span().to_encoding()
+        return self._cache["full_tokens"]
 
     def full_text(self) -> str:
         self._ensure_tokenizer_set()
-        return self._tokenizer.decode(self.full_tokens().ids)
+        if "full_text" not in self._cache:
+            # The full span is sliced from the texts of the leaves whole, so they
+            # are joined without tokenizing them
+            texts: list[str] = []
+            stack: list[AbstractBlock] = list(reversed(self.children))
+            while stack:
+                block = stack.pop()
+                if isinstance(block, Block) and "full_text" not in block._cache:
+                    stack.extend(reversed(block.children))
+                else:
+                    texts.append(block.full_text())
+            self._cache["full_text"] = "".join(texts)
+        return self._cache["full_text"]
 
     def sort_by_priority(self, blocks: list["Block | TextBlock"]):
         # obtain reading order and priority order
@@ -231,170 +764,295 @@ class Block(AbstractBlock):
         return sorted(blocks, key=lambda x: x.reading_order_idx)
 
     def truncate_node(
-        self, node: list[str | Encoding] | NodeData, tokens_seen: int = 0
-    ) -> dict[str, NodeData | Encoding]:
-        number_allowed = max(self.max_tokens - tokens_seen, 0)
-        if isinstance(node, dict):
-            revised_node = {}
+        self,
+        node: Tree | NodeData,
+        tokens_seen: int = 0,
+        budget: int | None = None,
+    ) -> tuple[Tree | NodeData, int]:
+        """
+        Cut `node` down to the tokens left after `tokens_seen`, out of `budget`
+        or this block's max_tokens. Returns the revised node and the number of
+        tokens seen after it.
+        """
+        if budget is None:
+            budget = self.max_tokens
+
+        def truncate_leaf(leaf: NodeData) -> NodeData:
+            nonlocal tokens_seen
+            leaf = self._truncate_leaf(leaf, max(budget - tokens_seen, 0))
+            tokens_seen += len(leaf.tokens)
+            return leaf
+
+        revised_node = fold_tree(node, truncate_leaf, lambda _, leaves: leaves)
+        return revised_node, tokens_seen
+
+    def _truncate_leaf(self, node: NodeData, number_allowed: int) -> NodeData:
+        if len(node.tokens) <= number_allowed:
+            # Leaves that fit in the remaining budget are left untouched
+            return node
+
+        # Nothing can be kept once the budget is spent, so any boundary is as good as another
+        new_boundary_points = None
+        if number_allowed > 0:
             new_boundary_points = find_boundary_points(
-                node["tokens"],
+                node.tokens,
                 tokenizer=self._tokenizer,
                 boundary=self.boundary,
                 truncate=self.truncation_strategy,
-            )
-
-            parent_truncated_tokens = truncate(
-                node["tokens"],
-                tokenizer=self._tokenizer,
                 max_tokens=number_allowed,
-                truncation_strategy=self.truncation_strategy,
-                boundary_points=new_boundary_points,
-                ellipsis=self.ellipsis,
-                boundary_name=self.boundary,
-            )
-            revised_node["remainder_left"] = Encoding.merge(
-                [
-                    node["remainder_left"],
-                    parent_truncated_tokens["remainder_left"],
-                ]
-            )
-            revised_node["remainder_right"] = Encoding.merge(
-                [
-                    parent_truncated_tokens["remainder_right"],
-                    node["remainder_right"],
-                ]
             )
-            revised_node["tokens"] = parent_truncated_tokens["tokens"]
-            revised_node["name"] = node.get("name", "")
-            tokens_seen += len(revised_node["tokens"].ids)
-            return {
-                "revised_node": revised_node,
-                "tokens_seen": tokens_seen,
-            }
-        elif isinstance(node, list):
-            revised_node = []
-            for child_node in node:
-                revised_child_node = self.truncate_node(child_node, tokens_seen)
-                revised_node.append(revised_child_node["revised_node"])
-                tokens_seen = revised_child_node["tokens_seen"]
-            return {
-                "revised_node": revised_node,
-                "tokens_seen": tokens_seen,
-            }
-        else:
-            raise TypeError(f"Unexpected type {type(node)} in tree")
 
-    def truncate(self) -> list[NodeData | list]:
+        parent_truncated_tokens = truncate(
+            node.tokens,
+            tokenizer=self._tokenizer,
+            max_tokens=number_allowed,
+            truncation_strategy=self.truncation_strategy,
+            boundary_points=new_boundary_points,
+            ellipsis=self.ellipsis,
+            boundary_name=self.boundary,
+        )
+        return NodeData(
+            tokens=parent_truncated_tokens.tokens,
+            remainder_left=TokenSpan.merge(
+                [node.remainder_left, parent_truncated_tokens.remainder_left]
+            ),
+            remainder_right=TokenSpan.merge(
+                [parent_truncated_tokens.remainder_right, node.remainder_right]
+            ),
+            name=node.name,
+            cut_from=node,
+            window=parent_truncated_tokens.window,
+        )
+
+    def truncate(self) -> Tree:
         # load tokenizer
         self._ensure_tokenizer_set()
 
-        # TODO: is this necessary?
+        if "truncated" not in self._cache:
+            self._prepare_for_truncation()
+            _truncate_tree(self)
+        return self._cache["truncated"]
+
+    def _prepare_for_truncation(self):
+        """
+        Like `prepare`, but leave the children of lazy blocks to be tokenized by
+        `_truncate` as their budget needs them.
+        """
+        self._ensure_tokenizer_set()
+        if not self._cache.get("prepared"):
+            _prepare_tree([(self, False)], skip_lazy=True)
+
+    def _truncated_size(self) -> int:
+        """Number of tokens kept by `truncate`, without merging the tree."""
+        self.truncate()
+        return self._cache["size"]
+
+    def _truncation_prerequisites(self) -> Iterator[AbstractBlock]:
+        """
+        The children in the order `_truncate` reads their results, so that they
+        can be truncated before it. Raises the errors `_truncate` would raise
+        before reading the rest. Lazy blocks only list their "never" children,
+        they truncate the others themselves as their budget needs them.
+        """
+        never = [
+            child for child in self.children if child.truncation_strategy == "never"
+        ]
+        lazy = self._tokenizes_lazily()
+        if lazy:
+            _prepare_tree([(child, False) for child in never], skip_lazy=True)
+        yield from never
         self._validate_children_max_tokens(
-            max_tokens=self.max_tokens, truncation_strategy=self.truncation_strategy
+            sum(child._truncated_size() for child in never)
         )
+        if lazy:
+            return
+        for idx in self._priority_order():
+            if self.children[idx].truncation_strategy != "never":
+                yield self.children[idx]
 
-        tokens_seen = 0
+    def _priority_order(self) -> list[int]:
+        """
+        Indices of the children in the order they claim tokens: "never" children
+        first, then the rest, each group walked from the end that is kept.
+        """
+        indices = range(len(self.children))
+        if self.truncation_strategy == "left":
+            indices = reversed(indices)
+        never, rest = [], []
+        for idx in indices:
+            if self.children[idx].truncation_strategy == "never":
+                never.append(idx)
+            else:
+                rest.append(idx)
+        return never + rest
 
-        result: list[NodeData | list] = []
-        self.children = self.sort_by_priority(self.children)
+    def _truncate(self) -> tuple[Tree, int]:
+        """
+        Truncate every child exactly once and hand out this block's budget.
+
+        Child trees and sizes come up from the (cached) child truncations, the
+        remaining budget goes down into the children that overflow it. With the
+        default "priority" allocation children claim tokens in priority order,
+        otherwise every child gets the share computed by `_allocate` up front.
+        The result is returned in reading order together with the number of
+        tokens kept.
+
+        Lazy blocks tokenize their children in priority order, a batch at a
+        time, and drop the ones left once the budget is spent without
+        tokenizing them, see `_check_dropped`.
+        """
+        never_tokens_count = sum(
+            child._truncated_size()
+            for child in self.children
+            if child.truncation_strategy == "never"
+        )
+        self._validate_children_max_tokens(never_tokens_count)
 
-        for child in self.children:
-            child_tokens = child.tokens().ids
-            child_result = {
-                "remainder_left": Encoding(),
-                "remainder_right": Encoding(),
-                "name": child.name or self.name,
-            }
-            if (
-                self.max_tokens is None
-                or child.truncation_strategy == "never"
-                or (tokens_seen + len(child_tokens) < self.max_tokens)
-            ):
+        tokens_seen = 0
+        result: list[NodeData | Tree | None] = [None] * len(self.children)
+        order = self._priority_order()
+        budgets = None
+        if self.max_tokens is not None and self.allocation != "priority":
+            budgets = self._allocate(order, self.max_tokens - never_tokens_count)
+
+        lazy = self._tokenizes_lazily()
+        prepared = 0
+        for position, idx in enumerate(order):
+            child = self.children[idx]
+            if lazy and child.truncation_strategy != "never":
+                if tokens_seen >= self.max_tokens:
+                    _check_dropped(child)
+                    result[idx] = NodeData(TokenSpan(), name=child.name or self.name)
+                    continue
+                if position >= prepared:
+                    prepared = position + self._lazy_batch_size(
+                        order[position:], self.max_tokens - tokens_seen
+                    )
+                    _prepare_tree(
+                        [(self.children[i], False) for i in order[position:prepared]],
+                        skip_lazy=True,
+                    )
+            child_size = child._truncated_size()
+            if self.max_tokens is None or child.truncation_strategy == "never":
+                fits = True
+            elif budgets is None:
+                fits = tokens_seen + child_size < self.max_tokens
+            else:
+                fits = child_size <= budgets[idx]
+            if fits:
                 # We can add this child and have tokens left over
-                child_result["tokens"] = child.tokens()
-                tokens_seen += len(child_tokens)
-                result.append(child_result)
+                result[idx] = NodeData(child._span(), name=child.name or self.name)
+                tokens_seen += child_size
+            elif budgets is None and tokens_seen + child_size <= self.max_tokens:
+                # The child fills the budget exactly, so its tree is kept as is
+                result[idx] = child.truncate()
+                tokens_seen += child_size
+            elif budgets is None:
+                result[idx], tokens_seen = self.truncate_node(
+                    child.truncate(), tokens_seen
+                )
             else:
-                child_tree: list[NodeData | list] = child.truncate()
-                revised_node = self.truncate_node(child_tree, tokens_seen)
-                tokens_seen = revised_node["tokens_seen"]
-                result.append(revised_node["revised_node"])
-
-        sorted_result = sorted(
-            zip(self.children, result), key=lambda pair: pair[0].reading_order_idx
-        )
-        self.children = self.sort_by_reading_order(self.children)
+                result[idx], child_tokens = self.truncate_node(
+                    child.truncate(), budget=budgets[idx]
+                )
+                tokens_seen += child_tokens
 
-        return [child_tree for (_, child_tree) in sorted_result]
+        return result, tokens_seen
 
-    def untruncated_tokens(self, tree: list[dict[str, Encoding] | list]) -> Encoding:
-        encodings: list[Encoding] = []
-        for node in tree:
-            if isinstance(node, dict):
-                encodings.append(node["tokens"])
-            elif isinstance(node, list):
-                encodings.append(self.untruncated_tokens(node))
-            else:
-                raise TypeError(f"Unexpected type {type(node)} in tree")
-        return Encoding.merge(encodings)
+    def _lazy_batch_size(self, indices: list[int], budget: int) -> int:
+        """
+        Number of children, from the start of `indices`, to tokenize together:
+        enough to spend `budget` by the lower bounds on their token counts
+        learned from the tokenizer, so that no child past them is needed.
+        """
+        artifacts = tokenizer_artifacts(self._tokenizer)
+        if artifacts.min_token_rate is None:
+            # Nothing is known about the tokenizer until it encodes a first text
+            return 1
+        estimate = 0.0
+        for count, idx in enumerate(indices, 1):
+            child = self.children[idx]
+            child_tokens = artifacts.min_tokens(len(child.full_text()))
+            if child.max_tokens is not None:
+                child_tokens = min(child_tokens, child.max_tokens)
+            estimate += child_tokens
+            if estimate >= budget:
+                return count
+        return len(indices)
+
+    def _allocate(self, order: list[int], budget: int) -> dict[int, int]:
+        """
+        Share `budget` between the children that can be truncated, in one
+        water-filling pass over their sizes: "fair" gives every child the same
+        share, "weighted" gives shares proportional to the children's weights.
+        Whatever a child does not need goes to the others.
+        """
+        indices = [
+            idx for idx in order if self.children[idx].truncation_strategy != "never"
+        ]
+        sizes = [self.children[idx]._truncated_size() for idx in indices]
+        weights = None
+        if self.allocation == "weighted":
+            weights = [self.children[idx].weight for idx in indices]
+        return dict(zip(indices, allocate_budget(sizes, budget, weights)))
+
+    def _merge_tree(self, tree: Tree) -> TokenSpan:
+        return FlatTree.from_tree(tree).span()
+
+    def untruncated_tokens(self, tree: Tree) -> Encoding:
+        return self._merge_tree(tree).to_encoding()
+
+    def _span(self) -> TokenSpan:
+        if "span" not in self._cache:
+            self._cache["span"] = self._merge_tree(self.truncate())
+        return self._cache["span"]
 
     def tokens(self) -> Encoding:
         # load tokenizer
         self._ensure_tokenizer_set()
 
-        # validate children with truncate == "never" max_tokens < self.max_token
-
-        self._validate_children_max_tokens(
-            max_tokens=self.max_tokens, truncation_strategy=self.truncation_strategy
-        )
-        return self.untruncated_tokens(self.truncate())
+        if "tokens" not in self._cache:
+            self._cache["tokens"] = self._span().to_encoding()
+        return self._cache["tokens"]
 
     def format_node(self, node: list | NodeData) -> Panel:
-        # print("Examining node", node[0].keys())
-
-        if isinstance(node, dict):
-            left_text = self._tokenizer.decode(node["remainder_left"].ids)
-            inner_text = self._tokenizer.decode(node["tokens"].ids)
-            right_text = self._tokenizer.decode(node["remainder_right"].ids)
+        from rich.console import Group
+        from rich.panel import Panel
+        from rich.text import Text
+
+        def leaf_panel(leaf: NodeData) -> Panel:
+            left_text = leaf.remainder_left.text(self._tokenizer)
+            inner_text = leaf.tokens.text(self._tokenizer)
+            right_text = leaf.remainder_right.text(self._tokenizer)
             display_text = Text()
             display_text.append(left_text, style="bold magenta")
             display_text.append(inner_text, style="bold blue")
             display_text.append(right_text, style="bold magenta")
             return Panel(
                 display_text,
-                title=node["name"],
+                title=leaf.name,
                 title_align="left",
                 border_style="bold blue",
             )
 
-        if isinstance(node, list):
-
-            titles = self.extract_names_from_list(node)
+        def group_panel(nodes: Tree, panels: list[Panel]) -> Panel:
+            # TODO: need to wire name through properly here, names of nested
+            # children are not titles of this panel
+            title = None
+            if nodes and isinstance(nodes[0], NodeData):
+                title = nodes[0].name
+            return Panel(
+                Group(*panels),
+                title=title,
+                title_align="left",
+                border_style="bold blue",
+            )
 
-            print(f"{titles=}")
-            for title in titles:
-                return Panel(
-                    Group(*[self.format_node(child_node) for child_node in node]),
-                    # TODO: need to wire name through properly here
-                    # title=child.get("name"),
-                    title=title,
-                    title_align="left",
-                    border_style="bold blue",
-                )
-        else:
-            raise TypeError(f"Unexpected type {type(node)} in tree")
+        return fold_tree(node, leaf_panel, group_panel)
 
-    def extract_names_from_list(self, node_list: list) -> str:
+    def extract_names_from_list(self, node_list: list) -> list:
         """Helper function to extract names from a list of nodes."""
-        names = []
-        for node in node_list:
-            if isinstance(node, dict):
-                # if node is a dictionary, extract the name
-                names.append(node.get("name", ""))
-            elif isinstance(node, list):
-                # if node is a list, recursively extract names from the list
-                names.append(self.extract_names_from_list(node))
-        return names
+        return fold_tree(node_list, lambda leaf: leaf.name, lambda _, names: names)
 
     def rich_text(
         self,
@@ -413,10 +1071,13 @@ class Block(AbstractBlock):
     def text(self) -> str:
         self._ensure_tokenizer_set()
 
-        return self._tokenizer.decode(self.tokens().ids)
+        if "text" not in self._cache:
+            self._cache["text"] = self._span().text(self._tokenizer)
+        return self._cache["text"]
 
     def __repr__(self):
-        return f'<Block name="{self.name}" size=[{self.full_size()}/{self.max_tokens or "inf"}] text="{self.text()[:25] + "..."}">'
+        # Shows the start of the full text, which is not truncated nor decoded
+        return f'<Block name="{self.name}" size=[{self.full_size()}/{self.max_tokens or "inf"}] text="{self.full_text()[:25] + "..."}">'
 
     def append(self, other: AbstractBlock | str):
         self.__add__(other)
@@ -458,6 +1119,380 @@ class Block(AbstractBlock):
         pass
 
 
+def _prepare_tree(
+    stack: list[tuple[AbstractBlock, bool]],
+    n_process: int = 1,
+    skip_lazy: bool = False,
+):
+    """
+    Tokenize the leaves below the given (block, in_sentences) roots that have no
+    tokens yet, with one `encode_batch` call per tokenizer, and segment the
+    sentence leaves in one batch. `in_sentences` tells whether an ancestor of the
+    root cuts on "sentence" boundaries. With `skip_lazy`, the children of lazy
+    blocks are left alone, and neither those blocks nor their ancestors are
+    marked prepared.
+    """
+    blocks: list[Block] = []
+    partial: set[int] = set()
+    pending: dict[int, tuple[Callable, list[TextBlock]]] = {}
+    sentence_leaves: list[TextBlock] = []
+    while stack:
+        node, in_sentences = stack.pop()
+        in_sentences = in_sentences or "sentence" in boundary_kinds(node.boundary)
+        if isinstance(node, Block):
+            if node._cache.get("prepared"):
+                continue
+            blocks.append(node)
+            if skip_lazy and node._tokenizes_lazily():
+                ancestors = [node]
+                while ancestors:
+                    ancestor = ancestors.pop()
+                    if id(ancestor) not in partial:
+                        partial.add(id(ancestor))
+                        ancestors.extend(ancestor._parents())
+                continue
+            stack.extend((child, in_sentences) for child in node._subblocks())
+        elif isinstance(node, TextBlock):
+            if node._tokens is None:
+                _, leaves = pending.setdefault(
+                    id(node._tokenizer), (node._tokenizer, [])
+                )
+                leaves.append(node)
+            if in_sentences:
+                sentence_leaves.append(node)
+
+    for tokenizer, leaves in pending.values():
+        spans = encode_texts(tokenizer, [leaf.full_text() for leaf in leaves])
+        for leaf, span in zip(leaves, spans):
+            leaf._tokens = span
+
+    segment_sentences(
+        [
+            buffer
+            for leaf in sentence_leaves
+            for buffer, _, _, _ in leaf._tokens.pieces
+        ],
+        n_process=n_process,
+    )
+
+    for block in blocks:
+        if id(block) not in partial:
+            block._cache["prepared"] = True
+
+
+def _check_dropped(root: AbstractBlock):
+    """
+    Raise the errors that truncating `root` would raise, for a child that a
+    lazy block drops without truncating it. Only the "never" blocks below it
+    are tokenized, to check them against their own and their parent's budget.
+    """
+    checks: list[tuple[Block, list[AbstractBlock]]] = []
+    sized: list[AbstractBlock] = []
+    for block in _descendants(root):
+        if block.truncation_strategy == "never" and block.max_tokens is not None:
+            sized.append(block)
+        if isinstance(block, Block) and block.max_tokens is not None:
+            never = [
+                child
+                for child in block.children
+                if child.truncation_strategy == "never"
+            ]
+            if never:
+                checks.append((block, never))
+                sized.extend(never)
+    if not checks and not sized:
+        return
+    _prepare_tree([(block, False) for block in sized], skip_lazy=True)
+    for block in sized:
+        block._truncated_size()
+    for block, never in checks:
+        block._validate_children_max_tokens(
+            sum(child._truncated_size() for child in never)
+        )
+
+
+class _StreamFrame:
+    """A block whose children are being streamed by `_stream_leaves`."""
+
+    __slots__ = ("block", "in_sentences", "cutting", "tokens_seen")
+
+    def __init__(self, block: Block, in_sentences: bool):
+        self.block = block
+        self.in_sentences = in_sentences
+        self.cutting = False
+        never = [
+            child for child in block.children if child.truncation_strategy == "never"
+        ]
+        _prepare_tree([(child, in_sentences) for child in never])
+        self.tokens_seen = sum(child._truncated_size() for child in never)
+        block._validate_children_max_tokens(self.tokens_seen)
+
+    def cut(self, leaf: NodeData) -> NodeData:
+        """Cut `leaf` down to what is left of the budget, as `truncate_node` does."""
+        if not self.cutting:
+            return leaf
+        leaf = self.block._truncate_leaf(
+            leaf, max(self.block.max_tokens - self.tokens_seen, 0)
+        )
+        self.tokens_seen += len(leaf.tokens)
+        return leaf
+
+
+def _stream_leaves(root: AbstractBlock) -> Iterator[NodeData]:
+    """
+    The tokens kept by `root.truncate()` as leaves in reading order, yielded as
+    soon as their budget is settled. Blocks that hand out tokens in reading
+    order tokenize and truncate each child just before streaming it, and cut
+    its leaves with what is left of their budget. Other blocks are truncated
+    whole first. Leaves are not merged like in `truncate`, so the names of the
+    blocks kept whole are not carried over.
+    """
+    if isinstance(root, Block):
+        root._ensure_tokenizer_set()
+    frames: list[_StreamFrame] = []
+    iterators = [iter([root])]
+    while iterators:
+        for child in iterators[-1]:
+            in_sentences = cutting = False
+            if frames:
+                frame = frames[-1]
+                cutting = frame.cutting = (
+                    frame.block.max_tokens is not None
+                    and child.truncation_strategy != "never"
+                )
+                in_sentences = frame.in_sentences
+                if (
+                    cutting
+                    and frame.block._tokenizes_lazily()
+                    and frame.tokens_seen >= frame.block.max_tokens
+                ):
+                    # Dropped without being tokenized, as `_truncate` does
+                    _check_dropped(child)
+                    continue
+                _prepare_tree([(child, in_sentences)], skip_lazy=True)
+            # A child that is cut is kept whole or cut leaf by leaf depending on its
+            # size, so it must be truncated before any of its leaves is settled
+            if (
+                not cutting
+                and isinstance(child, Block)
+                and "truncated" not in child._cache
+                and child._streams_children()
+            ):
+                in_sentences = in_sentences or "sentence" in boundary_kinds(
+                    child.boundary
+                )
+                frames.append(_StreamFrame(child, in_sentences))
+                iterators.append(iter(child.children))
+                break
+            for leaf in FlatTree.from_tree(child.truncate()).leaves:
+                for frame in reversed(frames):
+                    leaf = frame.cut(leaf)
+                yield leaf
+        else:
+            iterators.pop()
+            if frames and len(frames) == len(iterators):
+                frames.pop()
+
+
+def _descendants(root: AbstractBlock) -> Iterator[AbstractBlock]:
+    """`root` and every block below it, parents first, walked with a stack."""
+    stack = [root]
+    while stack:
+        block = stack.pop()
+        yield block
+        stack.extend(reversed(block._subblocks()))
+
+
+def _truncate_tree(root: Block):
+    """
+    Truncate `root` and the blocks below it that have no cached result, with an
+    explicit stack instead of recursion: the children of every block are
+    truncated first, in the order its `_truncate` reads them.
+    """
+    stack = [(root, root._truncation_prerequisites())]
+    while stack:
+        block, children = stack[-1]
+        for child in children:
+            if not isinstance(child, Block):
+                child.truncate()
+            elif "truncated" not in child._cache:
+                stack.append((child, child._truncation_prerequisites()))
+                break
+        else:
+            stack.pop()
+            block._cache["truncated"], block._cache["size"] = block._truncate()
+
+
+def _leaf_occurrences(root: AbstractBlock) -> Iterator[TextBlock]:
+    """
+    The text blocks below `root` in reading order, once per place they appear,
+    such as the shared separator of a queue.
+    """
+    stack = [root]
+    while stack:
+        block = stack.pop()
+        if isinstance(block, TextBlock):
+            yield block
+        else:
+            stack.extend(reversed(block.children))
+
+
+def _block_digest(root: AbstractBlock, max_tokens: int | None) -> bytes:
+    """
+    Digest of the settings of `root`, with `max_tokens` as its budget, and of
+    the digests of its children, which are cached in the blocks below.
+    """
+    digests: dict[int, bytes] = {}
+    stack = [(root, False)]
+    while stack:
+        block, expanded = stack.pop()
+        if block is not root and "digest" in block._cache:
+            digests[id(block)] = block._cache["digest"]
+            continue
+        children = block.children if isinstance(block, Block) else ()
+        if not expanded:
+            stack.append((block, True))
+            stack.extend((child, False) for child in children)
+            continue
+        budget = max_tokens if block is root else block.max_tokens
+        digest = hashlib.blake2b(
+            repr(block._digest_settings(budget)).encode(), digest_size=16
+        )
+        for child in children:
+            digest.update(digests[id(child)])
+        digests[id(block)] = digest.digest()
+        if budget == block.max_tokens:
+            block._cache["digest"] = digests[id(block)]
+    return digests[id(root)]
+
+
+def _tree_fingerprint(root: AbstractBlock, max_tokens: int | None) -> bytes:
+    """The fingerprint of `root` truncated to `max_tokens`, see `fingerprint`."""
+    digest = hashlib.blake2b(_block_digest(root, max_tokens), digest_size=16)
+    digest.update(tokenizer_artifacts(root._tokenizer).fingerprint)
+    digest.update(type(get_sentence_splitter()).__name__.encode())
+    return digest.digest()
+
+
+def _cut_segments(
+    rows: list[tuple[int, int, int]],
+    window: tuple[int, int, int],
+    ellipsis_size: int,
+) -> list[tuple[int, int, int]]:
+    """
+    The rows holding tokens `start:end` of the tokens of `rows`, with the
+    ellipsis of `window` before or after them.
+    """
+    start, end, side = window
+    cut = []
+    position = 0
+    for leaf, first, last in rows:
+        low = max(start - position, 0)
+        high = min(end - position, last - first)
+        if low < high:
+            cut.append((leaf, first + low, first + high))
+        position += last - first
+    if side < 0:
+        cut.insert(0, (-1, 0, ellipsis_size))
+    elif side > 0:
+        cut.append((-1, 0, ellipsis_size))
+    return cut
+
+
+def _make_plan(root: AbstractBlock) -> TruncationPlan:
+    """
+    The plan of the truncation of `root`, read from its truncation tree: every
+    leaf of the tree is traced back through the leaves it was cut from to the
+    text block it came from, and the windows of those cuts give the tokens
+    kept. Walked with an explicit stack, the subtrees that were cut as a whole
+    collect their rows apart and cut them once all their leaves are read.
+    """
+    tree = root.truncate()
+    ellipsis = tokenizer_artifacts(root._tokenizer).ellipsis
+    ellipsis_size = len(ellipsis)
+    leaves: list[TextBlock] = []
+    rows: list[list[tuple[int, int, int]]] = [[]]
+    # (block, entry) pairs to walk, and (None, windows) once a cut subtree is read
+    stack: list = [(root, tree)]
+    while stack:
+        block, entry = stack.pop()
+        if block is None:
+            cut = rows.pop()
+            for window in reversed(entry):
+                cut = _cut_segments(cut, window, ellipsis_size)
+            rows[-1].extend(cut)
+            continue
+        if isinstance(entry, list):
+            if isinstance(block, TextBlock):
+                entry = entry[0]
+            else:
+                stack.extend(reversed(block._align(entry)))
+                continue
+
+        windows = []
+        node = own = None
+        if entry is not None:
+            node = entry
+            while node.cut_from is not None:
+                windows.append(node.window)
+                node = node.cut_from
+        if isinstance(block, TextBlock):
+            own = block._cache.get("truncated", [None])[0]
+            # Children that fit are taken whole, in a leaf of their own tokens
+            if node is not None and node is not own and len(node.tokens):
+                node = own
+        if node is None or (node is not own and not len(node.tokens)):
+            # Dropped by a parent, without being tokenized if it is lazy
+            leaves.extend(_leaf_occurrences(block))
+        elif isinstance(block, TextBlock):
+            if own.window is not None:
+                windows.append(own.window)
+            leaves.append(block)
+            cut = [(len(leaves) - 1, 0, len(block._tokens))]
+            for window in reversed(windows):
+                cut = _cut_segments(cut, window, ellipsis_size)
+            rows[-1].extend(cut)
+        else:
+            if windows:
+                stack.append((None, windows))
+                rows.append([])
+            stack.append((block, block.truncate()))
+
+    # Every run of tokens keeps the offsets the merges of the tree gave it,
+    # found from the leaves of the tree without merging them
+    nodes = FlatTree.from_tree(tree).leaves
+    added = TokenSpan.merge_shifts([node.tokens for node in nodes])
+    segments: list[tuple[int, int, int, int]] = []
+    position = node_start = idx = 0
+    for leaf, start, end in rows[0]:
+        if start == end:
+            continue
+        while position >= node_start + len(nodes[idx].tokens):
+            node_start += len(nodes[idx].tokens)
+            idx += 1
+        source = ellipsis if leaf < 0 else leaves[leaf]._tokens
+        shift = (
+            nodes[idx].tokens.shift_at(position - node_start)
+            + added[idx]
+            - source.shift_at(start)
+        )
+        position += end - start
+        last = segments[-1] if segments else None
+        if last and last[0] == leaf and last[2] == start and last[3] == shift:
+            segments[-1] = (leaf, last[1], end, shift)
+        else:
+            segments.append((leaf, start, end, shift))
+    return TruncationPlan(
+        segments=np.array(segments, dtype=np.int64).reshape(-1, 4),
+        sizes=np.array(
+            [-1 if leaf._tokens is None else len(leaf._tokens) for leaf in leaves],
+            dtype=np.int64,
+        ),
+        max_tokens=root.max_tokens,
+        fingerprint=_tree_fingerprint(root, root.max_tokens),
+    )
+
+
 # class SectionBlock(Block):
 #     def __init__(
 #         self,
@@ -491,18 +1526,237 @@ class Block(AbstractBlock):
 
 
 class QueueBlock(Block):
-    def __init__(self, queue_size: int = 32, **kwargs):
-        super().__init__(**kwargs)
+    """
+    A history of messages, such as the turns of a conversation, that keeps the
+    newest ones.
+
+    Messages are held in a deque, so dropping the oldest one past `queue_size`
+    is O(1), and separators are shared rather than stored as messages. With
+    `max_tokens` set, the block renders the newest messages that fit: the token
+    count of every message is cached together with a running prefix sum, the
+    first message that fits is found with a binary search, and only the message
+    just before it is truncated, from the side given by `truncate`.
+    """
+
+    __slots__ = ("queue_size", "_messages", "_ends", "_head", "_separator_block")
+
+    def __init__(
+        self, queue_size: int = 32, truncate: TruncationStrategy = "left", **kwargs
+    ):
         self.queue_size = queue_size
-        self.children = self.children[-queue_size:]
+        self._separator_block = None
+        super().__init__(truncate=truncate, **kwargs)
+        if self.separator:
+            self._separator_block = TextBlock(text=self.separator, name="separator")
+            self._separator_block._parent = self
+
+    @property
+    def children(self) -> tuple[AbstractBlock, ...]:
+        """
+        The messages in reading order with separators between them. This is a
+        read-only snapshot, use `add` to change the queue.
+        """
+        if "children" not in self._cache:
+            children = []
+            for message in self._messages:
+                if children and self._separator_block is not None:
+                    children.append(self._separator_block)
+                children.append(message)
+            self._cache["children"] = tuple(children)
+        return self._cache["children"]
+
+    @children.setter
+    def children(self, children: list[AbstractBlock]):
+        self._check_editable()
+        self._messages: deque[AbstractBlock] = deque()
+        # _ends[_head + i] is the number of tokens of all messages before the
+        # i-th queued one, including every message's leading separator. It only
+        # covers the messages whose size is known, the rest are sized on use.
+        self._ends: list[int] = [0]
+        self._head = 0
+        self._mark_dirty()
+        for child in children:
+            self._push(child)
+
+    def _insert_separators(self):
+        # Separators are added when the queue is rendered
+        pass
+
+    def _prepend_text_block(self, text: str | None):
+        if text is not None:
+            self.children = [TextBlock(text=text)] + list(self._messages)
+
+    def _push(self, message: AbstractBlock):
+        if len(self._messages) >= self.queue_size:
+            evicted = self._messages.popleft()
+            if evicted._parent is self:
+                evicted._parent = None
+            if len(self._ends) - self._head > 1:
+                self._head += 1
+            # Compact the prefix sums once most of them belong to evicted messages
+            if self._head > 64 and 2 * self._head > len(self._ends):
+                del self._ends[: self._head]
+                self._head = 0
+        message._add_parent(self)
+        self._messages.append(message)
 
     def add(self, other: AbstractBlock | str):
-        if len(self.children) >= self.queue_size:
-            self.children.pop(0)
-        self.__add__(other)
+        self._check_editable()
+        if isinstance(other, str):
+            other = TextBlock(text=other, ellipsis=self.ellipsis)
+        elif not isinstance(other, (TextBlock, Block)):
+            raise TypeError(f"Cannot add type {type(other)} to Block")
+        if self._cache.get("tokenizer_set"):
+            other.set_tokenizer(self._tokenizer)
+        self._push(other)
+
+        # The other messages are still prepared and their sizes still valid, so
+        # only the results derived from the whole queue are dropped. The new
+        # message is prepared and sized by `_size_messages` on the next render.
+        kept = {
+            key: self._cache[key]
+            for key in ("tokenizer_set", "sized", "prepared")
+            if key in self._cache
+        }
+        self._mark_dirty()
+        self._cache.update(kept)
+
+    def __add__(self, other: AbstractBlock | str):
+        self.add(other)
+        return self
+
+    def _tokenizes_lazily(self) -> bool:
+        # Every message is sized to find the window, see `_size_messages`
+        return False
+
+    def _subblocks(self) -> tuple[AbstractBlock, ...]:
+        if self._separator_block is None:
+            return tuple(self._messages)
+        return (*self._messages, self._separator_block)
+
+    def _truncation_prerequisites(self) -> Iterator[AbstractBlock]:
+        # `_truncate` only reads the messages in the window, and sizing the
+        # messages already truncated the new ones
+        self._size_messages()
+        if self._separator_block is not None:
+            yield self._separator_block
+        start, partial = self._window()
+        for idx in range(start - 1 if partial else start, len(self._messages)):
+            yield self._messages[idx]
+
+    def _size_messages(self, n_process: int = 1):
+        """Extend the prefix sums over the messages whose size is not known yet."""
+        if not self._cache.get("sized"):
+            # Something in the queue changed, so every cached size is suspect
+            self._ends = [0]
+            self._head = 0
+            self._cache["sized"] = True
+
+        sized = len(self._ends) - self._head - 1
+        pending = [self._messages[i] for i in range(sized, len(self._messages))]
+        if self._separator_block is not None:
+            pending.append(self._separator_block)
+        in_sentences = "sentence" in boundary_kinds(self.boundary)
+        _prepare_tree([(block, in_sentences) for block in pending], n_process)
+
+        separator_size = self._separator_size()
+        total = self._ends[-1]
+        for message in pending[: len(self._messages) - sized]:
+            total += separator_size + message._truncated_size()
+            self._ends.append(total)
+
+    def _separator_size(self) -> int:
+        if self._separator_block is None:
+            return 0
+        return self._separator_block._truncated_size()
+
+    async def _atruncate_subtrees(
+        self, executor: Executor | None, max_concurrency: int | None
+    ):
+        # Only the messages in the window are truncated, so only size them here
+        if "truncated" not in self._cache:
+            await _offload(executor, self.prepare)
+
+    def prepare(self, n_process: int = 1) -> "QueueBlock":
+        self._ensure_tokenizer_set()
+        # Only the messages added since the last call are prepared and sized
+        self._size_messages(n_process=n_process)
+        self._cache["prepared"] = True
+        return self
+
+    def _window_start(self) -> int:
+        """Index of the oldest message that is rendered whole."""
+        if self.max_tokens is None:
+            return 0
+        # Messages from k on cost _ends[-1] - _ends[_head + k] tokens, minus the
+        # separator in front of message k which is not rendered
+        target = self._ends[-1] - self._separator_size() - self.max_tokens
+        return (
+            bisect_left(
+                self._ends, target, lo=self._head, hi=self._head + len(self._messages)
+            )
+            - self._head
+        )
+
+    def _window(self) -> tuple[int, bool]:
+        """
+        Index of the oldest message that is rendered whole, and whether the
+        message before it is rendered in part.
+        """
+        start = self._window_start()
+        tokens_seen = self._ends[-1] - self._ends[self._head + start]
+        return start, start > 0 and tokens_seen < self.max_tokens
+
+    def _truncate(self) -> tuple[Tree, int]:
+        """
+        Render the newest messages that fit whole, and whatever part of the
+        message before them fits in the rest of the budget.
+        """
+        # A queue inside another block is prepared with it but not sized yet
+        self._size_messages()
+        start, partial = self._window()
+        tokens_seen = self._ends[-1] - self._ends[self._head + start]
+        result: Tree = []
+
+        if partial:
+            message = self._messages[start - 1]
+            revised_node, tokens_seen = self.truncate_node(
+                message.truncate(), tokens_seen
+            )
+            result.append(revised_node)
+        elif start < len(self._messages):
+            # The first message rendered has no separator in front of it
+            tokens_seen -= self._separator_size()
+
+        for idx in range(start, len(self._messages)):
+            if result and self._separator_block is not None:
+                result.append(self._separator_node())
+            message = self._messages[idx]
+            result.append(NodeData(message._span(), name=message.name or self.name))
+        return result, tokens_seen
+
+    def _align(self, tree: Tree) -> list[tuple[AbstractBlock, Tree | NodeData | None]]:
+        start, partial = self._window()
+        first = start - 1 if partial else start
+        entries = iter(tree)
+        aligned = []
+        for idx, message in enumerate(self._messages):
+            # A separator is rendered in front of every message but the first one
+            if idx and self._separator_block is not None:
+                entry = next(entries) if idx > first else None
+                aligned.append((self._separator_block, entry))
+            aligned.append((message, next(entries) if idx >= first else None))
+        return aligned
+
+    def _separator_node(self) -> NodeData:
+        return NodeData(
+            self._separator_block._span(), name=self._separator_block.name
+        )
 
 
 class TextBlock(AbstractBlock):
+    __slots__ = ("_text", "_tokens", "max_value")
+
     def __init__(
         self,
         text: str,
@@ -512,10 +1766,13 @@ class TextBlock(AbstractBlock):
         truncate: TruncationStrategy = "right",
         ellipsis: bool = False,
         tokenizer: Callable | None = None,
-        boundary: Boundary = "token",
+        boundary: Boundary | tuple[Boundary, ...] = "token",
+        weight: float = 1.0,
         reading_order_idx: int | None = None,
         priority_order_idx: tuple[int, int] | None = None,
     ):
+        self._cache = {}
+        self._parent = None
         self._text = text
         self._tokenizer = tokenizer
         self._tokens = None
@@ -524,25 +1781,68 @@ class TextBlock(AbstractBlock):
         self.truncation_strategy: TruncationStrategy = truncate
         self.max_value = max_value
         self.ellipsis = ellipsis
-        self.boundary: Boundary = boundary
+        self.boundary: Boundary | tuple[Boundary, ...] = boundary
+        self.weight = weight
         self.reading_order_idx = reading_order_idx
         self.priority_order_idx = priority_order_idx
 
-    def boundary_points(self, boundary, truncation_strategy):
+    @classmethod
+    def from_corpus(
+        cls, corpus: Corpus, idx: int, tokenizer=None, **kwargs
+    ) -> "TextBlock":
+        """
+        A block holding document `idx` of `corpus`, whose tokens and boundary
+        points are read from the corpus instead of tokenizing its text.
+
+        The block uses the corpus tokenizer, or `tokenizer` when it has the same
+        fingerprint. It keeps the stored tokens under any parent whose tokenizer
+        has that fingerprint too, and is tokenized again under any other.
+        """
+        if tokenizer is None:
+            tokenizer = corpus.tokenizer
+        elif tokenizer_fingerprint(tokenizer) != tokenizer_fingerprint(
+            corpus.tokenizer
+        ):
+            raise ValueError(
+                "The corpus was tokenized with another tokenizer, use "
+                "corpus.tokenizer or leave tokenizer out"
+            )
+        block = cls(text=corpus.text(idx), tokenizer=tokenizer, **kwargs)
+        block._tokens = corpus.span(idx)
+        return block
+
+    def boundary_points(self, boundary, truncation_strategy, max_tokens=None):
         if boundary is None:
             boundary = self.boundary
         if truncation_strategy is None:
             truncation_strategy = self.truncation_strategy
 
         return find_boundary_points(
-            encoding=self.full_tokens(),
+            encoding=self._full_span(),
             tokenizer=self._tokenizer,
-            boundary=self.boundary,
+            boundary=boundary,
             truncate=truncation_strategy,
+            max_tokens=max_tokens,
         )
 
     def set_tokenizer(self, tokenizer):
-        self._tokenizer = tokenizer
+        if self._replace_tokenizer(tokenizer):
+            self._mark_dirty()
+
+    def _replace_tokenizer(self, tokenizer) -> bool:
+        if tokenizer is self._tokenizer:
+            return False
+        self._check_editable()
+        # Tokens made by an equal tokenizer, e.g. read from a corpus, are kept
+        if not (
+            self._tokens is not None
+            and self._tokenizer is not None
+            and tokenizer is not None
+            and tokenizer_fingerprint(tokenizer)
+            == tokenizer_fingerprint(self._tokenizer)
+        ):
+            self._tokens = None
+        return super()._replace_tokenizer(tokenizer)
 
     def rich_text(
         self,
@@ -551,6 +1851,9 @@ class TextBlock(AbstractBlock):
         boundary: str | None = None,
         boundary_points: list[int] | None = None,
     ) -> Panel:
+        from rich.panel import Panel
+        from rich.text import Text
+
         if max_tokens is None:
             max_tokens = self.max_tokens
         if truncation_strategy is None:
@@ -561,9 +1864,9 @@ class TextBlock(AbstractBlock):
         tree = self.truncate()
         # guaranteed to only have 1 element
         node_data = tree[0]
-        left_text = self._tokenizer.decode(node_data["remainder_left"].ids)
-        inner_text = self._tokenizer.decode(node_data["tokens"].ids)
-        right_text = self._tokenizer.decode(node_data["remainder_right"].ids)
+        left_text = node_data.remainder_left.text(self._tokenizer)
+        inner_text = node_data.tokens.text(self._tokenizer)
+        right_text = node_data.remainder_right.text(self._tokenizer)
         display_text.append(left_text, style="bold magenta")
         display_text.append(inner_text, style="bold blue")
         display_text.append(right_text, style="bold magenta")
@@ -578,21 +1881,56 @@ class TextBlock(AbstractBlock):
     def full_text(self) -> str:
         return self._text
 
-    def full_tokens(self) -> Encoding:
-        if self._tokens == None:
+    def _digest_settings(self, max_tokens: int | None) -> tuple:
+        return (*super()._digest_settings(max_tokens), self._text)
+
+    def prepare(self, n_process: int = 1) -> "TextBlock":
+        self._full_span()
+        if "sentence" in boundary_kinds(self.boundary):
+            segment_sentences(
+                [buffer for buffer, _, _, _ in self._tokens.pieces],
+                n_process=n_process,
+            )
+        return self
+
+    def _full_span(self) -> TokenSpan:
+        if self._tokens is None:
             if self._tokenizer is None:
                 raise ValueError("Tokenizer must be explicitly provided")
-            self._tokens = self._tokenizer.encode(self.full_text())
+            self._tokens = encode_texts(self._tokenizer, [self.full_text()])[0]
         return self._tokens
 
+    def full_tokens(self) -> Encoding:
+        return self._full_span().to_encoding()
+
     def text(self) -> str:
-        return self._tokenizer.decode(self.tokens().ids)
+        if "text" not in self._cache:
+            self._cache["text"] = self._span().text(self._tokenizer)
+        return self._cache["text"]
 
     def truncate(
         self,
         max_tokens: int | None = None,
         truncation_strategy: TruncationStrategy | None = None,
-        boundary: Boundary | None = None,
+        boundary: Boundary | tuple[Boundary, ...] | None = None,
+    ) -> list[NodeData]:
+        # Only the default truncation is cached, overrides are computed on demand
+        if max_tokens is None and truncation_strategy is None and boundary is None:
+            if "truncated" not in self._cache:
+                self._cache["truncated"] = self._truncate()
+                self._cache["size"] = len(self._cache["truncated"][0].tokens)
+            return self._cache["truncated"]
+        return self._truncate(
+            max_tokens=max_tokens,
+            truncation_strategy=truncation_strategy,
+            boundary=boundary,
+        )
+
+    def _truncate(
+        self,
+        max_tokens: int | None = None,
+        truncation_strategy: TruncationStrategy | None = None,
+        boundary: Boundary | tuple[Boundary, ...] | None = None,
     ) -> list[NodeData]:
         if max_tokens is None:
             max_tokens = self.max_tokens
@@ -602,38 +1940,43 @@ class TextBlock(AbstractBlock):
             boundary = self.boundary
 
         if self.truncation_strategy == "never":
-            truncated = {
-                "remainder_left": Encoding(),
-                "remainder_right": Encoding(),
-                "tokens": self.full_tokens(),
-            }
+            truncated = NodeData(self._full_span())
         else:
             truncated = truncate(
-                self.full_tokens(),
+                self._full_span(),
                 max_tokens=max_tokens,
                 truncation_strategy=truncation_strategy,
                 ellipsis=self.ellipsis,
                 tokenizer=self._tokenizer,
                 boundary_name=self.boundary,
                 boundary_points=self.boundary_points(
-                    boundary=boundary, truncation_strategy=truncation_strategy
+                    boundary=boundary,
+                    truncation_strategy=truncation_strategy,
+                    max_tokens=max_tokens,
                 ),
             )
 
-        truncated["name"] = self.name or ""
+        truncated.name = self.name or ""
         return [truncated]
 
+    def _truncated_size(self) -> int:
+        self.truncate()
+        return self._cache["size"]
+
+    def _span(self) -> TokenSpan:
+        return self.truncate()[0].tokens
+
     def tokens(
         self,
         max_tokens: int | None = None,
         truncation_strategy: TruncationStrategy | None = None,
-        boundary: Boundary | None = None,
+        boundary: Boundary | tuple[Boundary, ...] | None = None,
     ) -> Encoding:
         return self.truncate(
             max_tokens=max_tokens,
             truncation_strategy=truncation_strategy,
             boundary=boundary,
-        )[0]["tokens"]
+        )[0].tokens.to_encoding()
 
     def __repr__(self):
-        return f'<Block name="{self.name}" size=[{self.full_size()}/{self.max_tokens or "inf"}] text="{self.text()[:25] + "..."}">'
+        return f'<Block name="{self.name}" size=[{self.full_size()}/{self.max_tokens or "inf"}] text="{self.full_text()[:25] + "..."}">'
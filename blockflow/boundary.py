@@ -1,73 +1,375 @@
+import re
+from typing import Protocol
+
+import numpy as np
+
 from blockflow.dtypes import Boundary, TruncationStrategy
+from blockflow.span import TokenBuffer, TokenSpan
+from blockflow.tokenizer import VocabularyMasks, tokenizer_artifacts
+
+# Sorted token indices where a cut may happen. The "token" boundary allows a cut
+# anywhere, which is represented by a `range` instead of a materialized array.
+BoundaryPoints = np.ndarray | range
+
+
+class SentenceSplitter(Protocol):
+    def sentence_spans(
+        self, texts: list[str], n_process: int = 1
+    ) -> list[list[tuple[int, int]]]:
+        """Return the (start_char, end_char) span of every sentence of each text."""
+        ...
+
+
+class RegexSentenceSplitter:
+    """
+    Rule based sentence splitter that works on the raw text with one compiled
+    regular expression, so it needs no model and no third party import.
+
+    A sentence ends at a run of ".", "!" or "?", plus any closing quotes or
+    brackets, that is followed by whitespace. The split is skipped when the next
+    sentence would start with a lower case letter, or when a single full stop
+    follows a known abbreviation, a single letter initial or a dotted word such
+    as "e.g." or "U.S.".
+    """
+
+    abbreviations = frozenset(
+        {
+            "al",
+            "approx",
+            "ca",
+            "cf",
+            "dr",
+            "fig",
+            "jr",
+            "mr",
+            "mrs",
+            "ms",
+            "mt",
+            "prof",
+            "sr",
+            "st",
+            "vs",
+        }
+    )
+    _sentence_end = re.compile(r"(?<!\S)(\S*?)([.!?]+[\"'”’»)\]]*)(?=\s|\Z)")
+    _whitespace = re.compile(r"\s*")
+
+    def _is_abbreviation(self, word: str, punctuation: str) -> bool:
+        if punctuation.rstrip("\"'”’»)]") != ".":
+            return False
+        word = word.lstrip("\"'“‘«([")
+        return (
+            (len(word) == 1 and word.isalpha())
+            or "." in word
+            or word.lower() in self.abbreviations
+        )
+
+    def split(self, text: str) -> list[tuple[int, int]]:
+        spans = []
+        start = self._whitespace.match(text).end()
+        for match in self._sentence_end.finditer(text):
+            end = match.end()
+            following = self._whitespace.match(text, end).end()
+            if following < len(text) and text[following].islower():
+                continue
+            if self._is_abbreviation(match.group(1), match.group(2)):
+                continue
+            if end > start:
+                spans.append((start, end))
+            start = following
+        end = len(text.rstrip())
+        if end > start:
+            spans.append((start, end))
+        return spans
+
+    def sentence_spans(
+        self, texts: list[str], n_process: int = 1
+    ) -> list[list[tuple[int, int]]]:
+        return [self.split(text) for text in texts]
 
 
 class SpacyPlugin:
-    def __init__(self):
+    def __init__(self, batch_size: int = 64):
         self.nlp = None
+        self.batch_size = batch_size
 
     @property
     def sentence_splitter(self):
         if self.nlp is None:
-            import spacy
+            try:
+                import spacy
+            except ImportError as e:
+                raise ImportError(
+                    "SpacyPlugin needs spaCy, install it with `pip install blockflow[spacy]`"
+                ) from e
 
             self.nlp = spacy.blank("en")
             self.nlp.add_pipe("sentencizer")
         return self.nlp
 
+    def _chunks(self, text: str) -> list[tuple[int, str]]:
+        """Split `text` into (start, chunk) pieces that fit in spaCy's max_length."""
+        max_length = self.sentence_splitter.max_length
+        chunks = []
+        start = 0
+        while len(text) - start > max_length:
+            # Prefer to split on a line break, then after a full stop, then on a
+            # space, and only cut through a word as a last resort
+            end = start + max_length
+            for separator in ("\n", ". ", " "):
+                split = text.rfind(separator, start + 1, end - len(separator) + 1)
+                if split != -1:
+                    end = split + len(separator)
+                    break
+            chunks.append((start, text[start:end]))
+            start = end
+        chunks.append((start, text[start:]))
+        return chunks
+
+    def sentence_spans(
+        self, texts: list[str], n_process: int = 1
+    ) -> list[list[tuple[int, int]]]:
+        """
+        Return the (start_char, end_char) span of every sentence of each text,
+        segmenting all texts in a single `nlp.pipe` batch.
+        """
+        owners, starts, chunks = [], [], []
+        for idx, text in enumerate(texts):
+            for start, chunk in self._chunks(text):
+                owners.append(idx)
+                starts.append(start)
+                chunks.append(chunk)
+
+        spans: list[list[tuple[int, int]]] = [[] for _ in texts]
+        docs = self.sentence_splitter.pipe(
+            chunks, batch_size=self.batch_size, n_process=n_process
+        )
+        for idx, start, doc in zip(owners, starts, docs):
+            spans[idx].extend(
+                (start + sent.start_char, start + sent.end_char) for sent in doc.sents
+            )
+        return spans
+
 
 SPACY_MODEL = SpacyPlugin()
+REGEX_SPLITTER = RegexSentenceSplitter()
 
+# Backend used for "sentence" boundaries when none is passed explicitly
+_SENTENCE_SPLITTER: SentenceSplitter = REGEX_SPLITTER
 
 
-def find_boundary_points(
-    encoding, tokenizer, boundary: Boundary, truncate: TruncationStrategy
-) -> list[int]:
+def get_sentence_splitter() -> SentenceSplitter:
+    return _SENTENCE_SPLITTER
+
+
+def set_sentence_splitter(splitter: SentenceSplitter):
     """
-    Return token indices that correspond to valid boundary points
+    Change the default sentence splitter, e.g. `set_sentence_splitter(SPACY_MODEL)`
+    to use spaCy. Blocks that were already truncated keep their cached results.
     """
-    boundary_points: list[int] = []
-    if boundary == "token":
-        return list(range(len(encoding.ids)))
-    elif boundary == "line":
-        boundary_token = tokenizer.encode("\n").ids[0]
-        boundary_points.extend(
-            [i for i, token in enumerate(encoding.ids) if token == boundary_token]
-        )
-    elif boundary == "whitespace":
-        whitespace_token = "Ġ"
-        boundary_points.extend(
-            [
-                i
-                for i, token in enumerate(encoding.tokens)
-                if token.startswith(whitespace_token)
-            ]
-        )
+    global _SENTENCE_SPLITTER
+    _SENTENCE_SPLITTER = splitter
+
+
+def vocabulary_masks(tokenizer) -> VocabularyMasks:
+    """Return the vocabulary masks of `tokenizer`, computing them on first use."""
+    return tokenizer_artifacts(tokenizer).vocabulary_masks
+
+
+def segment_sentences(
+    buffers: list[TokenBuffer],
+    n_process: int = 1,
+    sentence_splitter: SentenceSplitter | None = None,
+):
+    """Fill in the sentence spans of every buffer that does not have them yet."""
+    if sentence_splitter is None:
+        sentence_splitter = get_sentence_splitter()
+    pending = [buffer for buffer in buffers if sentence_splitter not in buffer.sentences]
+    if not pending:
+        return
+    spans = sentence_splitter.sentence_spans(
+        [buffer.text for buffer in pending], n_process=n_process
+    )
+    for buffer, sentences in zip(pending, spans):
+        buffer.sentences[sentence_splitter] = sentences
+
+
+# Boundaries ordered from coarsest to finest, see `fallback_chain`
+FALLBACK_ORDER: tuple[Boundary, ...] = (
+    "paragraph",
+    "sentence",
+    "line",
+    "whitespace",
+    "token",
+)
 
-    
-    elif boundary == "sentence":
-        decoded_text = tokenizer.decode(encoding.ids)
-        doc = SPACY_MODEL.sentence_splitter(decoded_text)
+_BLANK_LINE = re.compile(r"\n[^\S\n]*\n")
 
-        # preprocess the sentence
-        sentence_boundaries = [(sent.start_char, sent.end_char) for sent in doc.sents]
 
-        start_idx = 0
-        # loop through offsets once to avoid creating a new list on each iteration
-        for offset_idx, (token_start, token_end) in enumerate(encoding.offsets):
-            # exit early if all sentences have been processed
-            if start_idx >= len(sentence_boundaries):
-                break  # already processed
+def fallback_chain(boundary: Boundary) -> tuple[Boundary, ...]:
+    """
+    `boundary` followed by every finer boundary, e.g. "sentence" gives
+    ("sentence", "line", "whitespace", "token"). Used as a block's boundary, the
+    text is cut at the coarsest of them that keeps any tokens.
+    """
+    return FALLBACK_ORDER[FALLBACK_ORDER.index(boundary) :]
+
+
+def boundary_kinds(boundary: Boundary | tuple[Boundary, ...]) -> tuple[Boundary, ...]:
+    return (boundary,) if isinstance(boundary, str) else tuple(boundary)
+
+
+def _covering_tokens(offsets: np.ndarray, chars: np.ndarray) -> np.ndarray:
+    """
+    Sorted indices of the first token ending at or after each character offset,
+    for the offsets that such a token also starts at or before.
+    """
+    idx = np.searchsorted(offsets[:, 1], chars, side="left")
+    found = idx < len(offsets)
+    idx, chars = idx[found], chars[found]
+    return np.unique(idx[offsets[idx, 0] <= chars])
+
+
+def _buffer_text(buffer: TokenBuffer, tokenizer) -> str:
+    if buffer.text is None:
+        # Without the source text, fall back to the decoded tokens
+        buffer.text = tokenizer.decode(buffer.ids)
+    return buffer.text
+
+
+def index_buffer(buffer: TokenBuffer, tokenizer):
+    """
+    Find the whitespace, line and paragraph boundaries of `buffer` in one pass
+    over its token ids and text, and store them in `buffer.boundary_points`.
+
+    Whitespace and line points are the tokens starting with whitespace and the
+    tokens holding a line break. Paragraph points are the tokens holding the line
+    break that closes a blank line, which makes them a subset of the line points.
+    """
+    if "paragraph" in buffer.boundary_points:
+        return
+    masks = vocabulary_masks(tokenizer)
+    ids = buffer.id_array
+    buffer.boundary_points["whitespace"] = np.flatnonzero(masks.whitespace[ids])
+    buffer.boundary_points["line"] = np.flatnonzero(masks.newline[ids])
 
-            char_start, char_end = sentence_boundaries[start_idx]
+    text = _buffer_text(buffer, tokenizer)
+    offsets = np.asarray(buffer.offsets, dtype=np.int64).reshape(-1, 2)
+    chars = np.fromiter(
+        (match.end() for match in _BLANK_LINE.finditer(text)), dtype=np.int64
+    )
+    buffer.boundary_points["paragraph"] = _covering_tokens(offsets, chars)
 
-            if truncate == "right" and token_start <= char_start <= token_end:
-                boundary_points.append(offset_idx)
-                start_idx += 1
 
-            if truncate == "left" and token_start <= char_end <= token_end:
-                boundary_points.append(offset_idx)
-                start_idx += 1
+def _buffer_sentence_points(
+    buffer: TokenBuffer,
+    tokenizer,
+    truncate: TruncationStrategy,
+    sentence_splitter: SentenceSplitter,
+) -> np.ndarray:
+    """
+    Token indices of `buffer` where a sentence starts (right truncation) or
+    ends (left truncation), mapped through the token offsets of the source text.
+    """
+    key = ("sentence", truncate, sentence_splitter)
+    if key not in buffer.boundary_points:
+        _buffer_text(buffer, tokenizer)
+        segment_sentences([buffer], sentence_splitter=sentence_splitter)
+
+        offsets = np.asarray(buffer.offsets, dtype=np.int64).reshape(-1, 2)
+        sentences = np.asarray(
+            buffer.sentences[sentence_splitter], dtype=np.int64
+        ).reshape(-1, 2)
+        chars = sentences[:, 0] if truncate == "right" else sentences[:, 1]
+        buffer.boundary_points[key] = _covering_tokens(offsets, chars)
+    return buffer.boundary_points[key]
+
 
+def buffer_boundary_points(
+    buffer: TokenBuffer,
+    tokenizer,
+    boundary: Boundary,
+    truncate: TruncationStrategy,
+    sentence_splitter: SentenceSplitter | None = None,
+) -> np.ndarray:
+    """The boundary points of a whole buffer, computed once and cached on it."""
+    if boundary == "sentence":
+        if sentence_splitter is None:
+            sentence_splitter = get_sentence_splitter()
+        return _buffer_sentence_points(buffer, tokenizer, truncate, sentence_splitter)
+    elif boundary in ("whitespace", "line", "paragraph"):
+        index_buffer(buffer, tokenizer)
+        return buffer.boundary_points[boundary]
     else:
         raise NotImplementedError(f"Boundary {boundary} not implemented")
-    return boundary_points
+
+
+def span_boundary_points(
+    span: TokenSpan,
+    tokenizer,
+    boundary: Boundary,
+    truncate: TruncationStrategy,
+    sentence_splitter: SentenceSplitter | None = None,
+) -> np.ndarray:
+    """Map the cached boundary points of each buffer of `span` into its positions."""
+    points = []
+    position = 0
+    for buffer, start, end, _ in span.pieces:
+        buffer_points = buffer_boundary_points(
+            buffer, tokenizer, boundary, truncate, sentence_splitter
+        )
+        lo, hi = np.searchsorted(buffer_points, [start, end])
+        points.append(buffer_points[lo:hi] - start + position)
+        position += end - start
+    if not points:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(points)
+
+
+def _keeps_tokens(
+    boundary_points: BoundaryPoints,
+    max_tokens: int,
+    token_size: int,
+    truncate: TruncationStrategy,
+) -> bool:
+    """Whether cutting down to `max_tokens` on these points keeps any token."""
+    if truncate == "left":
+        # see `truncation.process_boundary_points`
+        lo = np.searchsorted(boundary_points, token_size - max_tokens - 1)
+        return lo < len(boundary_points) and boundary_points[lo] < token_size - 1
+    lo = np.searchsorted(boundary_points, 1)
+    return lo < len(boundary_points) and boundary_points[lo] <= max_tokens
+
+
+def find_boundary_points(
+    encoding,
+    tokenizer,
+    boundary: Boundary | tuple[Boundary, ...],
+    truncate: TruncationStrategy,
+    sentence_splitter: SentenceSplitter | None = None,
+    max_tokens: int | None = None,
+) -> BoundaryPoints:
+    """
+    Return the sorted token indices that correspond to valid boundary points.
+    "sentence" boundaries use `sentence_splitter`, or the default splitter when
+    it is None.
+
+    `boundary` may also be a chain of boundaries, see `fallback_chain`, in which
+    case the points of the first one that keeps any of the `max_tokens` are
+    returned, or those of the last one if none does.
+    """
+    if not isinstance(encoding, TokenSpan):
+        encoding = TokenSpan.from_encoding(encoding)
+    kinds = boundary_kinds(boundary)
+    for kind in kinds:
+        if kind == "token":
+            points = range(len(encoding))
+        else:
+            points = span_boundary_points(
+                encoding, tokenizer, kind, truncate, sentence_splitter
+            )
+        if max_tokens is None or len(kinds) == 1 or max_tokens >= len(encoding):
+            return points
+        if _keeps_tokens(points, max_tokens, len(encoding), truncate):
+            return points
+    return points
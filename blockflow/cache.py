@@ -0,0 +1,437 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from blockflow.span import ArrayBuffer, TokenSpan
+from blockflow.tokenizer import tokenizer_artifacts, tokenizer_fingerprint
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# SQLite caps the number of parameters of a statement
+_MAX_PARAMETERS = 500
+
+# Files written with another layout are emptied when they are opened
+_SCHEMA_VERSION = 2
+
+# One statement each, so that they run inside a transaction
+_SCHEMA = (
+    "DROP TABLE IF EXISTS tokens",
+    "DROP TABLE IF EXISTS usage",
+    """
+    CREATE TABLE tokens (
+        key BLOB PRIMARY KEY,
+        ids BLOB NOT NULL,
+        offsets BLOB NOT NULL,
+        fields BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        used REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX tokens_used ON tokens (used)",
+    """
+    CREATE TABLE usage (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        bytes INTEGER NOT NULL
+    )
+    """,
+    "INSERT INTO usage VALUES (0, 0)",
+    """
+    CREATE TRIGGER tokens_insert AFTER INSERT ON tokens
+    BEGIN
+        UPDATE usage SET bytes = bytes + NEW.size;
+    END
+    """,
+    """
+    CREATE TRIGGER tokens_delete AFTER DELETE ON tokens
+    BEGIN
+        UPDATE usage SET bytes = bytes - OLD.size;
+    END
+    """,
+    f"PRAGMA user_version = {_SCHEMA_VERSION}",
+)
+
+# The token level fields stored besides the ids and offsets, in the order they
+# are packed into the fields blob, with the dtype of each. Word ids of None
+# are stored as -1, and type ids and masks are small enough for a byte.
+_FIELDS = (
+    ("word_ids", np.int32),
+    ("type_ids", np.uint8),
+    ("special_tokens_mask", np.uint8),
+    ("attention_mask", np.uint8),
+)
+
+
+def _pack_fields(span: TokenSpan) -> bytes:
+    parts = []
+    for name, dtype in _FIELDS:
+        values = getattr(span, name)
+        if name == "word_ids":
+            values = [-1 if word is None else word for word in values]
+        parts.append(np.asarray(values, dtype=dtype).tobytes())
+    return b"".join(parts)
+
+
+def _unpack_fields(fields: bytes, length: int) -> dict[str, np.ndarray]:
+    arrays = {}
+    start = 0
+    for name, dtype in _FIELDS:
+        arrays[name] = np.frombuffer(fields, dtype=dtype, count=length, offset=start)
+        start += length * np.dtype(dtype).itemsize
+    return arrays
+
+
+@contextmanager
+def _transaction(connection: sqlite3.Connection):
+    # Take the write lock up front, so that two processes never evict the same
+    # entries or wait on each other to upgrade a read lock
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+@dataclass
+class CacheStats:
+    """Lookups made by this process, and the time spent reading and writing."""
+
+    hits: int = 0
+    misses: int = 0
+    lookup_seconds: float = 0.0
+    store_seconds: float = 0.0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class TokenCache:
+    """
+    Token ids, offsets and other token level fields of encoded texts, so that
+    a hit matches a fresh encode, kept in an SQLite file at `path`
+    that any number of processes can share. Entries are keyed by a fingerprint
+    of the tokenizer and a hash of the text, and once they take more than
+    `max_bytes` the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int | None = None
+        with self._lock:
+            self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not be used by a forked child, so every process
+        # opens its own
+        if self._pid != os.getpid():
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with _transaction(connection):
+                # Checked under the write lock, so that a process does not empty
+                # a file another one has just set up and started to fill
+                (version,) = connection.execute("PRAGMA user_version").fetchone()
+                if version != _SCHEMA_VERSION:
+                    for statement in _SCHEMA:
+                        connection.execute(statement)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    @staticmethod
+    def key(tokenizer, text: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(tokenizer_fingerprint(tokenizer))
+        digest.update(text.encode())
+        return digest.digest()
+
+    def get_many(self, tokenizer, texts: list[str]) -> list[TokenSpan | None]:
+        """The cached tokens of each text, or None for the texts not cached."""
+        start = time.perf_counter()
+        keys = [self.key(tokenizer, text) for text in texts]
+        rows = {}
+        with self._lock:
+            connection = self._connect()
+            unique = list(dict.fromkeys(keys))
+            for lo in range(0, len(unique), _MAX_PARAMETERS):
+                chunk = unique[lo : lo + _MAX_PARAMETERS]
+                query = (
+                    "SELECT key, ids, offsets, fields FROM tokens WHERE key IN ({})"
+                ).format(",".join("?" * len(chunk)))
+                rows.update(
+                    (key, (ids, offsets, fields))
+                    for key, ids, offsets, fields in connection.execute(query, chunk)
+                )
+            if rows:
+                now = time.time()
+                with _transaction(connection):
+                    connection.executemany(
+                        "UPDATE tokens SET used = ? WHERE key = ?",
+                        [(now, key) for key in rows],
+                    )
+
+        spans = []
+        for key, text in zip(keys, texts):
+            if key in rows:
+                ids, offsets, fields = rows[key]
+                ids = np.frombuffer(ids, dtype=np.uint32)
+                buffer = ArrayBuffer(
+                    ids,
+                    np.frombuffer(offsets, dtype=np.uint32),
+                    text=text,
+                    tokenizer=tokenizer,
+                    field_arrays=_unpack_fields(fields, len(ids)),
+                )
+                spans.append(TokenSpan([(buffer, 0, len(buffer), 0)]))
+            else:
+                spans.append(None)
+        self.stats.hits += len(texts) - spans.count(None)
+        self.stats.misses += spans.count(None)
+        self.stats.lookup_seconds += time.perf_counter() - start
+        return spans
+
+    def put_many(self, tokenizer, texts: list[str], spans: list[TokenSpan]):
+        """Store the tokens of `texts`, then evict entries if over `max_bytes`."""
+        start = time.perf_counter()
+        rows = []
+        now = time.time()
+        for text, span in zip(texts, spans):
+            ids = np.asarray(span.ids, dtype=np.uint32).tobytes()
+            offsets = np.asarray(span.offsets, dtype=np.uint32).tobytes()
+            fields = _pack_fields(span)
+            key = self.key(tokenizer, text)
+            size = len(key) + len(ids) + len(offsets) + len(fields)
+            rows.append((key, ids, offsets, fields, size, now))
+
+        with self._lock:
+            connection = self._connect()
+            with _transaction(connection):
+                connection.executemany(
+                    "INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+                self._evict(connection)
+        self.stats.store_seconds += time.perf_counter() - start
+
+    def _evict(self, connection: sqlite3.Connection):
+        (used_bytes,) = connection.execute("SELECT bytes FROM usage").fetchone()
+        if used_bytes <= self.max_bytes:
+            return
+        # Free a little more than needed so that the next puts do not evict again
+        to_free = used_bytes - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in connection.execute(
+            "SELECT key, size FROM tokens ORDER BY used"
+        ):
+            keys.append((key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+        connection.executemany("DELETE FROM tokens WHERE key = ?", keys)
+        self.stats.evictions += len(keys)
+
+    def encode(self, tokenizer, texts: list[str]) -> list[TokenSpan]:
+        """
+        The tokens of `texts`, from the cache where possible. The other texts
+        are encoded with one `encode_batch` call and added to the cache.
+        """
+        spans = self.get_many(tokenizer, texts)
+        missing = [idx for idx, span in enumerate(spans) if span is None]
+        if missing:
+            encoded = _encode_batch(tokenizer, [texts[idx] for idx in missing])
+            for idx, span in zip(missing, encoded):
+                spans[idx] = span
+            self.put_many(tokenizer, [texts[idx] for idx in missing], encoded)
+        return spans
+
+    def size(self) -> tuple[int, int]:
+        """Number of entries and bytes they take, for every process."""
+        with self._lock:
+            connection = self._connect()
+            (entries,) = connection.execute("SELECT COUNT(*) FROM tokens").fetchone()
+            (used_bytes,) = connection.execute("SELECT bytes FROM usage").fetchone()
+        return entries, used_bytes
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM tokens")
+
+
+class EncodingCache:
+    """
+    The tokens of recently encoded texts, by tokenizer fingerprint and text,
+    holding about `max_bytes` at most and evicting the least recently used.
+    Blocks with the same text share one immutable `TokenSpan`, along with the
+    boundary points and sentences cached on its buffer.
+
+    Entries are sized by what their buffers hold, see `TokenBuffer.nbytes`.
+    Blocks fill in more of a buffer as they render it, so the entries handed
+    out or stored by one call are measured again at the next. `max_bytes` is
+    an approximate cap, which the last entries used may overrun until then.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self.bytes = 0
+        self._entries: OrderedDict[tuple[bytes, str], tuple[TokenSpan, int]] = (
+            OrderedDict()
+        )
+        # Keys of the entries handed out or stored since they were last measured
+        self._unmeasured: set[tuple[bytes, str]] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _size(text: str, span: TokenSpan) -> int:
+        buffers = {id(buffer): buffer for buffer, _, _, _ in span.pieces}
+        return sys.getsizeof(text) + sum(
+            buffer.nbytes() for buffer in buffers.values()
+        )
+
+    def _measure(self):
+        for key in self._unmeasured:
+            entry = self._entries.get(key)
+            if entry is not None:
+                span, size = entry
+                new_size = self._size(key[1], span)
+                self._entries[key] = (span, new_size)
+                self.bytes += new_size - size
+        self._unmeasured.clear()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.stats.evictions += 1
+
+    def get_many(self, tokenizer, texts: list[str]) -> list[TokenSpan | None]:
+        """The cached tokens of each text, or None for the texts not cached."""
+        start = time.perf_counter()
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        spans = []
+        with self._lock:
+            self._measure()
+            for text in texts:
+                entry = self._entries.get((fingerprint, text))
+                if entry is None:
+                    spans.append(None)
+                    self.stats.misses += 1
+                else:
+                    self._entries.move_to_end((fingerprint, text))
+                    self._unmeasured.add((fingerprint, text))
+                    spans.append(entry[0])
+                    self.stats.hits += 1
+            self._evict()
+        self.stats.lookup_seconds += time.perf_counter() - start
+        return spans
+
+    def put_many(self, tokenizer, texts: list[str], spans: list[TokenSpan]):
+        """Keep the tokens of `texts`, evicting entries when over `max_bytes`."""
+        start = time.perf_counter()
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        with self._lock:
+            self._measure()
+            for text, span in zip(texts, spans):
+                key = (fingerprint, text)
+                size = self._size(text, span)
+                if key in self._entries or size > self.max_bytes:
+                    continue
+                self._entries[key] = (span, size)
+                self._unmeasured.add(key)
+                self.bytes += size
+            self._evict()
+        self.stats.store_seconds += time.perf_counter() - start
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unmeasured.clear()
+            self.bytes = 0
+
+
+# Caches consulted by every block before encoding, None to skip them
+_ENCODING_CACHE: EncodingCache | None = EncodingCache()
+_TOKEN_CACHE: TokenCache | None = None
+
+
+def get_encoding_cache() -> EncodingCache | None:
+    return _ENCODING_CACHE
+
+
+def set_encoding_cache(cache: EncodingCache | None):
+    """
+    Replace the process-wide encoding cache, e.g. with one of another size, or
+    turn it off with None.
+    """
+    global _ENCODING_CACHE
+    _ENCODING_CACHE = cache
+
+
+def get_token_cache() -> TokenCache | None:
+    return _TOKEN_CACHE
+
+
+def set_token_cache(cache: TokenCache | None):
+    """
+    Make blocks look up their tokens in `cache` before encoding them, e.g.
+    `set_token_cache(TokenCache("tokens.sqlite"))`, or stop with None.
+    """
+    global _TOKEN_CACHE
+    _TOKEN_CACHE = cache
+
+
+def _encode_batch(tokenizer, texts: list[str]) -> list[TokenSpan]:
+    return [
+        TokenSpan.from_encoding(encoding, text=text)
+        for text, encoding in zip(texts, tokenizer.encode_batch(texts))
+    ]
+
+
+def encode_texts(tokenizer, texts: list[str]) -> list[TokenSpan]:
+    """
+    The tokens of `texts`. Each distinct text is looked up in the encoding
+    cache, then in the token cache when one is set, and the rest are encoded
+    with one `encode_batch` call. Equal texts get the same `TokenSpan`.
+    """
+    unique = list(dict.fromkeys(texts))
+    if _ENCODING_CACHE is None:
+        spans = dict.fromkeys(unique)
+    else:
+        spans = dict(zip(unique, _ENCODING_CACHE.get_many(tokenizer, unique)))
+
+    missing = [text for text, span in spans.items() if span is None]
+    if missing:
+        if _TOKEN_CACHE is None:
+            encoded = _encode_batch(tokenizer, missing)
+        else:
+            encoded = _TOKEN_CACHE.encode(tokenizer, missing)
+        spans.update(zip(missing, encoded))
+        tokenizer_artifacts(tokenizer).observe(missing, encoded)
+        if _ENCODING_CACHE is not None:
+            _ENCODING_CACHE.put_many(tokenizer, missing, encoded)
+    return [spans[text] for text in texts]
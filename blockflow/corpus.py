@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import json
+from itertools import islice
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from blockflow.boundary import (
+    REGEX_SPLITTER,
+    SPACY_MODEL,
+    SentenceSplitter,
+    buffer_boundary_points,
+    get_sentence_splitter,
+    segment_sentences,
+)
+from blockflow.span import ArrayBuffer, TokenBuffer, TokenSpan
+from blockflow.tokenizer import create_tokenizer
+
+# Sentence splitters whose sentences can be stored, by the name saved with them
+SENTENCE_SPLITTERS: dict[str, SentenceSplitter] = {
+    "regex": REGEX_SPLITTER,
+    "spacy": SPACY_MODEL,
+}
+
+# One file per column holding the rows of every document back to back, with
+# the dtype and number of values per row. Boundary points are token indices
+# within their document.
+COLUMNS: dict[str, tuple[type, int]] = {
+    "ids": (np.uint32, 1),
+    "offsets": (np.uint32, 2),
+    "text": (np.uint8, 1),
+    "sentences": (np.uint32, 2),
+    "whitespace": (np.uint32, 1),
+    "line": (np.uint32, 1),
+    "paragraph": (np.uint32, 1),
+    "sentence_right": (np.uint32, 1),
+    "sentence_left": (np.uint32, 1),
+}
+
+
+def _document_columns(
+    buffer: TokenBuffer, tokenizer, sentence_splitter: SentenceSplitter
+) -> dict[str, np.ndarray]:
+    columns = {
+        "ids": buffer.id_array,
+        "offsets": np.asarray(buffer.offsets).reshape(-1, 2),
+        "text": np.frombuffer(buffer.text.encode(), dtype=np.uint8),
+        "sentences": np.asarray(buffer.sentences[sentence_splitter]).reshape(-1, 2),
+    }
+    for boundary in ("whitespace", "line", "paragraph"):
+        columns[boundary] = buffer_boundary_points(
+            buffer, tokenizer, boundary, "right"
+        )
+    for truncate in ("right", "left"):
+        columns[f"sentence_{truncate}"] = buffer_boundary_points(
+            buffer, tokenizer, "sentence", truncate, sentence_splitter
+        )
+    return columns
+
+
+def write_corpus(
+    path: str | Path,
+    texts: Iterable[str],
+    tokenizer_name: str | None = None,
+    sentence_splitter: SentenceSplitter | None = None,
+    batch_size: int = 256,
+):
+    """
+    Tokenize `texts` once with the tokenizer called `tokenizer_name` and write
+    their tokens, offsets, sentences and boundary points to the directory
+    `path`, to be read back with `Corpus`. `texts` is read `batch_size` at a
+    time, so it can be larger than memory.
+    """
+    if sentence_splitter is None:
+        sentence_splitter = get_sentence_splitter()
+    names = {id(splitter): name for name, splitter in SENTENCE_SPLITTERS.items()}
+    if id(sentence_splitter) not in names:
+        raise ValueError(
+            f"Only the sentences of {list(SENTENCE_SPLITTERS)} can be stored"
+        )
+    tokenizer = create_tokenizer(tokenizer_name)
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    # Start of every document in every column, in rows
+    index = [np.zeros(len(COLUMNS), dtype=np.int64)]
+    files = {column: open(path / f"{column}.bin", "wb") for column in COLUMNS}
+    try:
+        texts = iter(texts)
+        while batch := list(islice(texts, batch_size)):
+            buffers = [
+                TokenBuffer(encoding, text=text)
+                for text, encoding in zip(batch, tokenizer.encode_batch(batch))
+            ]
+            segment_sentences(buffers, sentence_splitter=sentence_splitter)
+            for buffer in buffers:
+                columns = _document_columns(buffer, tokenizer, sentence_splitter)
+                for column, (dtype, _) in COLUMNS.items():
+                    files[column].write(columns[column].astype(dtype).tobytes())
+                sizes = [len(columns[column]) for column in COLUMNS]
+                index.append(index[-1] + sizes)
+    finally:
+        for file in files.values():
+            file.close()
+
+    np.save(path / "index.npy", np.stack(index))
+    (path / "meta.json").write_text(
+        json.dumps(
+            {
+                "tokenizer_name": tokenizer_name,
+                "sentence_splitter": names[id(sentence_splitter)],
+                "columns": list(COLUMNS),
+            }
+        )
+    )
+
+
+def _map_column(path: Path, dtype: type, width: int) -> np.ndarray:
+    if path.stat().st_size == 0:
+        # mmap cannot map empty files
+        array = np.empty(0, dtype=dtype)
+    else:
+        array = np.memmap(path, dtype=dtype, mode="r")
+    return array.reshape(-1, width) if width > 1 else array
+
+
+class Corpus:
+    """
+    A corpus written by `write_corpus`. Every column is memory mapped, so the
+    corpus is opened without reading it and the pages of a document are only
+    loaded when it is used.
+    """
+
+    def __init__(self, path: str | Path):
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        if meta["columns"] != list(COLUMNS):
+            raise ValueError(f"Unsupported corpus columns {meta['columns']}")
+        self.tokenizer = create_tokenizer(meta["tokenizer_name"])
+        self.sentence_splitter = SENTENCE_SPLITTERS[meta["sentence_splitter"]]
+        self._index = np.load(path / "index.npy")
+        self._columns = {
+            column: _map_column(path / f"{column}.bin", dtype, width)
+            for column, (dtype, width) in COLUMNS.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._index) - 1
+
+    def column(self, column: str, idx: int) -> np.ndarray:
+        """The rows of document `idx` in `column`, as a view of the mapped file."""
+        position = list(COLUMNS).index(column)
+        start, end = self._index[idx, position], self._index[idx + 1, position]
+        return self._columns[column][start:end]
+
+    def text(self, idx: int) -> str:
+        return self.column("text", idx).tobytes().decode()
+
+    def span(self, idx: int) -> TokenSpan:
+        """The tokens of document `idx`, without tokenizing it."""
+        buffer = StoredBuffer(self, idx)
+        return TokenSpan([(buffer, 0, len(buffer), 0)])
+
+
+class StoredBuffer(ArrayBuffer):
+    """
+    The tokens of one `Corpus` document, with the sentences and boundary points
+    that were stored with them.
+    """
+
+    def __init__(self, corpus: Corpus, idx: int):
+        super().__init__(
+            corpus.column("ids", idx),
+            corpus.column("offsets", idx),
+            text=corpus.text(idx),
+            tokenizer=corpus.tokenizer,
+        )
+        splitter = corpus.sentence_splitter
+        self.sentences[splitter] = corpus.column("sentences", idx)
+        self.boundary_points.update(
+            {
+                "whitespace": corpus.column("whitespace", idx),
+                "line": corpus.column("line", idx),
+                "paragraph": corpus.column("paragraph", idx),
+                ("sentence", "right", splitter): corpus.column("sentence_right", idx),
+                ("sentence", "left", splitter): corpus.column("sentence_left", idx),
+            }
+        )
@@ -2,3 +2,4 @@ from typing import Literal
 
 TruncationStrategy = Literal["left", "right", "never"]
 Boundary = Literal["token", "whitespace", "sentence", "line", "paragraph"]
+Allocation = Literal["priority", "fair", "weighted"]
@@ -1,4 +1,7 @@
 
 class TruncationError(ValueError):
     pass
-    
\ No newline at end of file
+    
+
+class FrozenBlockError(RuntimeError):
+    pass
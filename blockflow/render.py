@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import io
+import os
+import pickle
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing.context import BaseContext
+from typing import Iterable, Iterator
+
+from tokenizers import Tokenizer
+
+from blockflow import tokenizer as tokenizer_registry
+from blockflow.block import AbstractBlock
+
+# Tokenizers loaded by this worker process, by the key `render_many` sent
+_WORKER_TOKENIZERS: dict[tuple, Tokenizer] = {}
+
+
+class _TreePickler(pickle.Pickler):
+    """
+    Pickles block trees with every tokenizer replaced by a key. Tokenizers from
+    the registry are keyed by name, and by snapshot path when they were loaded
+    with `load_snapshot`, and loaded by the workers themselves. Any other
+    tokenizer is sent as a JSON string next to the chunk.
+    """
+
+    def __init__(self, file, keys: dict[int, tuple]):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        # (key, JSON string, tokenizer) of the tokenizers seen so far, by id. The
+        # tokenizers are kept alive so that their ids stay unique.
+        self.keys = keys
+        self.tokenizers: dict[tuple, str | None] = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, Tokenizer):
+            return None
+        if id(obj) not in self.keys:
+            names = {
+                id(tokenizer): name
+                for name, tokenizer in tokenizer_registry._TOKENIZERS.items()
+            }
+            if id(obj) in names:
+                name = names[id(obj)]
+                snapshot = tokenizer_registry._SNAPSHOTS.get(name)
+                if snapshot is None:
+                    key = ("name", name)
+                else:
+                    key = ("snapshot", name, snapshot)
+                self.keys[id(obj)] = (key, None, obj)
+            else:
+                key = ("json", os.getpid(), id(obj))
+                self.keys[id(obj)] = (key, obj.to_str(), obj)
+        key, json, _ = self.keys[id(obj)]
+        self.tokenizers[key] = json
+        return key
+
+
+class _TreeUnpickler(pickle.Unpickler):
+    def __init__(self, file, tokenizers: dict[tuple, str | None]):
+        super().__init__(file)
+        self.tokenizers = tokenizers
+
+    def persistent_load(self, key: tuple) -> Tokenizer:
+        tokenizer = _WORKER_TOKENIZERS.get(key)
+        if tokenizer is None:
+            if key[0] == "name":
+                tokenizer = tokenizer_registry.create_tokenizer(key[1])
+            elif key[0] == "snapshot":
+                # Forked workers have the parent's registry, spawned ones load
+                # the snapshot themselves, without the network
+                _, name, path = key
+                tokenizer = tokenizer_registry._TOKENIZERS.get(name)
+                if tokenizer is None:
+                    tokenizer = tokenizer_registry.load_snapshot(path)
+            else:
+                tokenizer = Tokenizer.from_str(self.tokenizers[key])
+            _WORKER_TOKENIZERS[key] = tokenizer
+        return tokenizer
+
+
+def _pickle_chunks(
+    blocks: Iterable[AbstractBlock], chunk_size: int
+) -> Iterator[tuple[int, bytes, dict[tuple, str | None]]]:
+    """Yield (index of the first block, pickled blocks, tokenizers) per chunk."""
+    keys: dict[int, tuple] = {}
+    blocks = iter(blocks)
+    start = 0
+    while chunk := list(islice(blocks, chunk_size)):
+        file = io.BytesIO()
+        pickler = _TreePickler(file, keys)
+        pickler.dump(chunk)
+        yield start, file.getvalue(), pickler.tokenizers
+        start += len(chunk)
+
+
+def _render_chunk(payload: bytes, tokenizers: dict[tuple, str | None]) -> list[str]:
+    blocks = _TreeUnpickler(io.BytesIO(payload), tokenizers).load()
+    return [block.text() for block in blocks]
+
+
+def render_many(
+    blocks: Iterable[AbstractBlock],
+    workers: int | None = None,
+    chunk_size: int = 32,
+    ordered: bool = True,
+    mp_context: BaseContext | None = None,
+) -> Iterator[str] | Iterator[tuple[int, str]]:
+    """
+    Render the text of many independent block trees in a pool of `workers`
+    processes (one per core by default), `chunk_size` trees at a time.
+
+    Trees are sent without their tokenizers: each worker loads a tokenizer once
+    and attaches it to every tree it renders. Tokenizers made with
+    `create_tokenizer` are loaded from the worker's own registry, and those
+    made with `load_snapshot` from the same snapshot file when the worker was
+    not forked, e.g. with a "spawn" `mp_context`. Other tokenizers are sent
+    with every chunk that uses them.
+
+    Texts are yielded in the order of `blocks`, or as soon as they are done
+    together with their index when `ordered` is False. `blocks` is read lazily,
+    with at most two chunks per worker waiting to be rendered.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = _pickle_chunks(blocks, chunk_size)
+    max_in_flight = 2 * workers
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+    try:
+        if ordered:
+            queue: deque[Future] = deque()
+            while True:
+                for _, payload, tokenizers in islice(
+                    chunks, max_in_flight - len(queue)
+                ):
+                    queue.append(pool.submit(_render_chunk, payload, tokenizers))
+                if not queue:
+                    break
+                yield from queue.popleft().result()
+        else:
+            running: dict[Future, int] = {}
+            while True:
+                for start, payload, tokenizers in islice(
+                    chunks, max_in_flight - len(running)
+                ):
+                    running[pool.submit(_render_chunk, payload, tokenizers)] = start
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start = running.pop(future)
+                    for offset, text in enumerate(future.result()):
+                        yield start + offset, text
+    finally:
+        pool.shutdown(cancel_futures=True)
@@ -0,0 +1,424 @@
+from __future__ import annotations
+
+import json
+import sys
+from functools import cache, cached_property
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from tokenizers import Encoding
+
+
+# Fields of the serialized state of an `Encoding` that `_build_encoding` writes,
+# as laid out by the tokenizers versions pinned in pyproject.toml
+_ENCODING_STATE_FIELDS = (
+    "ids",
+    "type_ids",
+    "tokens",
+    "words",
+    "offsets",
+    "special_tokens_mask",
+    "attention_mask",
+    "overflowing",
+    "sequence_ranges",
+)
+
+
+@cache
+def _check_encoding_state():
+    from tokenizers import Encoding
+
+    fields = tuple(json.loads(Encoding().__getstate__()))
+    if fields != _ENCODING_STATE_FIELDS:
+        import tokenizers
+
+        raise RuntimeError(
+            f"tokenizers {tokenizers.__version__} serializes an Encoding as "
+            f"{fields}, not as {_ENCODING_STATE_FIELDS}; install the version "
+            "pinned by blockflow"
+        )
+
+
+# Approximate bytes per token held by an `Encoding` outside of Python: the ids,
+# type ids, word ids, offsets, masks and token strings
+_ENCODING_BYTES_PER_TOKEN = 100
+# Approximate bytes of the Python objects in each item of the lists read out of
+# an `Encoding`, on top of the list itself. Masks and type ids are small ints,
+# which Python shares.
+_FIELD_ITEM_BYTES = {
+    "ids": 32,
+    "offsets": 128,
+    "tokens": 72,
+    "word_ids": 32,
+    "type_ids": 0,
+    "special_tokens_mask": 0,
+    "attention_mask": 0,
+}
+
+
+class TokenBuffer:
+    """
+    The token level fields of one `Encoding`, read out once and shared by every
+    span cut from it.
+    """
+
+    def __init__(self, encoding: Encoding, text: str | None = None):
+        self.encoding = encoding
+        # Source text the encoding was made from, used to find boundaries without
+        # decoding, and the sentence spans / boundary points derived from it
+        self.text = text
+        # sentence spans are keyed by the splitter that produced them
+        self.sentences: dict[object, list[tuple[int, int]]] = {}
+        self.boundary_points: dict[object, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.encoding)
+
+    @cached_property
+    def ids(self) -> list[int]:
+        return self.encoding.ids
+
+    @cached_property
+    def id_array(self) -> np.ndarray:
+        return np.asarray(self.ids, dtype=np.int64)
+
+    @cached_property
+    def tokens(self) -> list[str]:
+        return self.encoding.tokens
+
+    @cached_property
+    def offsets(self) -> list[tuple[int, int]]:
+        return self.encoding.offsets
+
+    @cached_property
+    def word_ids(self) -> list[int | None]:
+        return self.encoding.word_ids
+
+    @cached_property
+    def type_ids(self) -> list[int]:
+        return self.encoding.type_ids
+
+    @cached_property
+    def special_tokens_mask(self) -> list[int]:
+        return self.encoding.special_tokens_mask
+
+    @cached_property
+    def attention_mask(self) -> list[int]:
+        return self.encoding.attention_mask
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory held by the buffer: its encoding, the fields read
+        out of it so far and the boundaries found in it, but not its text.
+        """
+        fields = vars(self)
+        size = 0
+        if "encoding" in fields:
+            size += len(self) * _ENCODING_BYTES_PER_TOKEN
+        for name in ("id_array", "offset_array"):
+            if name in fields:
+                size += fields[name].nbytes
+        for array in fields.get("field_arrays", {}).values():
+            size += array.nbytes
+        for name, item_bytes in _FIELD_ITEM_BYTES.items():
+            if name in fields:
+                size += sys.getsizeof(fields[name]) + len(fields[name]) * item_bytes
+        for points in self.boundary_points.values():
+            size += points.nbytes
+        for spans in self.sentences.values():
+            size += sys.getsizeof(spans) + len(spans) * _FIELD_ITEM_BYTES["offsets"]
+        return size
+
+    def field(self, name: str, start: int, end: int) -> list:
+        """The values of the token level field `name` for tokens `start:end`."""
+        return getattr(self, name)[start:end]
+
+    def char_boundary(self, idx: int) -> int:
+        """
+        Where token `idx` starts in `text`: at the end of the token before it,
+        so that a character split over several tokens goes with the first one,
+        and the first and last tokens reach the ends of the text.
+        """
+        if idx == 0:
+            return 0
+        if idx == len(self):
+            return len(self.text)
+        return self.field("offsets", idx - 1, idx)[0][1]
+
+
+class ArrayBuffer(TokenBuffer):
+    """
+    A `TokenBuffer` over arrays of token ids and offsets that were stored rather
+    than encoded. The other `Encoding` fields are only built for the tokens
+    that are asked for, from `field_arrays` where they were stored too, where
+    word ids of -1 stand for None. Fields not stored have the values of a
+    single sequence encoded without special tokens, with word ids of None.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        text: str | None,
+        tokenizer,
+        field_arrays: dict[str, np.ndarray] | None = None,
+    ):
+        self.id_array = ids
+        self.offset_array = offsets.reshape(-1, 2)
+        self.field_arrays = field_arrays or {}
+        self.text = text
+        self.tokenizer = tokenizer
+        self.sentences = {}
+        self.boundary_points = {}
+
+    def __len__(self) -> int:
+        return len(self.id_array)
+
+    @cached_property
+    def encoding(self) -> Encoding:
+        return TokenSpan([(self, 0, len(self), 0)])._build_encoding()
+
+    @cached_property
+    def ids(self) -> list[int]:
+        return self.id_array.tolist()
+
+    @cached_property
+    def offsets(self) -> list[tuple[int, int]]:
+        return self.field("offsets", 0, len(self))
+
+    def field(self, name: str, start: int, end: int) -> list:
+        if name == "ids":
+            return self.id_array[start:end].tolist()
+        if name == "offsets":
+            return [tuple(pair) for pair in self.offset_array[start:end].tolist()]
+        if name == "tokens":
+            ids = self.field("ids", start, end)
+            return [self.tokenizer.id_to_token(idx) for idx in ids]
+        if name in self.field_arrays:
+            values = self.field_arrays[name][start:end].tolist()
+            if name == "word_ids":
+                return [None if value < 0 else value for value in values]
+            return values
+        if name == "word_ids":
+            return [None] * (end - start)
+        if name in ("type_ids", "special_tokens_mask"):
+            return [0] * (end - start)
+        if name == "attention_mask":
+            return [1] * (end - start)
+        return super().field(name, start, end)
+
+
+class TokenSpan:
+    """
+    An immutable run of tokens made of views over shared `TokenBuffer`s.
+
+    Each piece is a `(buffer, start, end, shift)` view where `shift` is added to
+    the character offsets of the buffer, so slicing and merging spans only copies
+    piece references, never tokens. Offsets follow the same rules as
+    `Encoding.merge(..., growing_offsets=True)`, and a real `Encoding` is only
+    built by `to_encoding`.
+    """
+
+    __slots__ = ("_pieces", "_length", "_ids")
+
+    def __init__(self, pieces=()):
+        self._pieces: tuple[tuple[TokenBuffer, int, int, int], ...] = tuple(
+            piece for piece in pieces if piece[2] > piece[1]
+        )
+        self._length = sum(end - start for _, start, end, _ in self._pieces)
+        self._ids: list[int] | None = None
+
+    @classmethod
+    def from_encoding(cls, encoding: Encoding, text: str | None = None) -> "TokenSpan":
+        buffer = TokenBuffer(encoding, text=text)
+        return cls([(buffer, 0, len(buffer), 0)])
+
+    @classmethod
+    def merge(cls, spans: list["TokenSpan"]) -> "TokenSpan":
+        pieces: list[tuple[TokenBuffer, int, int, int]] = []
+        for span, last_end in zip(spans, cls.merge_shifts(spans)):
+            for buffer, start, end, shift in span._pieces:
+                shift += last_end
+                if pieces:
+                    prev_buffer, prev_start, prev_end, prev_shift = pieces[-1]
+                    # Re-join neighbouring views of the same buffer
+                    if (
+                        prev_buffer is buffer
+                        and prev_end == start
+                        and prev_shift == shift
+                    ):
+                        pieces[-1] = (buffer, prev_start, end, shift)
+                        continue
+                pieces.append((buffer, start, end, shift))
+        return cls(pieces)
+
+    @staticmethod
+    def merge_shifts(spans: list["TokenSpan"]) -> list[int]:
+        """The shift `merge` adds to the offsets of each of `spans`."""
+        shifts = []
+        last_end = 0
+        for span in spans:
+            shifts.append(last_end)
+            if span._pieces:
+                buffer, _, end, shift = span._pieces[-1]
+                last_end += buffer.field("offsets", end - 1, end)[0][1] + shift
+        return shifts
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def pieces(self) -> tuple[tuple[TokenBuffer, int, int, int], ...]:
+        return self._pieces
+
+    def __repr__(self) -> str:
+        return f"TokenSpan(num_tokens={self._length}, pieces={len(self._pieces)})"
+
+    def slice(self, start: int, stop: int) -> "TokenSpan":
+        start, stop = max(start, 0), min(stop, self._length)
+        pieces = []
+        position = 0
+        for buffer, piece_start, piece_end, shift in self._pieces:
+            size = piece_end - piece_start
+            lo, hi = max(start - position, 0), min(stop - position, size)
+            if lo < hi:
+                pieces.append((buffer, piece_start + lo, piece_start + hi, shift))
+            position += size
+            if position >= stop:
+                break
+        return TokenSpan(pieces)
+
+    def shifted(self, delta: int) -> "TokenSpan":
+        """The same tokens with `delta` added to their offsets."""
+        return TokenSpan(
+            (buffer, start, end, shift + delta)
+            for buffer, start, end, shift in self._pieces
+        )
+
+    def shift_at(self, idx: int) -> int:
+        """The shift of the offsets of token `idx`."""
+        position = 0
+        for _, start, end, shift in self._pieces:
+            position += end - start
+            if idx < position:
+                return shift
+        raise IndexError(idx)
+
+    def head(self, n: int) -> "TokenSpan":
+        """The first `n` tokens, like `Encoding.truncate(n, direction="right")`."""
+        if n >= self._length:
+            return self
+        return self.slice(0, n)
+
+    def tail(self, n: int) -> "TokenSpan":
+        """The last `n` tokens, like `Encoding.truncate(n, direction="left")`."""
+        if n >= self._length:
+            return self
+        return self.slice(self._length - n, self._length)
+
+    def _field(self, name: str) -> list:
+        values = []
+        for buffer, start, end, _ in self._pieces:
+            values.extend(buffer.field(name, start, end))
+        return values
+
+    @property
+    def ids(self) -> list[int]:
+        if self._ids is None:
+            self._ids = self._field("ids")
+        return self._ids
+
+    @property
+    def id_array(self) -> np.ndarray:
+        """The token ids as an int64 array, a view when the span is one piece."""
+        if len(self._pieces) == 1:
+            buffer, start, end, _ = self._pieces[0]
+            return buffer.id_array[start:end]
+        return np.concatenate(
+            [buffer.id_array[start:end] for buffer, start, end, _ in self._pieces]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+    @property
+    def tokens(self) -> list[str]:
+        return self._field("tokens")
+
+    @property
+    def word_ids(self) -> list[int | None]:
+        return self._field("word_ids")
+
+    @property
+    def type_ids(self) -> list[int]:
+        return self._field("type_ids")
+
+    @property
+    def special_tokens_mask(self) -> list[int]:
+        return self._field("special_tokens_mask")
+
+    @property
+    def attention_mask(self) -> list[int]:
+        return self._field("attention_mask")
+
+    def text(self, tokenizer=None) -> str:
+        """
+        The source text of the tokens, sliced out of the text of each buffer
+        at the token offsets instead of decoding them. Only the pieces of
+        buffers without a source text are decoded, with `tokenizer`.
+        """
+        parts = []
+        for buffer, start, end, _ in self._pieces:
+            if buffer.text is None:
+                parts.append(tokenizer.decode(buffer.field("ids", start, end)))
+            else:
+                parts.append(
+                    buffer.text[buffer.char_boundary(start) : buffer.char_boundary(end)]
+                )
+        return "".join(parts)
+
+    @property
+    def offsets(self) -> list[tuple[int, int]]:
+        offsets = []
+        for buffer, start, end, shift in self._pieces:
+            if shift:
+                offsets.extend(
+                    (s + shift, e + shift)
+                    for s, e in buffer.field("offsets", start, end)
+                )
+            else:
+                offsets.extend(buffer.field("offsets", start, end))
+        return offsets
+
+    def to_encoding(self) -> Encoding:
+        from tokenizers import Encoding
+
+        if not self._pieces:
+            return Encoding()
+        if len(self._pieces) == 1:
+            buffer, start, end, shift = self._pieces[0]
+            if start == 0 and end == len(buffer) and shift == 0:
+                return buffer.encoding
+        return self._build_encoding()
+
+    def _build_encoding(self) -> Encoding:
+        from tokenizers import Encoding
+
+        # Encoding has no public constructor, so the slice is loaded through the
+        # same serialized state that pickling uses, after checking that the
+        # installed tokenizers lays it out as expected
+        _check_encoding_state()
+        state = {
+            "ids": self.ids,
+            "type_ids": self.type_ids,
+            "tokens": self.tokens,
+            "words": self.word_ids,
+            "offsets": self.offsets,
+            "special_tokens_mask": self.special_tokens_mask,
+            "attention_mask": self.attention_mask,
+            "overflowing": [],
+            "sequence_ranges": {},
+        }
+        encoding = Encoding.__new__(Encoding)
+        encoding.__setstate__(json.dumps(state).encode())
+        return encoding
@@ -0,0 +1,124 @@
+import copy
+
+from blockflow.block import AbstractBlock, Block, TextBlock
+from blockflow.boundary import boundary_kinds, find_boundary_points
+
+
+class Slot(TextBlock):
+    """
+    Placeholder for a value that is only known per request. It takes the same
+    settings as a `TextBlock`, which are applied to the text it is filled with.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(text="", name=name, **kwargs)
+
+
+class BlockTemplate:
+    """
+    A block tree with named `Slot`s, compiled once and filled per request.
+
+    Compiling tokenizes every static leaf and builds the boundary points that
+    the leaf and its ancestors cut on. `render` then only copies the blocks on
+    the path to a slot and tokenizes the slot values. Static leaves and whole
+    static subtrees are shared with the template and every rendered tree,
+    together with their cached sizes and truncations. Compiling therefore
+    freezes the template's tree: editing any of its blocks, or a static block
+    of a rendered tree, raises `FrozenBlockError`. The copies on the path to a
+    slot and the filled slots belong to one rendered tree and can be edited.
+    """
+
+    def __init__(self, block: Block):
+        self.block = block
+        self.slots: dict[str, Slot] = {}
+        block.prepare()
+        self._plan = self._compile(block, [])
+        block._freeze()
+
+    def _compile(self, block: AbstractBlock, ancestors: list[AbstractBlock]):
+        """
+        Return `block` itself when it holds no slot, or a (block, child plans)
+        pair for the blocks that have to be copied per request.
+        """
+        if isinstance(block, Slot):
+            if block.name in self.slots:
+                raise ValueError(f"Slot {block.name} is used more than once")
+            self.slots[block.name] = block
+            return block
+        if isinstance(block, TextBlock):
+            self._warm(block, ancestors + [block])
+            return block
+
+        plans = [self._compile(child, ancestors + [block]) for child in block.children]
+        if not any(isinstance(plan, (Slot, tuple)) for plan in plans):
+            # Nothing below changes per request
+            block.truncate()
+            return block
+        return block, plans
+
+    def _warm(self, leaf: TextBlock, blocks: list[AbstractBlock]):
+        """Compute the leaf's truncation and the boundary points of its cutters."""
+        leaf.truncate()
+        for block in blocks:
+            for boundary in boundary_kinds(block.boundary):
+                if boundary != "token":
+                    find_boundary_points(
+                        leaf._full_span(),
+                        tokenizer=block._tokenizer,
+                        boundary=boundary,
+                        truncate=block.truncation_strategy,
+                    )
+
+    def render(self, **values: str | AbstractBlock) -> AbstractBlock:
+        """Return a tree with every slot filled from `values`, by slot name."""
+        missing = self.slots.keys() - values.keys()
+        if missing:
+            raise ValueError(f"No value given for slots {sorted(missing)}")
+        unknown = values.keys() - self.slots.keys()
+        if unknown:
+            raise ValueError(f"Unknown slots {sorted(unknown)}")
+        return self._build(self._plan, values)
+
+    def _build(self, plan, values: dict[str, str | AbstractBlock]) -> AbstractBlock:
+        if isinstance(plan, Slot):
+            return self._fill(plan, values[plan.name])
+        if isinstance(plan, AbstractBlock):
+            return plan
+
+        block, plans = plan
+        clone = copy.copy(block)
+        clone._cache = {}
+        clone._parent = None
+        clone._other_parents = None
+        clone._frozen = False
+        # The shared static children are frozen, so they keep the template's
+        # block as their parent
+        clone.children = [self._build(child, values) for child in plans]
+        # Static blocks got their tokenizer when compiling and filled slots get it
+        # from `_fill`, so the tree does not need to be walked again
+        clone._cache["tokenizer_set"] = True
+        return clone
+
+    def _fill(self, slot: Slot, value: str | AbstractBlock) -> AbstractBlock:
+        if isinstance(value, AbstractBlock):
+            # `_build` marks the parents as having their tokenizer set, so the value
+            # hands its own down to any leaves without one
+            if value._tokenizer is None:
+                value.set_tokenizer(slot._tokenizer)
+            else:
+                value._ensure_tokenizer_set()
+            return value
+        return TextBlock(
+            text=value,
+            name=slot.name,
+            max_tokens=slot.max_tokens,
+            truncate=slot.truncation_strategy,
+            ellipsis=slot.ellipsis,
+            tokenizer=slot._tokenizer,
+            boundary=slot.boundary,
+            weight=slot.weight,
+            reading_order_idx=slot.reading_order_idx,
+            priority_order_idx=slot.priority_order_idx,
+        )
@@ -1,13 +1,249 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from blockflow.span import TokenSpan
 
-from tokenizers import Tokenizer
+if TYPE_CHECKING:
+    from tokenizers import Tokenizer
 
 GPT4_TOKENIZER_JSON = Path(__file__).parent / "gpt4_tokenizer.json"
 
+# Tokenizers loaded in this process, by name (None for the bundled GPT-4 one)
+_TOKENIZERS: dict[str | None, Tokenizer] = {}
+# Snapshots that registered tokenizers were loaded from, by name, so that
+# processes not forked from this one can load them the same way
+_SNAPSHOTS: dict[str | None, str] = {}
+
 
 def create_tokenizer(tokenizer_name: str | None = None):
-    if tokenizer_name is not None:
-        tokenizer = Tokenizer.from_pretrained(tokenizer_name)
-    else:
-        tokenizer = Tokenizer.from_file(str(GPT4_TOKENIZER_JSON.resolve()))
+    """
+    Return the tokenizer called `tokenizer_name`, loading it only the first
+    time it is asked for in this process.
+    """
+    tokenizer = _TOKENIZERS.get(tokenizer_name)
+    if tokenizer is None:
+        from tokenizers import Tokenizer
+
+        if tokenizer_name is not None:
+            tokenizer = Tokenizer.from_pretrained(tokenizer_name)
+        else:
+            tokenizer = Tokenizer.from_file(str(GPT4_TOKENIZER_JSON.resolve()))
+        _TOKENIZERS[tokenizer_name] = tokenizer
+    return tokenizer
+
+
+@dataclass(frozen=True)
+class VocabularyMasks:
+    """
+    Boolean masks over a tokenizer's vocabulary, indexed by token id.
+
+    The masks are derived from the decoded text of every token rather than from
+    tokenizer specific markers such as "Ġ" or "▁", so they hold for byte-level
+    BPE, SentencePiece and WordPiece vocabularies alike.
+    """
+
+    whitespace: np.ndarray  # token text starts with whitespace
+    newline: np.ndarray  # token text contains a line break
+    blank_line: np.ndarray  # token text contains an empty line
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> "VocabularyMasks":
+        size = tokenizer.get_vocab_size(with_added_tokens=True)
+        # Decoding a token on its own drops a leading space for some decoders, so
+        # every token is decoded after a fixed prefix token which is then removed
+        prefix_id = tokenizer.encode("a", add_special_tokens=False).ids[0]
+        prefix = tokenizer.decode([prefix_id])
+        decoded = tokenizer.decode_batch([[prefix_id, idx] for idx in range(size)])
+        texts = [
+            text[len(prefix) :] if text.startswith(prefix) else text
+            for text in decoded
+        ]
+        return cls(
+            whitespace=np.fromiter(
+                (text[:1].isspace() for text in texts), dtype=bool, count=size
+            ),
+            newline=np.fromiter(("\n" in text for text in texts), dtype=bool, count=size),
+            blank_line=np.fromiter(
+                ("\n\n" in text for text in texts), dtype=bool, count=size
+            ),
+        )
+
+
+def tokenizer_state(tokenizer) -> tuple:
+    """
+    A cheap summary of what usually changes in `tokenizer` after it is made: its
+    added tokens, truncation and padding, and the type of each component. It
+    takes well under a microsecond, so it can be checked on every lookup.
+    """
+    return (
+        tokenizer.get_vocab_size(with_added_tokens=False),
+        len(tokenizer.get_added_tokens_decoder()),
+        tokenizer.truncation,
+        tokenizer.padding,
+        type(tokenizer.model),
+        type(tokenizer.normalizer),
+        type(tokenizer.pre_tokenizer),
+        type(tokenizer.post_processor),
+        type(tokenizer.decoder),
+    )
+
+
+class TokenizerArtifacts:
+    """
+    Constants derived from one tokenizer state, computed on first use and then
+    shared by every block of the process whose tokenizer has that state.
+    """
+
+    def __init__(self, tokenizer, fingerprint: bytes):
+        # A tokenizer with this state, the last one the artifacts were asked for
+        self.tokenizer = tokenizer
+        # Digest of the tokenizer's serialized form, the same in every process
+        self.fingerprint = fingerprint
+        # Fewest tokens per character seen in the texts encoded so far, None
+        # until the first one
+        self.min_token_rate: float | None = None
+
+    def observe(self, texts: list[str], spans: list[TokenSpan]):
+        """Learn from freshly encoded `texts` how few tokens a character takes."""
+        rates = [len(span) / len(text) for text, span in zip(texts, spans) if text]
+        if rates:
+            lowest = min(rates)
+            if self.min_token_rate is None or lowest < self.min_token_rate:
+                self.min_token_rate = lowest
+
+    def min_tokens(self, chars: int) -> float:
+        """
+        Estimated lower bound on the tokens of a text of `chars` characters,
+        0 before any text was encoded.
+        """
+        return chars * (self.min_token_rate or 0.0)
+
+    @cached_property
+    def ellipsis(self) -> TokenSpan:
+        return TokenSpan.from_encoding(self.tokenizer.encode("..."), text="...")
+
+    @cached_property
+    def vocabulary_masks(self) -> VocabularyMasks:
+        return VocabularyMasks.from_tokenizer(self.tokenizer)
+
+
+# Most tokenizer states whose artifacts are remembered at once. The least
+# recently used are forgotten, so tokenizers made per request are not kept
+# alive for the life of the process.
+_MAX_TOKENIZERS = 8
+
+# Artifacts by tokenizer fingerprint
+_ARTIFACTS: OrderedDict[bytes, TokenizerArtifacts] = OrderedDict()
+_LOCK = threading.Lock()
+
+# Tokenizers do not support weak references, so the (state, fingerprint) last
+# taken of a tokenizer is kept in this attribute of the tokenizer itself. It
+# lives and dies with the tokenizer, so no live tokenizer is forgotten.
+_FINGERPRINT_ATTRIBUTE = "_blockflow_fingerprint"
+
+
+def _remember(entries: OrderedDict, key, value):
+    entries[key] = value
+    entries.move_to_end(key)
+    while len(entries) > _MAX_TOKENIZERS:
+        entries.popitem(last=False)
+
+
+def tokenizer_fingerprint(tokenizer) -> bytes:
+    """
+    Digest of the serialized form of `tokenizer`, the same in every process.
+    It is taken again whenever `tokenizer_state` changes, e.g. after
+    `add_tokens` or `enable_truncation`. Changing the options of a component in
+    place, or replacing it with one of the same type, after the tokenizer was
+    first used is not noticed.
+    """
+    state = tokenizer_state(tokenizer)
+    entry = getattr(tokenizer, _FINGERPRINT_ATTRIBUTE, None)
+    if entry is not None and entry[0] == state:
+        return entry[1]
+    serialized = tokenizer.to_str().encode()
+    fingerprint = hashlib.blake2b(serialized, digest_size=16).digest()
+    try:
+        setattr(tokenizer, _FINGERPRINT_ATTRIBUTE, (state, fingerprint))
+    except AttributeError:
+        # Tokenizers that take no attributes are fingerprinted on every call
+        pass
+    return fingerprint
+
+
+def tokenizer_artifacts(tokenizer) -> TokenizerArtifacts:
+    """
+    Return the artifacts shared by every tokenizer with the current state of
+    `tokenizer`.
+    """
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    with _LOCK:
+        artifacts = _ARTIFACTS.get(fingerprint)
+        if artifacts is None:
+            artifacts = TokenizerArtifacts(tokenizer, fingerprint)
+        # Artifacts not computed yet are computed with a tokenizer known to
+        # have the state they are for
+        artifacts.tokenizer = tokenizer
+        _remember(_ARTIFACTS, fingerprint, artifacts)
+    return artifacts
+
+
+def save_snapshot(path: str | Path, tokenizer_name: str | None = None):
+    """
+    Write the tokenizer called `tokenizer_name` together with its artifacts to
+    `path`, so that `load_snapshot` can restore both without the network and
+    without recomputing anything.
+    """
+    tokenizer = create_tokenizer(tokenizer_name)
+    artifacts = tokenizer_artifacts(tokenizer)
+    masks = artifacts.vocabulary_masks
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            name=np.array(json.dumps(tokenizer_name)),
+            tokenizer=np.array(tokenizer.to_str()),
+            ellipsis=np.frombuffer(
+                artifacts.ellipsis.to_encoding().__getstate__(), dtype=np.uint8
+            ),
+            whitespace=masks.whitespace,
+            newline=masks.newline,
+            blank_line=masks.blank_line,
+        )
+
+
+def load_snapshot(path: str | Path) -> Tokenizer:
+    """
+    Register the tokenizer and artifacts saved by `save_snapshot`, so that later
+    `create_tokenizer` calls for the same name return them, and return the
+    tokenizer.
+    """
+    from tokenizers import Encoding, Tokenizer
+
+    with np.load(path) as snapshot:
+        tokenizer_name = json.loads(str(snapshot["name"]))
+        tokenizer = Tokenizer.from_str(str(snapshot["tokenizer"]))
+        ellipsis = Encoding.__new__(Encoding)
+        ellipsis.__setstate__(snapshot["ellipsis"].tobytes())
+        masks = VocabularyMasks(
+            whitespace=snapshot["whitespace"],
+            newline=snapshot["newline"],
+            blank_line=snapshot["blank_line"],
+        )
+
+    artifacts = tokenizer_artifacts(tokenizer)
+    # Fill in the cached properties directly
+    artifacts.ellipsis = TokenSpan.from_encoding(ellipsis, text="...")
+    artifacts.vocabulary_masks = masks
+    _TOKENIZERS[tokenizer_name] = tokenizer
+    _SNAPSHOTS[tokenizer_name] = str(Path(path).resolve())
     return tokenizer
@@ -1,71 +1,232 @@
-import copy
-from typing import Callable
+from __future__ import annotations
 
-from tokenizers import Encoding
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, TypeVar, Union
 
+import numpy as np
+
+from blockflow.boundary import BoundaryPoints
 from blockflow.dtypes import TruncationStrategy
 from blockflow.errors import TruncationError
+from blockflow.span import TokenSpan
+from blockflow.tokenizer import tokenizer_artifacts
 import warnings
 
+if TYPE_CHECKING:
+    from tokenizers import Encoding
+
+
+@dataclass(slots=True)
+class NodeData:
+    """
+    A leaf of a truncation result: the tokens kept, the tokens cut on either
+    side of them, and the name of the block they belong to.
+
+    A leaf that was cut out of the tokens of another also records that leaf as
+    `cut_from` (None when it was cut out of the full tokens of a text block),
+    and the `window` it kept: the kept tokens are `start:end` of the tokens it
+    was cut from, preceded (`side` -1) or followed (`side` 1) by an ellipsis.
+    """
+
+    tokens: TokenSpan
+    remainder_left: TokenSpan = field(default_factory=TokenSpan)
+    remainder_right: TokenSpan = field(default_factory=TokenSpan)
+    name: str = ""
+    cut_from: NodeData | None = None
+    # (start, end, side)
+    window: tuple[int, int, int] | None = None
+
+
+# A truncation result: the leaves of a block, nested like its children
+Tree = list[Union[NodeData, "Tree"]]
+
+T = TypeVar("T")
+
+
+def fold_tree(
+    tree: Tree | NodeData,
+    leaf: Callable[[NodeData], T],
+    group: Callable[[Tree, list[T]], T],
+) -> T:
+    """
+    Reduce `tree` bottom up with an explicit stack, so that trees of any depth
+    can be walked: every leaf becomes `leaf(node)`, in reading order, and every
+    list `group(node, values)` once the values of its items are known.
+    """
+    if isinstance(tree, NodeData):
+        return leaf(tree)
+    # The lists being walked, an iterator over each, and the values of their items
+    lists: list[Tree] = [tree]
+    iterators = [iter(tree)]
+    values: list[list[T]] = [[]]
+    while True:
+        for node in iterators[-1]:
+            if isinstance(node, NodeData):
+                values[-1].append(leaf(node))
+            elif isinstance(node, list):
+                lists.append(node)
+                iterators.append(iter(node))
+                values.append([])
+                break
+            else:
+                raise TypeError(f"Unexpected type {type(node)} in tree")
+        else:
+            iterators.pop()
+            value = group(lists.pop(), values.pop())
+            if not values:
+                return value
+            values[-1].append(value)
+
+
+@dataclass(slots=True)
+class FlatTree:
+    """
+    A truncation result without the nesting. `leaves` are in reading order,
+    and row i of `groups` holds the range of leaves under the i-th list of the
+    tree to end, so nested lists come before the lists holding them and the
+    root is last.
+    """
+
+    leaves: list[NodeData]
+    groups: np.ndarray
+
+    @classmethod
+    def from_tree(cls, tree: Tree) -> FlatTree:
+        leaves: list[NodeData] = []
+        bounds: list[int] = []
+
+        def add_leaf(node: NodeData) -> int:
+            leaves.append(node)
+            return 1
+
+        def add_group(node: Tree, counts: list[int]) -> int:
+            count = sum(counts)
+            bounds.extend((len(leaves) - count, len(leaves)))
+            return count
+
+        fold_tree(tree, add_leaf, add_group)
+        return cls(leaves, np.array(bounds, dtype=np.int64).reshape(-1, 2))
+
+    def __len__(self) -> int:
+        return len(self.leaves)
 
-def truncate_encoding(self, *args, **kwargs):
-    copied = copy.deepcopy(self)
-    copied.truncate(*args, **kwargs)
-    return copied
+    def span(self) -> TokenSpan:
+        """The tokens of every leaf, concatenated."""
+        return TokenSpan.merge([leaf.tokens for leaf in self.leaves])
 
+    def sizes(self) -> np.ndarray:
+        """The number of tokens kept in every leaf."""
+        return np.fromiter(
+            (len(leaf.tokens) for leaf in self.leaves), dtype=np.int64, count=len(self)
+        )
 
-def add_ellipsis_token(tokens, ellipsis_token, direction="right"):
-    n_ellipsis_tokens = len(ellipsis_token.ids)
-    num_tokens_to_keep = max(0, len(tokens.ids) - n_ellipsis_tokens)
+
+@dataclass(slots=True, eq=False)
+class TruncationPlan:
+    """
+    What the truncation of a tree keeps, as flat arrays instead of tokens.
+
+    Leaves are the text blocks of the tree in reading order, counted once per
+    place they appear. Row i of `segments` is a run of kept tokens (leaf,
+    start, end, shift): tokens `start:end` of the full tokens of that leaf, or
+    of the tokenizer's ellipsis when the leaf is -1, with `shift` added to
+    their offsets as merging the truncated tree does. Rows are in reading order.
+    `sizes` holds the number of full tokens of every leaf, -1 for the leaves
+    that were dropped without being tokenized. Plans pickle, and compare equal
+    when they were made for trees with the same `fingerprint` and the same
+    `max_tokens` and keep the same tokens.
+    """
+
+    segments: np.ndarray
+    sizes: np.ndarray
+    max_tokens: int | None
+    fingerprint: bytes
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TruncationPlan):
+            return NotImplemented
+        return (
+            self.fingerprint == other.fingerprint
+            and self.max_tokens == other.max_tokens
+            and np.array_equal(self.segments, other.segments)
+        )
+
+    def size(self) -> int:
+        """The number of tokens kept, ellipses included."""
+        return int((self.segments[:, 2] - self.segments[:, 1]).sum())
+
+    def kept(self) -> np.ndarray:
+        """The number of tokens kept of every leaf, ellipses left out."""
+        leaves = self.segments[:, 0] >= 0
+        return np.bincount(
+            self.segments[leaves, 0],
+            weights=(self.segments[leaves, 2] - self.segments[leaves, 1]),
+            minlength=len(self.sizes),
+        ).astype(np.int64)
+
+    def dropped(self) -> np.ndarray:
+        """Whether every token of each leaf was cut, for the leaves with tokens."""
+        return (self.kept() == 0) & (self.sizes != 0)
+
+
+def add_ellipsis_token(
+    tokens: TokenSpan, ellipsis_token: TokenSpan, direction="right"
+) -> TokenSpan:
+    n_ellipsis_tokens = len(ellipsis_token)
+    num_tokens_to_keep = max(0, len(tokens) - n_ellipsis_tokens)
     if num_tokens_to_keep > 0:
         if direction == "left":
-            first_tokens_removed = truncate_encoding(
-                tokens, num_tokens_to_keep, direction="left"
-            )
-            tokens = Encoding.merge([ellipsis_token, first_tokens_removed])
+            first_tokens_removed = tokens.tail(num_tokens_to_keep)
+            tokens = TokenSpan.merge([ellipsis_token, first_tokens_removed])
         elif direction == "right":
-            last_tokens_removed = truncate_encoding(
-                tokens, num_tokens_to_keep, direction="right"
-            )
-            tokens = Encoding.merge([last_tokens_removed, ellipsis_token])
+            last_tokens_removed = tokens.head(num_tokens_to_keep)
+            tokens = TokenSpan.merge([last_tokens_removed, ellipsis_token])
 
     return tokens
 
 
 def process_boundary_points(
-    boundary_points: list[int],
+    boundary_points: BoundaryPoints | None,
     max_tokens: int,
     token_size: int = None,
     direction="right",
 ) -> int:
+    """
+    Lower `max_tokens` to the largest count that ends the kept tokens on a
+    boundary point, or 0 if there is none. `boundary_points` must be sorted.
+    """
     if boundary_points is not None:
         if direction == "left":
-            while (
-                token_size - max_tokens - 1
-            ) not in boundary_points and max_tokens > 0:
-                # -------------x-
-                max_tokens -= 1
+            # Keeping the last n tokens cuts after token `token_size - n - 1`,
+            # so look for the first boundary point at or after the cut
+            idx = bisect_left(boundary_points, token_size - max_tokens - 1)
+            if idx == len(boundary_points):
+                return 0
+            max_tokens = max(token_size - 1 - int(boundary_points[idx]), 0)
         elif direction == "right":
-            while max_tokens not in boundary_points and max_tokens > 0:
-                max_tokens -= 1
+            idx = bisect_right(boundary_points, max_tokens) - 1
+            max_tokens = int(boundary_points[idx]) if idx >= 0 else 0
 
     return max_tokens
 
 
 def truncate(
-    tokens: Encoding,
+    tokens: TokenSpan | Encoding,
     max_tokens: int | None,
     truncation_strategy: TruncationStrategy,
     tokenizer: Callable,
     ellipsis: bool = False,
-    boundary_points: list[int] | None = None,
+    boundary_points: BoundaryPoints | None = None,
     boundary_name: str = None,
-) -> dict[str, Encoding]:
-    token_size = len(tokens.ids)
-    remainder_right = Encoding()
-    remainder_left = Encoding()
-    ellipsis_tokens: Encoding = tokenizer.encode("...")
-    # n_ellipsis_tokens: int = len(ellipsis_tokens.ids)
+) -> NodeData:
+    if not isinstance(tokens, TokenSpan):
+        tokens = TokenSpan.from_encoding(tokens)
+    token_size = len(tokens)
+    remainder_right = TokenSpan()
+    remainder_left = TokenSpan()
+    window = None
+    ellipsis_tokens = tokenizer_artifacts(tokenizer).ellipsis if ellipsis else None
     if max_tokens is not None and token_size > max_tokens:
         match truncation_strategy:
             case "right":
@@ -73,27 +234,32 @@ def truncate(
                     boundary_points, max_tokens, direction="right"
                 )
                 cutoff = token_size - processed_max_tokens
-                remainder_right = truncate_encoding(tokens, cutoff, direction="left")
-                tokens = truncate_encoding(
-                    tokens, processed_max_tokens, direction="right"
-                )
+                remainder_right = tokens.tail(cutoff)
+                tokens = tokens.head(processed_max_tokens)
+                window = (0, processed_max_tokens, 0)
                 if ellipsis:
                     tokens = add_ellipsis_token(
                         tokens, ellipsis_token=ellipsis_tokens, direction="right"
                     )
+                    # The ellipsis replaces the last tokens when any are left
+                    kept = processed_max_tokens - len(ellipsis_tokens)
+                    if kept > 0:
+                        window = (0, kept, 1)
             case "left":
                 processed_max_tokens = process_boundary_points(
                     boundary_points, max_tokens, token_size, direction="left"
                 )
                 cutoff = token_size - processed_max_tokens
-                remainder_left = truncate_encoding(tokens, cutoff, direction="right")
-                tokens = truncate_encoding(
-                    tokens, processed_max_tokens, direction="left"
-                )
+                remainder_left = tokens.head(cutoff)
+                tokens = tokens.tail(processed_max_tokens)
+                window = (cutoff, token_size, 0)
                 if ellipsis:
                     tokens = add_ellipsis_token(
                         tokens, ellipsis_token=ellipsis_tokens, direction="left"
                     )
+                    kept = processed_max_tokens - len(ellipsis_tokens)
+                    if kept > 0:
+                        window = (token_size - kept, token_size, -1)
 
             case "never":
                 if token_size > max_tokens:
@@ -105,13 +271,55 @@ def truncate(
                 # No truncation
                 pass
 
-        if len(tokens.ids) == 0:
+        if len(tokens) == 0:
             warnings.warn(
                 f"Truncated Text is empty. Consider using a different boundary setting other than '{boundary_name}'"
             )
 
-    return {
-        "remainder_left": remainder_left,
-        "remainder_right": remainder_right,
-        "tokens": tokens,
-    }
+    return NodeData(tokens, remainder_left, remainder_right, window=window)
+
+
+def allocate_budget(
+    sizes: list[int], budget: int, weights: list[float] | None = None
+) -> list[int]:
+    """
+    Split `budget` tokens between blocks that want `sizes` tokens by water-filling:
+    every block gets min(size, weight * level) for the highest level that fits the
+    budget, so blocks that want less than their share leave the rest to the
+    others. Shares are rounded down and the tokens lost to rounding go one each to
+    the first blocks that still want more. Runs in O(n log n).
+    """
+    if sum(sizes) <= budget:
+        return list(sizes)
+    if weights is None:
+        weights = [1.0] * len(sizes)
+
+    shares = [0] * len(sizes)
+    # Blocks fill up in the order of the level at which they are satisfied
+    order = sorted(
+        (idx for idx in range(len(sizes)) if weights[idx] > 0),
+        key=lambda idx: sizes[idx] / weights[idx],
+    )
+    remaining = max(budget, 0)
+    total_weight = sum(weights[idx] for idx in order)
+    for pos, idx in enumerate(order):
+        if sizes[idx] * total_weight <= remaining * weights[idx]:
+            shares[idx] = sizes[idx]
+            remaining -= sizes[idx]
+            total_weight -= weights[idx]
+            continue
+
+        # Every block from here on wants more than its share of what is left
+        level = remaining / total_weight
+        unsatisfied = sorted(order[pos:])
+        for other in unsatisfied:
+            shares[other] = int(weights[other] * level)
+            remaining -= shares[other]
+        for other in unsatisfied:
+            if remaining <= 0:
+                break
+            if shares[other] < sizes[other]:
+                shares[other] += 1
+                remaining -= 1
+        break
+    return shares
@@ -4,6 +4,7 @@ from rich import print
 
 from blockflow.block import Block, TextBlock
 from blockflow.tokenizer import create_tokenizer
+from blockflow.truncation import NodeData
 
 text_files = glob.glob("examples/data/*.txt")
 docs = []
@@ -11,20 +12,29 @@ for file in text_files:
     doc = open(file).read()
     docs.append(doc)
 
-# TODO: We want an even amount of information from each of the documents
-
+# "fair" allocation gives every document an even share of the budget, and hands
+# the share a short document does not need to the others
 max_tokens = 1024
-per_file_max_tokens = max_tokens // 3
-block = Block(max_tokens=max_tokens, tokenizer=create_tokenizer(), boundary="whitespace")
+block = Block(
+    max_tokens=max_tokens,
+    tokenizer=create_tokenizer(),
+    boundary="whitespace",
+    allocation="fair",
+)
 for doc in docs:
-    block += TextBlock(
-        text=doc,
-        max_tokens=per_file_max_tokens,
-        boundary="sentence",
-    )
+    block += TextBlock(text=doc, boundary="sentence")
+
+
+
+def num_tokens(node) -> int:
+    if isinstance(node, NodeData):
+        return len(node.tokens)
+    return sum(num_tokens(child) for child in node)
+
 
 # check that we have an equal amount of information from each document
-for child in block.children:
-    assert child.max_tokens <= per_file_max_tokens
+sizes = [num_tokens(node) for node in block.truncate()]
+assert sum(sizes) <= max_tokens
+assert max(sizes) <= max_tokens // len(docs) + 1
 
 print(block.rich_text())
@@ -0,0 +1,64 @@
+import glob
+import re
+import time
+
+from rich import print
+
+from blockflow.boundary import SPACY_MODEL, RegexSentenceSplitter
+
+text_files = sorted(glob.glob("examples/data/pg*.txt"))
+docs = [open(file).read() for file in text_files]
+num_chars = sum(len(doc) for doc in docs)
+
+
+word = re.compile(r"\w")
+
+
+def sentence_starts(spans: list[tuple[int, int]], text: str) -> set[int]:
+    # spaCy keeps line breaks and opening brackets or quotes with the previous
+    # sentence, so sentences are compared by their first word character
+    starts = set()
+    for start, end in spans:
+        match = word.search(text, start, end)
+        if match:
+            starts.add(match.start())
+    return starts
+
+
+def benchmark(splitter, repeat: int = 5):
+    start = time.perf_counter()
+    splitter.sentence_spans(docs)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        spans = splitter.sentence_spans(docs)
+    warm = (time.perf_counter() - start) / repeat
+    return spans, cold, warm
+
+
+regex_spans, regex_cold, regex_warm = benchmark(RegexSentenceSplitter())
+spacy_spans, spacy_cold, spacy_warm = benchmark(SPACY_MODEL)
+
+matched = predicted = expected = 0
+for doc, regex, spacy in zip(docs, regex_spans, spacy_spans):
+    regex_starts = sentence_starts(regex, doc)
+    spacy_starts = sentence_starts(spacy, doc)
+    matched += len(regex_starts & spacy_starts)
+    predicted += len(regex_starts)
+    expected += len(spacy_starts)
+
+precision, recall = matched / predicted, matched / expected
+print(f"{len(docs)} documents, {num_chars} characters")
+for name, cold, warm in [
+    ("regex", regex_cold, regex_warm),
+    ("spacy", spacy_cold, spacy_warm),
+]:
+    print(
+        f"{name}: first call {cold * 1000:.1f} ms, "
+        f"{num_chars / warm / 1e6:.2f} M chars/s"
+    )
+print(
+    f"agreement with spacy: precision {precision:.3f}, recall {recall:.3f}, "
+    f"f1 {2 * precision * recall / (precision + recall):.3f}"
+)
@@ -0,0 +1,16 @@
+import pytest
+
+from blockflow import cache as cache_module
+from blockflow.cache import EncodingCache
+
+
+@pytest.fixture(autouse=True)
+def encoding_cache(monkeypatch):
+    """
+    Give every test an empty encoding cache: a `CountingTokenizer` has the
+    fingerprint of the tokenizer it wraps, so it would otherwise see the texts
+    encoded by earlier tests.
+    """
+    cache = EncodingCache()
+    monkeypatch.setattr(cache_module, "_ENCODING_CACHE", cache)
+    return cache
@@ -0,0 +1,21 @@
+class CountingTokenizer:
+    """Wraps a tokenizer and records the calls made to it and the texts it encodes."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.texts = []
+        self.encode_calls = 0
+        self.encode_batch_calls = 0
+
+    def encode(self, text, **kwargs):
+        self.encode_calls += 1
+        self.texts.append(text)
+        return self.tokenizer.encode(text, **kwargs)
+
+    def encode_batch(self, texts):
+        self.encode_batch_calls += 1
+        self.texts.extend(texts)
+        return self.tokenizer.encode_batch(texts)
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
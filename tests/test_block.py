@@ -1,10 +1,24 @@
+import asyncio
+import copy
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import pytest
 from rich import print
 from rich.panel import Panel
 
-from blockflow.block import Block, TextBlock
+from blockflow.block import Block, QueueBlock, TextBlock
+from blockflow.boundary import fallback_chain
 from blockflow.errors import TruncationError
 from blockflow.tokenizer import create_tokenizer
+from blockflow.truncation import NodeData
+from helpers import CountingTokenizer
 
 tokenizer = create_tokenizer()
 
@@ -371,6 +385,20 @@ def test_sentence_boundary_parent(truncate, expected):
     assert block.text() == "This is the first sentence. "
 
 
+def test_sentence_boundary_with_fallback():
+    text = "This is a short sentence. This is a longer sentence."
+    block = TextBlock(text=text, tokenizer=tokenizer, max_tokens=4, boundary="sentence")
+    assert block.text() == ""
+
+    block = TextBlock(
+        text=text,
+        tokenizer=tokenizer,
+        max_tokens=4,
+        boundary=fallback_chain("sentence"),
+    )
+    assert block.text() == "This is a short"
+
+
 def test_newline_boundary_parent():
     child_a = TextBlock(
         text="This is the first line.",
@@ -387,3 +415,501 @@ def test_newline_boundary_parent():
         separator="\n",
     )
     assert parent.text() == "This is the first line.\n"
+
+
+def test_cached_results_are_reused():
+    block = Block(text="this is a sample text", max_tokens=3, tokenizer=tokenizer)
+    assert block.tokens() is block.tokens()
+    assert block.full_tokens() is block.full_tokens()
+    assert block.text() == "this is a"
+
+
+def test_child_edits_invalidate_ancestors():
+    child = Block(text="this is a child block")
+    parent = Block(children=[Block(children=[child])], tokenizer=tokenizer)
+    assert parent.text() == "this is a child block"
+
+    child += " with more text"
+    assert parent.text() == "this is a child block with more text"
+
+    child.max_tokens = 2
+    assert parent.text() == "this is"
+
+    child.children.pop()
+    assert parent.text() == "this is"
+    assert parent.full_text() == "this is a child block"
+
+
+def test_shared_child_edits_invalidate_every_parent():
+    shared = TextBlock(text="this is a shared block")
+    first = Block(children=[shared], tokenizer=tokenizer)
+    second = Block(children=[Block(children=[shared])], tokenizer=tokenizer)
+    assert first.text() == second.text() == "this is a shared block"
+
+    shared.max_tokens = 2
+    assert first.text() == second.text() == "this is"
+    assert copy.deepcopy(first).text() == pickle.loads(pickle.dumps(second)).text()
+
+
+def test_blocks_are_slotted():
+    child = TextBlock(text="this is a child block", name="child")
+    parent = Block(children=[child], max_tokens=3, tokenizer=tokenizer)
+    for block in (child, parent, QueueBlock()):
+        assert not hasattr(block, "__dict__")
+
+    tree = parent.truncate()
+    (leaf,) = tree[0]
+    assert isinstance(leaf, NodeData) and leaf.name == "child"
+    assert leaf.tokens.ids == tokenizer.encode("this is a").ids
+
+    # Copies keep the cached results, and do not drop those of the parent
+    clone = copy.copy(child)
+    assert clone._cache["truncated"] is child._cache["truncated"]
+    assert parent.truncate() is tree
+
+
+def test_queue_block_add_invalidates_cache():
+    queue = QueueBlock(queue_size=2, tokenizer=tokenizer)
+    queue.add("first")
+    queue.add(" second")
+    assert queue.text() == "first second"
+    queue.add(" third")
+    assert queue.text() == " second third"
+
+
+def test_queue_block_counts_messages_not_separators():
+    queue = QueueBlock(queue_size=2, separator="\n", tokenizer=tokenizer)
+    for message in ["first", "second", "third"]:
+        queue.add(message)
+    assert queue.text() == "second\nthird"
+    assert [child.name for child in queue.children] == [None, "separator", None]
+
+
+def test_queue_block_keeps_newest_messages_within_budget():
+    queue = QueueBlock(
+        queue_size=100, separator="\n", tokenizer=tokenizer, max_tokens=20
+    )
+    messages = [f"message number {idx} goes here" for idx in range(10)]
+    for message in messages:
+        queue.add(message)
+        assert queue.size() <= 20
+        assert queue.size() == len(tokenizer.encode(queue.text()))
+
+    older, second_last, last = queue.text().rsplit("\n", 2)
+    assert [second_last, last] == messages[-2:]
+    assert older and messages[-3].endswith(older)
+    assert queue.size() == 20
+
+
+def test_queue_block_truncates_only_its_window():
+    queue = QueueBlock(
+        queue_size=1000, separator="\n", tokenizer=tokenizer, max_tokens=16
+    )
+    for idx in range(200):
+        queue.add(f"message {idx}")
+    expected = queue.text()
+    # The separator and the few newest messages that fit, not the whole history
+    blocks = list(queue._truncation_prerequisites())
+    assert blocks[0] is queue._separator_block
+    assert blocks[-1] is queue._messages[-1]
+    assert len(blocks) < 20
+    assert expected.endswith("message 199")
+
+
+def test_queue_block_stays_prepared_across_add():
+    queue = QueueBlock(
+        queue_size=1000, separator="\n", tokenizer=tokenizer, max_tokens=16
+    )
+    for idx in range(50):
+        queue.add(f"message {idx}")
+    queue.text()
+    old = list(queue._messages)
+
+    queue.add("one more message")
+    assert queue._cache.get("prepared")
+    assert queue.text().endswith("\none more message")
+    # Only the new message was looked at, the old ones kept their results
+    assert all("truncated" in message._cache for message in old)
+
+
+def test_queue_block_tokenizes_only_new_messages():
+    counting = CountingTokenizer(tokenizer)
+    queue = QueueBlock(
+        queue_size=100, separator="\n", tokenizer=counting, max_tokens=16
+    )
+    for idx in range(20):
+        queue.add(f"message {idx}")
+    queue.text()
+    calls = counting.encode_batch_calls
+
+    queue.add("one more message")
+    assert queue.text().endswith("\none more message")
+    assert counting.encode_batch_calls == calls + 1
+    assert counting.encode_calls == 0
+
+
+def test_queue_block_message_edits_invalidate_sizes():
+    queue = QueueBlock(queue_size=10, tokenizer=tokenizer, max_tokens=50)
+    first = TextBlock(text="a first message that is fairly long")
+    queue.add(first)
+    queue.add(" and a second one")
+    assert queue.text() == "a first message that is fairly long and a second one"
+
+    first.max_tokens = 2
+    first.truncation_strategy = "right"
+    assert queue.text() == first.text() + " and a second one"
+
+
+def kept_tokens(node) -> int:
+    if isinstance(node, NodeData):
+        return len(node.tokens)
+    return sum(kept_tokens(child) for child in node)
+
+
+def test_fair_allocation():
+    docs = ["one " * 50, "two " * 5, "three " * 50]
+    block = Block(max_tokens=45, tokenizer=tokenizer, allocation="fair")
+    for doc in docs:
+        block += TextBlock(text=doc)
+
+    sizes = [len(tokenizer.encode(doc).ids) for doc in docs]
+    kept = [kept_tokens(node) for node in block.truncate()]
+    # The short document is kept whole and the others share the rest evenly
+    assert kept[1] == sizes[1]
+    assert abs(kept[0] - kept[2]) <= 1
+    assert sum(kept) == block.size() == 45
+
+    # The default hands the budget out in priority order
+    block.allocation = "priority"
+    with pytest.warns(UserWarning):
+        assert "three" not in block.text()
+
+
+def test_weighted_allocation():
+    block = Block(
+        children=[
+            TextBlock(text="one " * 50, weight=2),
+            TextBlock(text="two " * 50),
+            TextBlock(text="three " * 50, truncate="never"),
+        ],
+        max_tokens=90,
+        tokenizer=tokenizer,
+        allocation="weighted",
+    )
+    # "never" children are served first and the rest is split 2:1
+    kept = [kept_tokens(node) for node in block.truncate()]
+    never_size = block.children[2].size()
+    assert kept == [26, 12, never_size]
+    assert block.size() == 90
+
+    block.children[1].weight = 2
+    assert [kept_tokens(node) for node in block.truncate()] == [19, 19, never_size]
+
+
+def test_deeply_nested_truncation():
+    # Every level sits exactly at its budget, which used to re-truncate each
+    # subtree an exponential number of times
+    text = "a b c d e f g h i j k l m n o p"
+    block = TextBlock(text=text)
+    for _ in range(40):
+        block = Block(children=[block], max_tokens=16)
+    block.set_tokenizer(tokenizer)
+    assert block.text() == text
+    assert block.size() == 16
+
+
+def test_trees_deeper_than_the_recursion_limit():
+    block = TextBlock(text="a b c d")
+    for _ in range(3 * sys.getrecursionlimit()):
+        block = Block(children=[block], max_tokens=4)
+    root = Block(children=[block], max_tokens=2, tokenizer=tokenizer)
+    assert root.text() == "a b"
+    assert root.full_text() == "a b c d"
+    assert isinstance(root.format_node(root.truncate()), Panel)
+
+    block.children[0].max_tokens = 3
+    assert root.size() == 2 and block.text() == "a b c"
+
+
+def test_queue_block_inside_block():
+    queue = QueueBlock(max_tokens=5, separator="\n")
+    for idx in range(5):
+        queue.add(f"message number {idx}")
+    block = Block(children=[TextBlock(text="Chat:\n"), queue], tokenizer=tokenizer)
+    assert block.text() == "Chat:\nmessage number 4"
+
+
+def test_prepare_tokenizes_leaves_in_one_batch():
+    counting = CountingTokenizer(tokenizer)
+    block = Block(
+        children=[
+            Block(text="this is a child block", separator="\n"),
+            TextBlock(text="this is a sample text"),
+        ],
+        separator="\n",
+        max_tokens=8,
+        tokenizer=counting,
+    )
+    block.prepare()
+    assert counting.encode_batch_calls == 1
+    assert block.full_text() == "this is a child block\nthis is a sample text"
+    assert block.full_size() == len(tokenizer.encode(block.full_text()))
+    assert counting.encode_calls == 0
+    assert counting.encode_batch_calls == 1
+
+    block += "more text"
+    # The full text is joined from the leaves without tokenizing them
+    assert block.full_text().endswith("\nmore text")
+    assert counting.encode_batch_calls == 1
+    assert block.full_size() == len(tokenizer.encode(block.full_text()))
+    assert counting.encode_batch_calls == 2
+
+
+def streamed_prompt(**kwargs):
+    return Block(
+        children=[
+            TextBlock(text="You are a helpful assistant.", truncate="never"),
+            Block(
+                children=[TextBlock(text=f"Document {idx}. " * 5) for idx in range(3)],
+                separator="\n",
+            ),
+            TextBlock(text="What do the documents say?", boundary="whitespace"),
+        ],
+        separator="\n",
+        tokenizer=tokenizer,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"max_tokens": 40},
+        {"max_tokens": 40, "truncate": "left"},
+        {"max_tokens": 40, "allocation": "fair"},
+    ],
+)
+def test_iter_text_matches_text(kwargs):
+    expected = streamed_prompt(**kwargs)
+    block = streamed_prompt(**kwargs)
+    assert "".join(block.iter_text()) == expected.text()
+    assert [
+        token for tokens in block.iter_tokens() for token in tokens.ids
+    ] == expected.tokens().ids
+
+
+def test_iter_text_streams_before_tokenizing_the_rest():
+    block = streamed_prompt(max_tokens=40)
+    pieces = block.iter_text()
+    assert next(pieces) == "You are a helpful assistant."
+    question = block.children[-1]
+    assert question._tokens is None
+    assert next(pieces) == "\n"
+    assert question._tokens is None
+    assert "You are a helpful assistant.\n" + "".join(pieces) == (
+        streamed_prompt(max_tokens=40).text()
+    )
+
+
+def test_lazy_block_does_not_tokenize_dropped_children():
+    counting = CountingTokenizer(tokenizer)
+    texts = [f"Document {idx} says something. " * 20 for idx in range(50)]
+    docs = [TextBlock(text=text) for text in texts]
+    block = Block(
+        children=docs, separator="\n", max_tokens=300, tokenizer=counting, lazy=True
+    )
+    # The length is in characters and needs no tokens
+    assert len(block) == len("\n".join(texts))
+    assert counting.encode_batch_calls == 0
+
+    expected = Block(
+        children=[TextBlock(text=text) for text in texts],
+        separator="\n",
+        max_tokens=300,
+        tokenizer=tokenizer,
+    )
+    assert block.text() == expected.text()
+    assert block.size() == expected.size()
+    assert "".join(block.iter_text()) == expected.text()
+    # The first documents are kept whole and the next one is cut. Children are
+    # tokenized in batches sized by a lower bound on their tokens, so a few
+    # past the cut one can be tokenized too, but the rest are dropped untokenized
+    text = block.text()
+    cut = next(idx for idx, doc_text in enumerate(texts) if doc_text not in text)
+    last = text.rsplit("\n", 1)[-1]
+    assert cut > 0 and texts[cut].startswith(last) and last != texts[cut]
+    assert all(doc._tokens is not None for doc in docs[: cut + 1])
+    assert all(doc._tokens is None for doc in docs[cut + 5 :])
+
+
+def test_lazy_block_checks_dropped_children():
+    def build(lazy):
+        dropped = Block(
+            children=[TextBlock(text="a rule that must stay whole", truncate="never")],
+            max_tokens=2,
+        )
+        return Block(
+            children=[TextBlock(text="Document says something. " * 20), dropped],
+            max_tokens=10,
+            tokenizer=tokenizer,
+            lazy=lazy,
+        )
+
+    # The "never" child does not fit its parent, even though it is dropped
+    for lazy in (False, True):
+        with pytest.raises(ValueError, match="exceeds the parent's max_tokens"):
+            build(lazy).text()
+        with pytest.raises(ValueError, match="exceeds the parent's max_tokens"):
+            "".join(build(lazy).iter_text())
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"max_tokens": 40},
+        {"max_tokens": 40, "truncate": "left", "ellipsis": True},
+        {"max_tokens": 40, "allocation": "fair"},
+        {"max_tokens": 40, "lazy": True},
+    ],
+)
+def test_materialized_plan_matches_truncation(kwargs):
+    expected = streamed_prompt(**kwargs)
+    block = streamed_prompt(**kwargs)
+    plan = block.plan()
+    assert plan.size() == expected.size()
+    assert block.materialize(plan) == expected.text()
+    tokens = block.materialize_tokens(plan)
+    assert tokens.ids == expected.tokens().ids
+    assert tokens.offsets == expected.tokens().offsets
+
+
+def test_plan_is_reused_by_equal_trees():
+    block = streamed_prompt(max_tokens=40)
+    plan = pickle.loads(pickle.dumps(block.plan()))
+    assert block.plan() is block.plan()
+
+    other = streamed_prompt(max_tokens=40)
+    assert other.fingerprint() == block.fingerprint()
+    assert other.materialize(plan) == block.text()
+    # The first document is cut and the leaves after it are dropped, so they
+    # are not tokenized
+    assert plan.dropped().tolist() == [False] * 3 + [True] * 6
+    assert other.children[2].children[2]._tokens is None
+    assert other.children[-1]._tokens is None
+    assert other.plan() == plan
+
+    other.children[-1] = TextBlock(text="What else?")
+    assert other.fingerprint() != block.fingerprint()
+    with pytest.raises(ValueError):
+        other.materialize(plan)
+
+
+def test_plan_with_other_budget():
+    block = streamed_prompt(max_tokens=40)
+    plan = block.plan(max_tokens=20)
+    assert plan.max_tokens == 20 and block.max_tokens == 40
+    assert block.materialize(plan) == streamed_prompt(max_tokens=20).text()
+    assert block.text() == streamed_prompt(max_tokens=40).text()
+    assert plan.kept().sum() == plan.size() == 20
+
+class TrackingExecutor(ThreadPoolExecutor):
+    """Thread pool that records the most jobs it ran at the same time."""
+
+    def __init__(self):
+        super().__init__(max_workers=8)
+        self.lock = threading.Lock()
+        self.active = self.most_active = self.jobs = 0
+
+    def submit(self, fn, *args):
+        def job():
+            with self.lock:
+                self.active += 1
+                self.jobs += 1
+                self.most_active = max(self.most_active, self.active)
+            time.sleep(0.01)
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+        return super().submit(job)
+
+
+def async_prompt():
+    return Block(
+        children=[
+            TextBlock(text=f"document {idx} " * 20, max_tokens=10, boundary="whitespace")
+            for idx in range(6)
+        ],
+        separator="\n",
+        max_tokens=40,
+        tokenizer=tokenizer,
+        allocation="fair",
+    )
+
+
+def test_async_methods_match_sync_methods():
+    expected = async_prompt()
+    block = async_prompt()
+    assert asyncio.run(block.atext()) == expected.text()
+    assert asyncio.run(block.asize()) == expected.size()
+    assert asyncio.run(block.atokens()).ids == expected.tokens().ids
+
+
+def test_async_methods_run_in_executor_with_limit():
+    executor = TrackingExecutor()
+    block = async_prompt()
+    asyncio.run(block.atext(executor=executor, max_concurrency=2))
+    assert block.text() == async_prompt().text()
+    # prepare, six children plus five separators, then text
+    assert executor.jobs == 13
+    assert executor.most_active == 2
+
+    # Nothing is left to truncate, only the cached text is fetched
+    asyncio.run(block.atext(executor=executor))
+    assert executor.jobs == 14
+
+
+# Seconds `import blockflow.block` may take in a fresh interpreter. Timings
+# depend on the machine and its load, so the budget is only checked when
+# benchmarks are asked for with BLOCKFLOW_BENCHMARKS=1.
+IMPORT_BUDGET = 0.75
+
+
+def import_blockflow(runs: int) -> list[list[str]]:
+    """The import time and the heavy modules imported, in `runs` interpreters."""
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import blockflow.block\n"
+        "elapsed = time.perf_counter() - start\n"
+        "heavy = ('rich', 'tokenizers', 'spacy', 'transformers')\n"
+        "print(elapsed, *[name for name in heavy if name in sys.modules])\n"
+    )
+    return [
+        subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=Path(__file__).parent.parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        for _ in range(runs)
+    ]
+
+
+def test_import_is_light():
+    (result,) = import_blockflow(1)
+    assert result[1:] == []
+
+
+@pytest.mark.skipif(
+    os.environ.get("BLOCKFLOW_BENCHMARKS") != "1",
+    reason="set BLOCKFLOW_BENCHMARKS=1 to check timings",
+)
+def test_import_budget():
+    results = import_blockflow(3)
+    assert min(float(result[0]) for result in results) < IMPORT_BUDGET
@@ -0,0 +1,206 @@
+import pytest
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+
+from blockflow.block import Block, TextBlock
+from blockflow.boundary import (
+    REGEX_SPLITTER,
+    SPACY_MODEL,
+    RegexSentenceSplitter,
+    SpacyPlugin,
+    VocabularyMasks,
+    fallback_chain,
+    find_boundary_points,
+    set_sentence_splitter,
+)
+from blockflow.tokenizer import create_tokenizer
+
+tokenizer = create_tokenizer()
+
+
+def metaspace_tokenizer() -> Tokenizer:
+    vocab = {"<unk>": 0, "a": 1, "▁a": 2, "▁hello": 3, "▁world": 4, "ing": 5, "▁sing": 6}
+    sentencepiece = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token="<unk>"))
+    sentencepiece.pre_tokenizer = pre_tokenizers.Metaspace()
+    sentencepiece.decoder = decoders.Metaspace()
+    return sentencepiece
+
+
+def wordpiece_tokenizer() -> Tokenizer:
+    vocab = {"[UNK]": 0, "a": 1, "hello": 2, "world": 3, "sing": 4, "##ing": 5}
+    wordpiece = Tokenizer(models.WordPiece(vocab=vocab, unk_token="[UNK]"))
+    wordpiece.pre_tokenizer = pre_tokenizers.Whitespace()
+    wordpiece.decoder = decoders.WordPiece()
+    return wordpiece
+
+
+def test_whitespace_mask_for_metaspace_vocabulary():
+    masks = VocabularyMasks.from_tokenizer(metaspace_tokenizer())
+    assert masks.whitespace.tolist() == [False, False, True, True, True, False, True]
+
+
+def test_whitespace_mask_for_wordpiece_vocabulary():
+    masks = VocabularyMasks.from_tokenizer(wordpiece_tokenizer())
+    assert masks.whitespace.tolist() == [True, True, True, True, True, False]
+
+
+def test_whitespace_boundary_points_for_wordpiece():
+    wordpiece = wordpiece_tokenizer()
+    encoding = wordpiece.encode("hello singing world")
+    assert encoding.tokens == ["hello", "sing", "##ing", "world"]
+    boundary_points = find_boundary_points(
+        encoding, wordpiece, boundary="whitespace", truncate="right"
+    )
+    assert boundary_points.tolist() == [0, 1, 3]
+
+
+def test_line_boundary_points_include_merged_newline_tokens():
+    encoding = tokenizer.encode("first line.\nsecond line\n\nthird")
+    masks = VocabularyMasks.from_tokenizer(tokenizer)
+    expected = [i for i, idx in enumerate(encoding.ids) if "\n" in tokenizer.decode([idx])]
+    boundary_points = find_boundary_points(
+        encoding, tokenizer, boundary="line", truncate="right"
+    )
+    assert boundary_points.tolist() == expected
+    assert masks.blank_line[encoding.ids].any() == any(
+        "\n\n" in tokenizer.decode([idx]) for idx in encoding.ids
+    )
+
+
+def test_sentence_spans_chunk_texts_longer_than_max_length():
+    pytest.importorskip("spacy")
+    text = "This is the first sentence. This is the second one. And a third."
+    expected = SpacyPlugin().sentence_spans([text])[0]
+
+    plugin = SpacyPlugin()
+    plugin.sentence_splitter.max_length = 30
+    spans = plugin.sentence_spans([text, "Short one. Another."])
+    assert spans[0] == expected
+    assert all(text[start:end].strip() for start, end in spans[0])
+    assert spans[1] == [(0, 10), (11, 19)]
+
+
+def test_prepare_segments_sentence_leaves_in_one_batch(monkeypatch):
+    calls = []
+    sentence_spans = REGEX_SPLITTER.sentence_spans
+
+    def counting_sentence_spans(texts, n_process=1):
+        calls.append(list(texts))
+        return sentence_spans(texts, n_process=n_process)
+
+    monkeypatch.setattr(REGEX_SPLITTER, "sentence_spans", counting_sentence_spans)
+    block = Block(
+        children=[
+            TextBlock(text="This is the first sentence. Here is another sentence."),
+            TextBlock(text="A third sentence. And a fourth one."),
+        ],
+        max_tokens=12,
+        boundary="sentence",
+        separator=" ",
+        tokenizer=tokenizer,
+    )
+    block.prepare()
+    assert len(calls) == 1
+    assert "A third sentence. And a fourth one." in calls[0]
+
+    assert block.text() == "This is the first sentence. Here is another sentence. "
+    assert len(calls) == 1
+
+
+def test_regex_splitter_rules():
+    text = (
+        'Mr. Smith met J. R. Jones in the U.S. today. He said "hi." '
+        "It works, e.g. here! Really? yes.  [1]\n\nThe end"
+    )
+    sentences = [text[start:end] for start, end in RegexSentenceSplitter().split(text)]
+    assert sentences == [
+        "Mr. Smith met J. R. Jones in the U.S. today.",
+        'He said "hi."',
+        "It works, e.g. here!",
+        "Really? yes.",
+        "[1]\n\nThe end",
+    ]
+    assert RegexSentenceSplitter().split("  \n ") == []
+
+
+def test_regex_splitter_matches_spacy_on_simple_text():
+    pytest.importorskip("spacy")
+    texts = [
+        "This is the first sentence. Here is another sentence.",
+        "One! Two? Three.",
+    ]
+    assert REGEX_SPLITTER.sentence_spans(texts) == SPACY_MODEL.sentence_spans(texts)
+
+
+def test_sentence_splitter_is_pluggable():
+    class LineSplitter:
+        def sentence_spans(self, texts, n_process=1):
+            spans = []
+            for text in texts:
+                starts = [0] + [i + 1 for i, char in enumerate(text) if char == "\n"]
+                spans.append([(start, start) for start in starts])
+            return spans
+
+    encoding = tokenizer.encode("First line. Still first\nSecond line")
+    default = find_boundary_points(encoding, tokenizer, "sentence", "right")
+    lines = find_boundary_points(
+        encoding, tokenizer, "sentence", "right", sentence_splitter=LineSplitter()
+    )
+    assert len(default) == 2
+    assert tokenizer.decode(encoding.ids[lines[-1] :]).strip() == "Second line"
+    assert list(default) != list(lines)
+
+
+def test_spacy_sentence_splitter_can_be_set():
+    pytest.importorskip("spacy")
+    encoding = tokenizer.encode("First line. Still first\nSecond line")
+    default = find_boundary_points(encoding, tokenizer, "sentence", "right")
+    try:
+        set_sentence_splitter(SPACY_MODEL)
+        assert list(
+            find_boundary_points(encoding, tokenizer, "sentence", "right")
+        ) == list(default)
+    finally:
+        set_sentence_splitter(REGEX_SPLITTER)
+
+
+def test_paragraph_boundary_points():
+    text = "First paragraph.\nStill first.\n\nSecond paragraph.\n  \nThird."
+    encoding = tokenizer.encode(text)
+    points = find_boundary_points(encoding, tokenizer, "paragraph", "right")
+    lines = find_boundary_points(encoding, tokenizer, "line", "right")
+    assert set(points) < set(lines)
+    assert [tokenizer.decode(encoding.ids[: point + 1]) for point in points] == [
+        "First paragraph.\nStill first.\n\n",
+        "First paragraph.\nStill first.\n\nSecond paragraph.\n  \n",
+    ]
+
+
+def test_boundary_index_is_built_once_per_block():
+    block = TextBlock(
+        text="One line.\n\nAnother line. And more.\nLast one.",
+        tokenizer=tokenizer,
+        boundary="paragraph",
+    )
+    span = block._full_span()
+    (buffer, _, _, _) = span.pieces[0]
+    points = block.boundary_points(None, None)
+    assert set(buffer.boundary_points) >= {"whitespace", "line", "paragraph"}
+    assert list(points) == list(buffer.boundary_points["paragraph"])
+
+    index = dict(buffer.boundary_points)
+    block.boundary_points("line", None)
+    block.boundary_points("whitespace", "left")
+    assert all(buffer.boundary_points[key] is index[key] for key in index)
+
+
+def test_fallback_chain_uses_coarsest_boundary_that_fits():
+    assert fallback_chain("sentence") == ("sentence", "line", "whitespace", "token")
+    encoding = tokenizer.encode("A first sentence that is rather long. Then more words")
+    chain = fallback_chain("sentence")
+    assert list(
+        find_boundary_points(encoding, tokenizer, chain, "right", max_tokens=12)
+    ) == list(find_boundary_points(encoding, tokenizer, "sentence", "right"))
+    # The first sentence does not fit in 4 tokens and there are no line breaks
+    assert list(
+        find_boundary_points(encoding, tokenizer, chain, "right", max_tokens=4)
+    ) == list(find_boundary_points(encoding, tokenizer, "whitespace", "right"))
@@ -0,0 +1,216 @@
+import multiprocessing
+
+from blockflow import cache as cache_module
+from blockflow.block import Block, TextBlock
+from blockflow.cache import EncodingCache, TokenCache, encode_texts
+from blockflow.tokenizer import create_tokenizer
+from helpers import CountingTokenizer
+
+tokenizer = create_tokenizer()
+
+TEXTS = [
+    "The first text.",
+    "",
+    "A second text, with Unicode: déjà vu.",
+    "The first text.",
+]
+
+
+def test_cache_round_trip(tmp_path):
+    cache = TokenCache(tmp_path / "tokens.sqlite")
+    first = cache.encode(tokenizer, TEXTS)
+    assert cache.stats.misses == 4 and cache.stats.hits == 0
+
+    # A new process sees the entries written by the first one
+    cache = TokenCache(tmp_path / "tokens.sqlite")
+    second = cache.encode(tokenizer, TEXTS)
+    assert cache.stats.hits == 4 and cache.stats.hit_rate == 1.0
+    for text, span, cached in zip(TEXTS, first, second):
+        encoding = tokenizer.encode(text)
+        assert cached.ids == span.ids == encoding.ids
+        assert cached.offsets == encoding.offsets
+    assert cache.size()[0] == 3
+
+
+def test_cache_follows_tokenizer_changes(tmp_path):
+    from tokenizers import Tokenizer
+
+    changing = Tokenizer.from_str(tokenizer.to_str())
+    cache = TokenCache(tmp_path / "tokens.sqlite")
+    text = "hello world foo"
+    assert cache.encode(changing, [text])[0].ids == tokenizer.encode(text).ids
+
+    changing.add_tokens(["hello world"])
+    (span,) = cache.encode(changing, [text])
+    assert span.ids == changing.encode(text).ids != tokenizer.encode(text).ids
+    assert cache.stats.hits == 0 and cache.stats.misses == 2
+
+
+def test_cache_hits_match_fresh_encodings(tmp_path):
+    from tokenizers import Tokenizer, processors
+
+    templated = Tokenizer.from_str(tokenizer.to_str())
+    templated.add_special_tokens(["<s>", "</s>"])
+    templated.post_processor = processors.TemplateProcessing(
+        single="<s> $A </s>",
+        special_tokens=[
+            (token, templated.token_to_id(token)) for token in ("<s>", "</s>")
+        ],
+    )
+    cache = TokenCache(tmp_path / "tokens.sqlite")
+    cache.encode(templated, TEXTS)
+    for text, span in zip(TEXTS, cache.encode(templated, TEXTS)):
+        cached, encoding = span.to_encoding(), templated.encode(text)
+        for field in (
+            "ids",
+            "tokens",
+            "offsets",
+            "word_ids",
+            "type_ids",
+            "special_tokens_mask",
+            "attention_mask",
+        ):
+            assert getattr(cached, field) == getattr(encoding, field)
+    assert cache.stats.hits == 4
+
+
+def test_blocks_use_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cache_module, "_TOKEN_CACHE", TokenCache(tmp_path / "tokens.sqlite")
+    )
+
+    def build(counting):
+        return Block(
+            children=[TextBlock(text=text) for text in TEXTS],
+            separator="\n",
+            max_tokens=12,
+            tokenizer=counting,
+        )
+
+    counting = CountingTokenizer(tokenizer)
+    expected = build(counting).text()
+    assert counting.texts
+
+    counting = CountingTokenizer(tokenizer)
+    assert build(counting).text() == expected
+    assert TextBlock(text=TEXTS[2], tokenizer=counting).full_tokens().ids == (
+        tokenizer.encode(TEXTS[2]).ids
+    )
+    assert counting.texts == []
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    texts = [f"text number {idx} " * 20 for idx in range(3)]
+    entry_size = 20 + 19 * len(tokenizer.encode(texts[0]).ids)
+    cache = TokenCache(tmp_path / "tokens.sqlite", max_bytes=int(2.5 * entry_size))
+    for text in texts[:2]:
+        cache.encode(tokenizer, [text])
+    # Using the first text again makes the second the least recently used
+    cache.encode(tokenizer, texts[:1])
+    cache.encode(tokenizer, texts[2:])
+
+    first, second, third = cache.get_many(tokenizer, texts)
+    assert first is not None and second is None and third is not None
+    assert cache.stats.evictions == 1
+    assert cache.size()[0] == 2
+    assert cache.size()[1] <= cache.max_bytes
+
+
+def test_identical_leaves_share_tokens(monkeypatch):
+    monkeypatch.setattr(cache_module, "_ENCODING_CACHE", EncodingCache())
+    counting = CountingTokenizer(tokenizer)
+    blocks = [
+        Block(
+            children=[
+                TextBlock(text="A system prompt."),
+                TextBlock(text=f"Question {idx}"),
+            ],
+            separator="\n",
+            tokenizer=counting,
+        )
+        for idx in range(3)
+    ]
+    for block in blocks:
+        block.text()
+    assert sorted(counting.texts) == [
+        "\n",
+        "A system prompt.",
+        "Question 0",
+        "Question 1",
+        "Question 2",
+    ]
+    assert blocks[0].children[0]._full_span() is blocks[2].children[0]._full_span()
+    assert blocks[0].children[1]._full_span() is blocks[1].children[1]._full_span()
+
+    # Identical texts of one batch are encoded once
+    first, second = encode_texts(counting, ["Twice", "Twice"])
+    assert first is second
+    assert counting.texts.count("Twice") == 1
+
+
+def test_encoding_cache_evicts_least_recently_used():
+    texts = [f"text number {idx}" for idx in range(3)]
+    spans = encode_texts(tokenizer, texts)
+    cache = EncodingCache(max_bytes=2 * EncodingCache._size(texts[0], spans[0]))
+
+    cache.put_many(tokenizer, texts[:2], spans[:2])
+    # Using the first text makes the second the least recently used
+    assert cache.get_many(tokenizer, texts[:1]) == spans[:1]
+    cache.put_many(tokenizer, texts[2:], spans[2:])
+    assert cache.get_many(tokenizer, texts) == [spans[0], None, spans[2]]
+    assert len(cache) == 2 and cache.bytes <= cache.max_bytes
+    assert cache.stats.evictions == 1
+
+
+def test_encoding_cache_follows_tokenizer_changes(monkeypatch):
+    from tokenizers import Tokenizer
+
+    monkeypatch.setattr(cache_module, "_ENCODING_CACHE", EncodingCache())
+    changing = Tokenizer.from_str(tokenizer.to_str())
+    text = "hello world foo"
+    assert TextBlock(text=text, tokenizer=changing).text() == text
+
+    changing.add_tokens(["hello world"])
+    block = TextBlock(text=text, tokenizer=changing)
+    assert block.full_tokens().ids == changing.encode(text).ids
+    assert block.full_tokens().ids != tokenizer.encode(text).ids
+
+
+def test_encoding_cache_measures_entries_again_after_use():
+    cache = EncodingCache()
+    text = "Some words to render. And a second sentence."
+    (span,) = encode_texts(tokenizer, [text])
+    cache.put_many(tokenizer, [text], [span])
+    stored = cache.bytes
+
+    # Rendering reads fields and boundaries out of the shared buffer
+    buffer = span.pieces[0][0]
+    buffer.ids, buffer.offsets
+    cache.get_many(tokenizer, [])
+    assert cache.bytes == EncodingCache._size(text, span) > stored
+    assert cache.bytes > len(span) * (8 + 32 + 128)
+
+
+def fill(path, texts):
+    TokenCache(path, max_bytes=1 << 20).encode(tokenizer, texts)
+
+
+def test_cache_is_shared_by_processes(tmp_path):
+    path = tmp_path / "tokens.sqlite"
+    texts = [f"text number {idx}" for idx in range(200)]
+    processes = [
+        multiprocessing.Process(target=fill, args=(path, texts[idx::4]))
+        for idx in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    cache = TokenCache(path)
+    spans = cache.get_many(tokenizer, texts)
+    assert cache.stats.hits == len(texts)
+    assert [span.ids for span in spans] == [
+        encoding.ids for encoding in tokenizer.encode_batch(texts)
+    ]
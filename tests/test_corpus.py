@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from blockflow.block import Block, TextBlock
+from blockflow.corpus import Corpus, StoredBuffer, write_corpus
+from blockflow.tokenizer import create_tokenizer
+from helpers import CountingTokenizer
+
+tokenizer = create_tokenizer()
+
+DOCS = [
+    "The first document. It has two sentences.\n\nAnd a second paragraph.",
+    "",
+    "Second document, a single line without a full stop",
+    "Third document.\nIt spans\nthree lines. Déjà vu for the offsets.",
+]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    write_corpus(tmp_path, DOCS, batch_size=3)
+    return Corpus(tmp_path)
+
+
+def test_corpus_round_trip(corpus):
+    assert len(corpus) == len(DOCS)
+    for idx, doc in enumerate(DOCS):
+        encoding = tokenizer.encode(doc)
+        span = corpus.span(idx)
+        assert corpus.text(idx) == doc
+        assert span.ids == encoding.ids
+        assert span.offsets == encoding.offsets
+        assert span.tokens == encoding.tokens
+        assert span.to_encoding().ids == encoding.ids
+
+
+def test_corpus_blocks_match_tokenized_blocks(corpus):
+    for boundary in ["token", "whitespace", "sentence", ("paragraph", "sentence")]:
+        for truncate in ["left", "right"]:
+            for idx, doc in enumerate(DOCS):
+                expected = TextBlock(
+                    text=doc,
+                    max_tokens=7,
+                    truncate=truncate,
+                    boundary=boundary,
+                    tokenizer=tokenizer,
+                )
+                block = TextBlock.from_corpus(
+                    corpus, idx, max_tokens=7, truncate=truncate, boundary=boundary
+                )
+                assert block.text() == expected.text()
+
+
+def test_corpus_blocks_are_not_tokenized(corpus):
+    counting = corpus.tokenizer = CountingTokenizer(tokenizer)
+    block = Block(
+        children=[TextBlock.from_corpus(corpus, idx) for idx in (0, 3)],
+        separator="\n",
+        max_tokens=12,
+        boundary="sentence",
+        tokenizer=counting,
+    )
+    assert block.text() == "The first document. It has two sentences.\n"
+    # Only the separator is tokenized
+    assert counting.texts == ["\n"]
+
+    # The stored boundary points are views of the mapped files
+    buffer = corpus.span(0).pieces[0][0]
+    assert isinstance(buffer.boundary_points["whitespace"], np.memmap)
+
+
+def test_corpus_blocks_keep_their_tokens_under_equal_tokenizers(corpus):
+    from tokenizers import Tokenizer
+
+    equal = Tokenizer.from_str(tokenizer.to_str())
+    leaf = TextBlock.from_corpus(corpus, 0, tokenizer=equal, max_tokens=5)
+    block = Block(children=[leaf], tokenizer=Tokenizer.from_str(tokenizer.to_str()))
+    block.text()
+    # The tokens are still the ones read from the corpus
+    assert isinstance(leaf._tokens.pieces[0][0], StoredBuffer)
+
+    other = Tokenizer.from_str(tokenizer.to_str())
+    other.add_tokens(["first document"])
+    with pytest.raises(ValueError, match="another tokenizer"):
+        TextBlock.from_corpus(corpus, 0, tokenizer=other)
+    # Under a different tokenizer the document is tokenized again
+    leaf = TextBlock.from_corpus(corpus, 0)
+    Block(children=[leaf], tokenizer=other).text()
+    assert leaf.full_tokens().ids == other.encode(DOCS[0]).ids
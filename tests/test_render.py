@@ -0,0 +1,75 @@
+import multiprocessing
+
+from tokenizers import Tokenizer
+
+from blockflow import tokenizer as tokenizer_module
+from blockflow.block import Block, TextBlock
+from blockflow.render import _pickle_chunks, render_many
+from blockflow.tokenizer import create_tokenizer, load_snapshot, save_snapshot
+
+tokenizer = create_tokenizer()
+
+
+def prompts(n, tokenizer=tokenizer):
+    for idx in range(n):
+        yield Block(
+            children=[
+                TextBlock(text="You are a helpful assistant.", truncate="never"),
+                TextBlock(
+                    text=f"Question number {idx}. " * (idx + 1), boundary="sentence"
+                ),
+            ],
+            separator="\n",
+            max_tokens=20,
+            tokenizer=tokenizer,
+        )
+
+
+def test_render_many_matches_text():
+    expected = [block.text() for block in prompts(10)]
+    assert list(render_many(prompts(10), workers=2, chunk_size=3)) == expected
+
+    unordered = dict(render_many(prompts(10), workers=2, chunk_size=3, ordered=False))
+    assert [unordered[idx] for idx in range(10)] == expected
+
+
+def test_render_many_with_unregistered_tokenizer():
+    unregistered = Tokenizer.from_str(tokenizer.to_str())
+    expected = [block.text() for block in prompts(5, unregistered)]
+    assert list(render_many(prompts(5, unregistered), workers=2)) == expected
+
+
+def test_render_many_loads_snapshots_in_spawned_workers(tmp_path, monkeypatch):
+    # A name that only a snapshot can resolve, Tokenizer.from_pretrained fails
+    name = "blockflow-tests/offline-tokenizer"
+    monkeypatch.setitem(tokenizer_module._TOKENIZERS, name, tokenizer)
+    save_snapshot(tmp_path / "tokenizer.npz", name)
+    monkeypatch.setattr(tokenizer_module, "_TOKENIZERS", {})
+    monkeypatch.setattr(tokenizer_module, "_SNAPSHOTS", {})
+    restored = load_snapshot(tmp_path / "tokenizer.npz")
+
+    _, _, tokenizers = next(_pickle_chunks(prompts(2, restored), chunk_size=2))
+    assert tokenizers == {
+        ("snapshot", name, str((tmp_path / "tokenizer.npz").resolve())): None
+    }
+    expected = [block.text() for block in prompts(4, restored)]
+    rendered = render_many(
+        prompts(4, restored),
+        workers=2,
+        chunk_size=2,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    assert list(rendered) == expected
+
+
+def test_chunks_do_not_carry_tokenizers():
+    chunks = list(_pickle_chunks(prompts(10), chunk_size=4))
+    assert [start for start, _, _ in chunks] == [0, 4, 8]
+    for _, payload, tokenizers in chunks:
+        # Registered tokenizers are referred to by name only
+        assert tokenizers == {("name", None): None}
+        assert len(payload) < len(tokenizer.to_str()) // 100
+
+    unregistered = Tokenizer.from_str(tokenizer.to_str())
+    _, _, tokenizers = next(_pickle_chunks(prompts(4, unregistered), chunk_size=4))
+    assert list(tokenizers.values()) == [unregistered.to_str()]
@@ -0,0 +1,127 @@
+import copy
+import json
+import pickle
+
+from tokenizers import Encoding
+
+from blockflow.span import TokenSpan
+from blockflow.tokenizer import create_tokenizer
+
+tokenizer = create_tokenizer()
+
+
+def truncated(encoding: Encoding, n: int, direction: str) -> Encoding:
+    copied = copy.deepcopy(encoding)
+    copied.truncate(n, direction=direction)
+    return copied
+
+
+def test_head_and_tail_match_encoding_truncate():
+    encoding = tokenizer.encode("this is a sample text to slice")
+    span = TokenSpan.from_encoding(encoding)
+    for n in range(len(encoding) + 2):
+        expected_head = truncated(encoding, n, "right")
+        expected_tail = truncated(encoding, n, "left")
+        assert span.head(n).ids == expected_head.ids
+        assert span.head(n).offsets == expected_head.offsets
+        assert span.tail(n).ids == expected_tail.ids
+        assert span.tail(n).offsets == expected_tail.offsets
+
+
+def test_merge_matches_encoding_merge():
+    first = tokenizer.encode("this is a sample text")
+    second = tokenizer.encode("another sample")
+    parts = [truncated(first, 3, "left"), Encoding(), second, truncated(second, 1, "right")]
+    expected = Encoding.merge(parts)
+
+    merged = TokenSpan.merge([TokenSpan.from_encoding(part) for part in parts])
+    assert len(merged) == len(expected)
+    assert merged.ids == expected.ids
+    assert merged.tokens == expected.tokens
+    assert merged.offsets == expected.offsets
+
+    encoding = merged.to_encoding()
+    assert encoding.ids == expected.ids
+    assert encoding.offsets == expected.offsets
+    assert encoding.word_ids == expected.word_ids
+
+
+def test_built_encoding_round_trips_every_field():
+    first = tokenizer.encode("this is a sample text")
+    second = tokenizer.encode("another sample")
+    span = TokenSpan.merge(
+        [TokenSpan.from_encoding(first).tail(3), TokenSpan.from_encoding(second)]
+    )
+    encoding = span.to_encoding()
+    assert tuple(json.loads(encoding.__getstate__())) == tuple(
+        json.loads(Encoding().__getstate__())
+    )
+    assert len(encoding) == len(span)
+    assert encoding.ids == span.ids
+    assert encoding.tokens == span.tokens
+    assert encoding.offsets == span.offsets
+    assert encoding.type_ids == first.type_ids[-3:] + second.type_ids
+    assert encoding.word_ids == first.word_ids[-3:] + second.word_ids
+    assert encoding.special_tokens_mask == (
+        first.special_tokens_mask[-3:] + second.special_tokens_mask
+    )
+    assert encoding.attention_mask == first.attention_mask[-3:] + second.attention_mask
+    assert encoding.overflowing == []
+    assert encoding.n_sequences == 1
+
+    # The built encoding pickles like one made by the tokenizer
+    copied = pickle.loads(pickle.dumps(encoding))
+    assert copied.ids == encoding.ids and copied.offsets == encoding.offsets
+
+
+def test_merge_shifts_offsets_of_each_span():
+    first = TokenSpan.from_encoding(tokenizer.encode("this is a sample text"))
+    second = TokenSpan.from_encoding(tokenizer.encode("another sample"))
+    spans = [first.tail(3), TokenSpan(), second]
+    merged = TokenSpan.merge(spans)
+    shifts = TokenSpan.merge_shifts(spans)
+    assert shifts == [0, 21, 21]
+    assert merged.shift_at(0) == 0 and merged.shift_at(3) == 21
+    assert merged.offsets == first.tail(3).offsets + second.shifted(21).offsets
+
+def test_slices_share_the_source_encoding():
+    encoding = tokenizer.encode("this is a sample text")
+    span = TokenSpan.from_encoding(encoding)
+    assert span.to_encoding() is encoding
+    assert span.head(len(span)) is span
+    assert span.head(2).to_encoding().ids == encoding.ids[:2]
+    assert TokenSpan().to_encoding().ids == []
+
+
+def test_text_is_sliced_from_the_source():
+    text = "Déjà vu 🙂, twice:\n\n  déjà vu."
+    span = TokenSpan.from_encoding(tokenizer.encode(text), text=text)
+    assert span.text() == text
+    for n in range(len(span) + 1):
+        head, tail = span.head(n).text(), span.tail(len(span) - n).text()
+        assert head + tail == text
+        decoded = tokenizer.decode(span.head(n).ids)
+        # Decoding a character cut between its tokens gives a replacement character
+        assert head == decoded or "\ufffd" in decoded
+
+    # Pieces of spans without a source text are decoded
+    other = TokenSpan.from_encoding(tokenizer.encode(" and more"))
+    merged = TokenSpan.merge([span.head(3), other])
+    assert merged.text(tokenizer) == span.head(3).text() + " and more"
+
+
+def test_text_keeps_what_the_normalizer_changed():
+    from tokenizers import Tokenizer, normalizers
+
+    from blockflow.block import TextBlock
+
+    lowercasing = Tokenizer.from_str(tokenizer.to_str())
+    lowercasing.normalizer = normalizers.Lowercase()
+    text = "Keep The CASE Of This Text"
+    block = TextBlock(text=text, tokenizer=lowercasing)
+    assert block.text() == text
+    assert lowercasing.decode(block.tokens().ids) == text.lower()
+
+    block.max_tokens = 4
+    assert text.startswith(block.text())
+    assert block.text().lower() == lowercasing.decode(block.tokens().ids)
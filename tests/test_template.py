@@ -0,0 +1,116 @@
+import pytest
+
+from blockflow.block import Block, TextBlock
+from blockflow.errors import FrozenBlockError
+from blockflow.template import BlockTemplate, Slot
+from blockflow.tokenizer import create_tokenizer
+from helpers import CountingTokenizer
+
+tokenizer = create_tokenizer()
+
+SYSTEM = "You are a helpful assistant. Answer briefly and cite your sources."
+INSTRUCTIONS = "Use the context below to answer the question."
+
+
+def prompt(context, question, tokenizer=tokenizer):
+    return Block(
+        children=[
+            TextBlock(text=SYSTEM, truncate="never"),
+            Block(
+                children=[TextBlock(text=INSTRUCTIONS), context],
+                separator="\n",
+                max_tokens=24,
+                truncate="left",
+                boundary="whitespace",
+            ),
+            question,
+        ],
+        separator="\n\n",
+        max_tokens=48,
+        tokenizer=tokenizer,
+    )
+
+
+def test_render_matches_a_freshly_built_tree():
+    template = BlockTemplate(
+        prompt(Slot("context", boundary="sentence"), Slot("question"))
+    )
+    assert set(template.slots) == {"context", "question"}
+
+    for context, question in [
+        ("The sky is blue. Grass is green.", "What colour is the sky?"),
+        ("Short context.", "And a question that is long enough to get cut off here?"),
+    ]:
+        expected = prompt(
+            TextBlock(text=context, name="context", boundary="sentence"),
+            TextBlock(text=question, name="question"),
+        )
+        rendered = template.render(context=context, question=question)
+        assert rendered.text() == expected.text()
+        assert rendered.size() == expected.size()
+
+
+def test_render_only_tokenizes_slot_values():
+    counting = CountingTokenizer(tokenizer)
+    template = BlockTemplate(prompt(Slot("context"), Slot("question"), counting))
+    counting.texts.clear()
+
+    template.render(context="Some context.", question="A question?").text()
+    assert sorted(counting.texts) == ["A question?", "Some context."]
+
+
+def test_render_shares_static_blocks():
+    template = BlockTemplate(prompt(Slot("context"), Slot("question")))
+    first = template.render(context="one", question="two")
+    second = template.render(context="three", question="four")
+    assert first is not second
+    assert first.children[0] is second.children[0]
+    assert first.children[2].children[0] is second.children[2].children[0]
+    assert first.text().endswith("two") and second.text().endswith("four")
+
+
+def test_static_blocks_are_frozen():
+    block = prompt(Slot("context"), Slot("question"))
+    system = block.children[0]
+    template = BlockTemplate(block)
+    first = template.render(context="one", question="two more words")
+    second = template.render(context="three", question="four")
+    # Rendering does not take the shared blocks away from the template's tree
+    assert first.children[0] is system and system._parent is block
+
+    with pytest.raises(FrozenBlockError):
+        system.max_tokens = 2
+    with pytest.raises(FrozenBlockError):
+        block.children.append(TextBlock(text="more"))
+    with pytest.raises(FrozenBlockError):
+        first.set_tokenizer(CountingTokenizer(tokenizer))
+    assert first.text().startswith(SYSTEM) and second.text().startswith(SYSTEM)
+
+    # The copies and filled slots of one rendered tree are its own
+    expected = first.text()
+    first.children[-1].max_tokens = 1
+    assert first.text() != expected
+    assert second.text().endswith("four")
+
+
+def test_render_accepts_blocks_as_values():
+    template = BlockTemplate(prompt(Slot("context"), Slot("question")))
+    context = Block(children=[TextBlock(text="first doc"), TextBlock(text=" second doc")])
+    rendered = template.render(context=context, question="Which doc?")
+    assert "first doc second doc" in rendered.text()
+
+    # A block value with its own tokenizer hands it down to its leaves
+    counting = CountingTokenizer(tokenizer)
+    context = Block(children=[TextBlock(text="own doc")], tokenizer=counting)
+    assert "own doc" in template.render(context=context, question="q").text()
+    assert counting.texts == ["own doc"]
+
+
+def test_render_checks_slot_names():
+    template = BlockTemplate(prompt(Slot("context"), Slot("question")))
+    with pytest.raises(ValueError, match="question"):
+        template.render(context="only context")
+    with pytest.raises(ValueError, match="extra"):
+        template.render(context="c", question="q", extra="e")
+    with pytest.raises(ValueError, match="more than once"):
+        BlockTemplate(prompt(Slot("question"), Slot("question")))
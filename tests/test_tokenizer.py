@@ -0,0 +1,76 @@
+import numpy as np
+
+from blockflow import tokenizer as tokenizer_module
+from blockflow.block import TextBlock
+from blockflow.tokenizer import (
+    create_tokenizer,
+    load_snapshot,
+    save_snapshot,
+    tokenizer_artifacts,
+    tokenizer_fingerprint,
+    tokenizer_state,
+)
+
+
+def test_create_tokenizer_loads_once():
+    assert create_tokenizer() is create_tokenizer()
+
+
+def test_artifacts_are_shared():
+    tokenizer = create_tokenizer()
+    artifacts = tokenizer_artifacts(tokenizer)
+    assert tokenizer_artifacts(tokenizer) is artifacts
+    assert artifacts.ellipsis.ids == tokenizer.encode("...").ids
+    assert artifacts.ellipsis is tokenizer_artifacts(tokenizer).ellipsis
+
+
+def test_artifacts_are_keyed_by_tokenizer_state():
+    from tokenizers import Tokenizer
+
+    tokenizer = create_tokenizer()
+    copies = [Tokenizer.from_str(tokenizer.to_str()) for _ in range(20)]
+    # Equal tokenizers share their artifacts, and only the last few are kept
+    for copy in copies:
+        assert tokenizer_artifacts(copy) is tokenizer_artifacts(tokenizer)
+    assert len(tokenizer_module._ARTIFACTS) <= tokenizer_module._MAX_TOKENIZERS
+
+    # Every live tokenizer keeps its fingerprint, however many there are
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    for copy in copies:
+        state, kept = getattr(copy, tokenizer_module._FINGERPRINT_ATTRIBUTE)
+        assert state == tokenizer_state(copy) and kept == fingerprint
+
+    changed = copies[-1]
+    changed.add_tokens(["hello world"])
+    artifacts = tokenizer_artifacts(changed)
+    assert artifacts is not tokenizer_artifacts(tokenizer)
+    assert artifacts.fingerprint != tokenizer_artifacts(tokenizer).fingerprint
+    assert len(artifacts.vocabulary_masks.whitespace) == changed.get_vocab_size()
+
+
+def test_snapshot_round_trip(tmp_path, monkeypatch):
+    path = tmp_path / "tokenizer.npz"
+    tokenizer = create_tokenizer()
+    save_snapshot(path)
+    masks = tokenizer_artifacts(tokenizer).vocabulary_masks
+
+    # A fresh process has no tokenizers loaded yet
+    monkeypatch.setattr(tokenizer_module, "_TOKENIZERS", {})
+    restored = load_snapshot(path)
+    assert create_tokenizer() is restored
+    assert restored.to_str() == tokenizer.to_str()
+
+    artifacts = tokenizer_artifacts(restored)
+    assert "vocabulary_masks" in vars(artifacts)
+    assert np.array_equal(artifacts.vocabulary_masks.whitespace, masks.whitespace)
+    assert np.array_equal(artifacts.vocabulary_masks.newline, masks.newline)
+    assert artifacts.ellipsis.ids == tokenizer.encode("...").ids
+
+    block = TextBlock(
+        text="This is a sentence that will be cut.",
+        tokenizer=restored,
+        max_tokens=5,
+        ellipsis=True,
+        boundary="whitespace",
+    )
+    assert block.text().endswith("...")
@@ -0,0 +1,105 @@
+import random
+
+import numpy as np
+import pytest
+
+from blockflow.span import TokenSpan
+from blockflow.tokenizer import create_tokenizer
+from blockflow.truncation import (
+    FlatTree,
+    NodeData,
+    allocate_budget,
+    fold_tree,
+    process_boundary_points,
+)
+
+
+def scan_boundary_points(boundary_points, max_tokens, token_size, direction):
+    """Reference implementation stepping down one token at a time."""
+    if direction == "left":
+        while (token_size - max_tokens - 1) not in boundary_points and max_tokens > 0:
+            max_tokens -= 1
+    else:
+        while max_tokens not in boundary_points and max_tokens > 0:
+            max_tokens -= 1
+    return max_tokens
+
+
+@pytest.mark.parametrize("direction", ["left", "right"])
+def test_process_boundary_points_matches_scan(direction):
+    rng = random.Random(0)
+    for _ in range(500):
+        token_size = rng.randint(1, 60)
+        boundary_points = sorted(
+            rng.sample(range(token_size), rng.randint(0, token_size))
+        )
+        max_tokens = rng.randint(0, token_size - 1)
+        expected = scan_boundary_points(
+            boundary_points, max_tokens, token_size, direction
+        )
+        for points in (boundary_points, np.asarray(boundary_points, dtype=np.int64)):
+            assert (
+                process_boundary_points(points, max_tokens, token_size, direction)
+                == expected
+            )
+
+
+@pytest.mark.parametrize("direction", ["left", "right"])
+def test_every_token_is_a_boundary(direction):
+    assert process_boundary_points(range(100), 42, 100, direction) == 42
+    assert process_boundary_points(None, 42, 100, direction) == 42
+
+
+def fill_one_token_at_a_time(sizes, budget):
+    """Reference fair allocation handing out tokens round robin."""
+    shares = [0] * len(sizes)
+    for _ in range(budget):
+        wanting = [idx for idx in range(len(sizes)) if shares[idx] < sizes[idx]]
+        if not wanting:
+            break
+        shares[min(wanting, key=lambda idx: (shares[idx], idx))] += 1
+    return shares
+
+
+def test_allocate_budget_matches_round_robin():
+    rng = random.Random(0)
+    for _ in range(500):
+        sizes = [rng.randint(0, 40) for _ in range(rng.randint(1, 8))]
+        budget = rng.randint(0, 150)
+        assert allocate_budget(sizes, budget) == fill_one_token_at_a_time(
+            sizes, budget
+        )
+
+
+def test_allocate_budget_weighted():
+    assert allocate_budget([100, 100], 90, [2, 1]) == [60, 30]
+    # The share the small block does not need goes to the others
+    assert allocate_budget([5, 100, 100], 65, [4, 1, 1]) == [5, 30, 30]
+    assert allocate_budget([100, 100], 90, [1, 0]) == [90, 0]
+    assert allocate_budget([10, 20], 90, [1, 0]) == [10, 20]
+
+
+def test_flat_tree():
+    tokenizer = create_tokenizer()
+    leaves = [
+        NodeData(TokenSpan.from_encoding(tokenizer.encode(text)), name=text)
+        for text in ["zero", " one", " two", " three"]
+    ]
+    tree = [leaves[0], [[leaves[1], leaves[2]], []], [leaves[3]]]
+    flat = FlatTree.from_tree(tree)
+    assert flat.leaves == leaves
+    assert flat.groups.tolist() == [[1, 3], [3, 3], [1, 3], [3, 4], [0, 4]]
+    assert flat.sizes().tolist() == [len(leaf.tokens) for leaf in leaves]
+    assert flat.span().ids == tokenizer.encode("zero one two three").ids
+
+    with pytest.raises(TypeError):
+        FlatTree.from_tree([leaves[0], "two"])
+
+
+def test_fold_tree_without_recursion():
+    leaf = NodeData(TokenSpan(), name="leaf")
+    tree = [leaf]
+    for _ in range(10000):
+        tree = [tree, leaf]
+    assert fold_tree(tree, lambda _: 1, lambda _, counts: sum(counts)) == 10001
+    assert len(FlatTree.from_tree(tree).groups) == 10001